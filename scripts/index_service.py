@@ -1,13 +1,33 @@
 """
 Index Service
 -------------
-This FastAPI application provides two endpoints:
+This FastAPI application provides the following endpoints:
 
 1. **POST /index**  – kicks off a background indexing run that walks the whole
    workspace (repo root) and writes document chunks into a **local** Chroma
    vector store so no external infrastructure is required.
 2. **GET  /index/status** – returns the progress of the current/last run so
-   the calling process can display a nice progress bar.
+   the calling process can display a nice progress bar.  **GET /index/events**
+   streams the same information (plus throughput and ETA) as Server-Sent
+   Events so clients do not have to poll.
+3. **POST /search** – returns the chunks most similar to a query.
+   **POST /index/export** / **POST /index/import** write and load named
+   snapshots (kept below the state directory) so fresh machines start from
+   a warm index.
+4. **GET  /healthz** / **GET /readyz** – liveness and readiness probes.  The
+   service starts listening immediately; heavy backends are imported lazily
+   and Chroma is validated in the background, then re-checked by every
+   readiness probe.
+
+Progress and indexer ownership live in a small SQLite file so the service can
+run under ``uvicorn --workers N``: every worker serves /search and reports the
+same status while exactly one worker indexes at a time.
+
+One process serves any number of workspaces.  **POST /workspaces** registers
+one at runtime and every endpoint is also available below
+``/workspaces/{id}/…``; each workspace has its own collection, progress and
+index queue, while the embedding backend and the Chroma connection are shared
+and a scheduler splits indexing runs and embedding calls fairly between them.
 
 A couple of design decisions mean the service works even inside the very
 restricted Codex execution environment:
@@ -21,7 +41,27 @@ restricted Codex execution environment:
   embedding so the end-to-end flow still keeps working.
 * Large or generated folders such as *node_modules*, *vendor*, *dist*, *build*,
   *target*, *.git* … are completely skipped to keep memory footprint small and
-  indexing times low.
+  indexing times low.  Roots that are git repositories are enumerated from
+  the git index so everything matched by ``.gitignore`` is skipped as well.
+* Rebuilds (**POST /index?rebuild=true**, or a change of embedding backend,
+  chunking or projection) fill a new version of the collection while searches
+  keep using the old one; an alias flips to the new version once it is
+  complete and verified.
+* Stored vectors can optionally be reduced by a random projection or PCA
+  (*CODEX_INDEX_PROJECTION*); **GET /index/projection/eval** reports the
+  recall cost per dimension.
+* Roots that are git repositories remember the commit they were indexed at;
+  later runs only revisit the files changed since (commit diff plus working
+  tree status), and renamed files keep their embeddings.
+* Lockfiles, assets (SVG, fonts, images), minified bundles, generated code
+  and data dumps are recognised by a lightweight classifier and skipped;
+  **GET /index/classify** reports what would be skipped without indexing.
+* Interactive searches take priority: while they are being served the
+  indexer's embedding and store writes are paced to a configurable share of
+  the time, shrinking further when the search p99 exceeds its target.
+* **GET /index/plan** is a dry run of the next index pass: files and chunks
+  that would be added, changed or deleted plus a time estimate based on the
+  throughput measured by previous runs.
 
 The whole implementation lives in a **single file** on purpose because that
 keeps the integration effort with the existing monorepo low and avoids adding
@@ -51,68 +91,82 @@ additional build steps or package definitions.
 
 from __future__ import annotations
 
+import asyncio
+import codecs
+import contextvars
+import fnmatch
 # `hashlib` is only required for helper utilities later in the file.
 import hashlib
+import json
 import logging
 import os
+import sqlite3
 import subprocess
 import threading
 import time
+from collections import deque
+from contextlib import contextmanager
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Iterator, List
 
-import chromadb
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 
-# ---------------------------------------------------------------------------
-# Embedding utilities
-# ---------------------------------------------------------------------------
+if TYPE_CHECKING:  # only for annotations – imported lazily at runtime
+    import chromadb
+    import numpy as np
+
+# NOTE: `chromadb` (and through it `openai`) is **not** imported at module
+# level any more.  Pulling in the client library alone accounts for roughly a
+# second of import time which directly delays the moment uvicorn starts
+# listening – painful for pod start-up and autoscaling.  The helpers below
+# import the heavy backends lazily on first use instead.
+
+_backend_lock = threading.Lock()
+_chromadb_module = None
+
+
+def _chromadb():
+    """Return the lazily imported `chromadb` module."""
+
+    global _chromadb_module
 
+    if _chromadb_module is None:
+        with _backend_lock:
+            if _chromadb_module is None:
+                import chromadb  # deliberate lazy import
 
-try:
-    # `chromadb` ships optional integration helpers for popular models.
-    from chromadb.utils.embedding_functions import OpenAIEmbeddingFunction  # type: ignore
+                _chromadb_module = chromadb
 
-    import openai  # noqa: F401 – import used to detect availability only.
+    return _chromadb_module
 
-    OPENAI_AVAILABLE = True
-except Exception:  # pragma: no cover – any failure means we fall back.
-    OpenAIEmbeddingFunction = None  # type: ignore
-    OPENAI_AVAILABLE = False
+
+# ---------------------------------------------------------------------------
+# Embedding utilities
+# ---------------------------------------------------------------------------
 
 
 def _create_embedding_function():
-    """Return the best embedding backend for the current runtime."""
+    """Return ``(backend, identity)`` for the best backend of the runtime.
 
-    # We cannot rely on the module-level *logger* yet because logging is
-    # configured a bit further down in the file.  Create a temporary one on
-    # the fly so early diagnostic messages are not lost.
-    _log = logging.getLogger(__name__)
+    *identity* names the model and dimensionality so vectors produced by
+    different backends are never mixed (see the snapshot import).
+    """
 
     # ------------------------------------------------------------------
     # Primary backend – OpenAI embeddings when the package **and** an API key
-    # are available.  This is the preferred high-quality option.
+    # are available.  This is the preferred high-quality option.  The
+    # availability probe only runs when a key is configured so the common
+    # sandbox case never pays for importing `openai` at all.
     # ------------------------------------------------------------------
 
-    if OPENAI_AVAILABLE and os.environ.get("OPENAI_API_KEY"):
-        try:
-            from packaging.version import parse as _parse_version  # type: ignore
-
-            if _parse_version(getattr(openai, "__version__", "0")) < _parse_version("1.0.0"):
-                model = os.environ.get("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
-                _log.debug("Using OpenAI embeddings via model '%s'", model)
-                return OpenAIEmbeddingFunction(
-                    api_key=os.environ["OPENAI_API_KEY"], model_name=model
-                )
-            else:
-                _log.debug(
-                    "OpenAI package >=1.0 detected – falling back to hash embeddings because "
-                    "chromadb's OpenAIEmbeddingFunction relies on the deprecated <1.0 API"
-                )
-        except Exception as exc:  # pragma: no cover – robustness first
-            _log.debug("Failed to initialise OpenAI embeddings (%s) – falling back", exc)
+    model = os.environ.get("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+    fn = _openai_embedding_function(model)
+    if fn is not None:
+        return fn, f"openai:{model}"
 
     # ------------------------------------------------------------------
     # Fallback backend – *deterministic* hash embeddings when network access is
@@ -122,19 +176,57 @@ def _create_embedding_function():
     # particularly important inside the default sandbox environment.
     # ------------------------------------------------------------------
 
-    _log.debug("Falling back to deterministic hash embeddings (OpenAI unavailable)")
+    logging.getLogger(__name__).debug(
+        "Falling back to deterministic hash embeddings (OpenAI unavailable)"
+    )
+    return _hash_embedding_function(), "sha1-hash:20"
+
+
+def _openai_embedding_function(model: str):
+    """Return the OpenAI backend for *model*, or *None* when it is unavailable."""
+
+    _log = logging.getLogger(__name__)
+
+    if not os.environ.get("OPENAI_API_KEY"):
+        return None
+
+    try:
+        # `chromadb` ships optional integration helpers for popular models.
+        from chromadb.utils.embedding_functions import OpenAIEmbeddingFunction  # type: ignore
+
+        import openai  # type: ignore
+        from packaging.version import parse as _parse_version  # type: ignore
+
+        if _parse_version(getattr(openai, "__version__", "0")) < _parse_version("1.0.0"):
+            _log.debug("Using OpenAI embeddings via model '%s'", model)
+            return OpenAIEmbeddingFunction(api_key=os.environ["OPENAI_API_KEY"], model_name=model)
+
+        _log.debug(
+            "OpenAI package >=1.0 detected – falling back to hash embeddings because "
+            "chromadb's OpenAIEmbeddingFunction relies on the deprecated <1.0 API"
+        )
+    except Exception as exc:  # pragma: no cover – robustness first
+        _log.debug("Failed to initialise OpenAI embeddings (%s) – falling back", exc)
+
+    return None
+
+
+def _hash_embedding_function():
+    """Return the deterministic hash backend (``sha1-hash:20``)."""
+
+    import numpy as np
 
-    def _hash_embed(text: str) -> List[float]:  # noqa: D401 – simple helper
+    def _hash_embed(text: str) -> "np.ndarray":  # noqa: D401 – simple helper
         """Return a reproducible pseudo-embedding for *text*.
 
         The function uses SHA-1 to create a 20-byte digest which is then split
-        into 20 floats in the range 0-1.  The choice is arbitrary – the only
-        requirements are determinism and a fixed dimensionality so that the
-        vectors can be stored in Chroma without additional metadata.
+        into 20 float32 values in the range 0-1.  The choice is arbitrary – the
+        only requirements are determinism and a fixed dimensionality so that
+        the vectors can be stored in Chroma without additional metadata.
         """
 
         digest = hashlib.sha1(text.encode()).digest()
-        return [b / 255.0 for b in digest]
+        return np.frombuffer(digest, dtype=np.uint8).astype(np.float32) / 255.0
 
     def _embedding_fn(batch):  # type: ignore[override]
         # Accept both the batched form (List[str]) **and** the single-string
@@ -143,24 +235,76 @@ def _create_embedding_function():
         if isinstance(batch, str):
             return _hash_embed(batch)
 
-        return [_hash_embed(t) for t in batch]
+        return np.stack([_hash_embed(t) for t in batch]) if batch else np.empty((0, 20), np.float32)
 
     return _embedding_fn
 
 
-EmbeddingFunction = _create_embedding_function()
-# Emit a single informational line so users can immediately see which backend
-# was selected without having to crank log verbosity up to *DEBUG*.
-try:
-    _backend_name = (
-        EmbeddingFunction.__class__.__name__
-        if not callable(EmbeddingFunction)
-        else getattr(EmbeddingFunction, "__name__", str(EmbeddingFunction))
-    )
-except Exception:  # pragma: no cover – defensive
-    _backend_name = str(EmbeddingFunction)
+_embedding_function = None
+_embedding_backend_id: str | None = None
+
+
+def _get_embedding_function():
+    """Return the process wide embedding backend, creating it on first use."""
+
+    global _embedding_function, _embedding_backend_id
+
+    if _embedding_function is None:
+        with _backend_lock:
+            if _embedding_function is None:
+                fn, _embedding_backend_id = _create_embedding_function()
+
+                # Emit a single informational line so users can immediately
+                # see which backend was selected without having to crank log
+                # verbosity up to *DEBUG*.
+                try:
+                    backend_name = (
+                        fn.__class__.__name__
+                        if not callable(fn)
+                        else getattr(fn, "__name__", str(fn))
+                    )
+                except Exception:  # pragma: no cover – defensive
+                    backend_name = str(fn)
+
+                logging.getLogger(__name__).info(
+                    "Using embedding backend: %s (%s)", backend_name, _embedding_backend_id
+                )
+                _embedding_function = fn
+
+    return _embedding_function
+
 
-logging.getLogger(__name__).info("Using embedding backend: %s", _backend_name)
+def _get_embedding_backend_id() -> str:
+    """Return the identity of the embedding backend (model & dimensionality)."""
+
+    _get_embedding_function()
+    return _embedding_backend_id or "unknown"
+
+
+# Backends other than the configured one, by identity – queries against a
+# collection built with a previous backend are embedded with that backend
+# while its replacement is being rebuilt.
+_other_backends: Dict[str, Any] = {}
+
+
+def _get_embedding_backend(identity: str):
+    """Return the backend named *identity* (ValueError when it is unavailable)."""
+
+    if identity == _get_embedding_backend_id():
+        return _get_embedding_function()
+
+    with _backend_lock:
+        fn = _other_backends.get(identity)
+        if fn is None:
+            if identity == "sha1-hash:20":
+                fn = _hash_embedding_function()
+            elif identity.startswith("openai:"):
+                fn = _openai_embedding_function(identity.split(":", 1)[1])
+            if fn is None:
+                raise ValueError(f"Embedding backend {identity!r} is not available")
+            _other_backends[identity] = fn
+
+    return fn
 
 # ---------------------------------------------------------------------------
 # Logging configuration
@@ -210,9 +354,21 @@ ROOT_PATH = PRIMARY_ROOT
 # Log directory & file can be customised through env variables so the caller
 # can redirect output if required.
 LOG_DIR = Path(os.getenv("CODEX_LOG_DIR", ROOT_PATH / "logs")).resolve()
-LOG_DIR.mkdir(parents=True, exist_ok=True)
 LOG_FILE = LOG_DIR / "index_service.log"
 
+
+class _LazyRotatingFileHandler(RotatingFileHandler):
+    """Rotating file handler that creates *LOG_DIR* on the first emitted record.
+
+    Combined with ``delay=True`` this keeps module import free of filesystem
+    writes – the directory only appears once the service actually logs.
+    """
+
+    def _open(self):  # noqa: D401 – logging API
+        Path(self.baseFilename).parent.mkdir(parents=True, exist_ok=True)
+        return super()._open()
+
+
 # ---------------------------------------------------------------------------
 # The default log level is **DEBUG** so that all internal actions become
 # visible without any additional configuration which is extremely helpful when
@@ -238,7 +394,9 @@ if not any(isinstance(h, RotatingFileHandler) for h in _root_logger.handlers):
     _root_logger.addHandler(console_handler)
 
     # Rotating file so logs don’t grow without bound.
-    file_handler = RotatingFileHandler(LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=3)
+    file_handler = _LazyRotatingFileHandler(
+        LOG_FILE, maxBytes=5 * 1024 * 1024, backupCount=3, delay=True
+    )
     file_handler.setFormatter(
         logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s", "%Y-%m-%d %H:%M:%S")
     )
@@ -274,6 +432,46 @@ def _derive_collection_name(path: Path) -> str:
     return f"codex_index_{digest}"
 
 
+_chroma_client = None
+_client_lock = threading.Lock()
+
+
+def _remote_client():
+    """Return the process wide Chroma ``HttpClient`` for *CHROMA_URL*.
+
+    All workspaces share the client and with it the HTTP connection pool.
+    Raises on bad configuration.
+    """
+
+    global _chroma_client
+
+    if _chroma_client is not None:
+        return _chroma_client
+
+    with _client_lock:
+        if _chroma_client is None:
+            _chroma_client = _connect_client()
+
+    return _chroma_client
+
+
+def _connect_client():
+    endpoint = (
+        os.environ.get("CHROMA_URL")
+        or os.environ.get("CHROMADB_URL")
+        or "http://localhost:8000"
+    ).rstrip("/")
+
+    parsed = urlparse(endpoint)
+    if parsed.scheme not in {"http", "https"}:
+        raise ValueError("Unsupported URL scheme")
+
+    host = parsed.hostname or "localhost"
+    port = parsed.port or (443 if parsed.scheme == "https" else 80)
+
+    return _chromadb().HttpClient(host=host, port=port)  # type: ignore[arg-type]
+
+
 def _ensure_remote_collection() -> "chromadb.Collection | None":  # type: ignore[name-defined]
     """Ensure the project specific collection exists on the remote Chroma instance.
 
@@ -289,16 +487,9 @@ def _ensure_remote_collection() -> "chromadb.Collection | None":  # type: ignore
     ).rstrip("/")
 
     try:
-        parsed = urlparse(endpoint)
-        if parsed.scheme not in {"http", "https"}:
-            raise ValueError("Unsupported URL scheme")
-
-        host = parsed.hostname or "localhost"
-        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        client_remote = _remote_client()
 
-        client_remote = chromadb.HttpClient(host=host, port=port)  # type: ignore[arg-type]
-
-        col = client_remote.get_or_create_collection(_derive_collection_name(PRIMARY_ROOT))
+        col = client_remote.get_or_create_collection(_live_collection_name())
 
         logger.debug(
             "Ensured remote Chroma collection '%s' (count=%s) at %s",
@@ -313,6 +504,24 @@ def _ensure_remote_collection() -> "chromadb.Collection | None":  # type: ignore
         return None
 
 
+def _existing_live_collection() -> "chromadb.Collection | None":  # type: ignore[name-defined]
+    """Return the live collection without creating it – *None* when it is missing.
+
+    Raises when Chroma cannot be reached.
+    """
+
+    client = _remote_client()
+    name = _live_collection_name()
+    try:
+        return client.get_collection(name)
+    except Exception:
+        # Chroma reports a missing collection through various exception
+        # types; tell it apart from connection errors by listing them.
+        if name in [getattr(c, "name", c) for c in client.list_collections()]:
+            raise
+        return None
+
+
 # (ROOT_PATH already defined above.)
 
 # Folders we never want to index.  We use *contains* checks so nested matches
@@ -338,6 +547,15 @@ MAX_FILE_SIZE = 2 * 1024 * 1024  # 2 MiB
 CHUNK_SIZE = 1_000
 CHUNK_OVERLAP = 200
 
+# Number of ancestor directories stored as ``dir_<n>`` metadata so /search
+# can push path-prefix filters down into Chroma.  Deeper prefixes are still
+# supported but filtered after the query.
+PATH_PREFIX_DEPTH = 8
+
+# Bumped whenever the per-chunk metadata layout changes so the up-to-date
+# fast path re-indexes files written by an older version of the service.
+INDEX_SCHEMA_VERSION = 3
+
 # ---------------------------------------------------------------------------
 # Memory/throughput tuning
 # ---------------------------------------------------------------------------
@@ -348,18 +566,149 @@ CHUNK_OVERLAP = 200
 # batches** keeps the peak usage predictable while still retaining reasonable
 # throughput.
 
-# A value around 128 results in ~200 kB per batch (128 · 1536 · 8 bytes) for
-# 1536-dimensional float64 vectors which is a good compromise between memory
+# A value around 128 results in ~800 kB per batch (128 · 1536 · 4 bytes) for
+# 1536-dimensional float32 vectors which is a good compromise between memory
 # footprint and API/HTTP overhead.  The exact number can be tuned at runtime
 # through an environment variable so power-users can optimise for their
 # specific hardware.
 
 BATCH_SIZE = int(os.getenv("CODEX_INDEX_BATCH_SIZE", "4"))
 
-# Emit the configured batch size **early** so users can easily verify the
-# runtime setting without digging through *DEBUG* level logs.  The message is
-# logged at *INFO* so it shows up even during default verbosity runs.
-logger.info("Configured embedding batch size: %d", BATCH_SIZE)
+
+def _parse_size(value: str) -> int | None:
+    """Parse sizes such as ``512M``, ``2G`` or ``1048576`` into bytes."""
+
+    value = value.strip().upper().removesuffix("B")
+    if not value:
+        return None
+
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    if value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+
+    return int(value)
+
+
+# Optional upper bound for the resident set size of the indexing process
+# (e.g. ``CODEX_INDEX_MEMORY_BUDGET=512M``).  Unset means no enforcement.
+MEMORY_BUDGET = _parse_size(os.getenv("CODEX_INDEX_MEMORY_BUDGET", ""))
+
+# Files are read in segments of this size when they are streamed; anything
+# larger than *STREAM_THRESHOLD* is always streamed, smaller files only when
+# loading them whole would exceed the remaining memory budget.
+SEGMENT_BYTES = _parse_size(os.getenv("CODEX_INDEX_SEGMENT_BYTES", "256K")) or 256 * 1024
+STREAM_THRESHOLD = 4 * SEGMENT_BYTES
+
+# A file held in memory exists as bytes **and** as decoded str for a moment.
+_FILE_FOOTPRINT_FACTOR = 3
+
+
+class MemoryGovernor:
+    """Keep the indexer within *budget* bytes of resident memory.
+
+    The indexer is a sequential pipeline, so backpressure means adapting the
+    amount of work taken on at once rather than blocking: files that would
+    not fit into the remaining headroom are streamed in segments, embedding
+    batches shrink as RSS approaches the budget, and freed memory is handed
+    back to the OS when the budget is exceeded.
+
+    RSS only reflects memory once it is allocated, so the pipeline also
+    *reserves* the bytes of the files, batches and pending writes it holds
+    and releases them when they are gone.  Reservations count on top of
+    RSS – the governor errs on the side of smaller batches.
+    """
+
+    def __init__(self, budget: int | None):
+        self.budget = budget
+        self.peak_rss = 0
+        # Dimension of the vectors being embedded – set by every index run
+        # from the active backend; OpenAI's size until then.
+        self.vector_dim = 1536
+        self.reserved = 0
+        self._lock = threading.Lock()
+        self._warned = False
+
+    @property
+    def chunk_footprint(self) -> int:
+        """Rough size of one chunk in flight: its str, float32 vector and metadata."""
+
+        return CHUNK_SIZE * 2 + self.vector_dim * 4 + 1024
+
+    def reserve(self, nbytes: int) -> None:
+        with self._lock:
+            self.reserved += nbytes
+
+    def release(self, nbytes: int) -> None:
+        with self._lock:
+            self.reserved = max(0, self.reserved - nbytes)
+
+    @staticmethod
+    def rss() -> int | None:
+        """Return the current resident set size in bytes (Linux only)."""
+
+        try:
+            with open("/proc/self/statm", "rb") as fh:
+                return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except Exception:
+            return None
+
+    def headroom(self) -> int | None:
+        """Bytes left before the budget is reached (*None* = unlimited)."""
+
+        rss = self.rss()
+        if rss is None:
+            return None
+
+        self.peak_rss = max(self.peak_rss, rss)
+        return self.budget - rss - self.reserved if self.budget is not None else None
+
+    def should_stream(self, size: int) -> bool:
+        """Return whether a file of *size* bytes must be read in segments."""
+
+        if size > STREAM_THRESHOLD:
+            return True
+
+        headroom = self.headroom()
+        return headroom is not None and size * _FILE_FOOTPRINT_FACTOR > headroom
+
+    def batch_size(self, default: int) -> int:
+        """Return how many chunks may be embedded at once (at least one)."""
+
+        headroom = self.headroom()
+        if headroom is None:
+            return default
+
+        return max(1, min(default, headroom // self.chunk_footprint))
+
+    def checkpoint(self) -> None:
+        """Return freed memory to the OS when the budget is exceeded."""
+
+        headroom = self.headroom()
+        if headroom is None or headroom >= 0:
+            return
+
+        import ctypes
+        import gc
+
+        gc.collect()
+        try:
+            # glibc keeps freed arenas mapped – trim them explicitly.
+            ctypes.CDLL("libc.so.6").malloc_trim(0)
+        except Exception:
+            pass
+
+        headroom = self.headroom()
+        if headroom is not None and headroom < 0 and not self._warned:
+            self._warned = True
+            logger.warning(
+                "Indexer RSS exceeds the memory budget of %d MiB by %d MiB – "
+                "continuing with minimal batches",
+                self.budget // 1024**2,
+                -headroom // 1024**2,
+            )
+
+
+_memory_governor = MemoryGovernor(MEMORY_BUDGET)
 
 # ---------------------------------------------------------------------------
 # Progress tracking helpers
@@ -367,7 +716,7 @@ logger.info("Configured embedding batch size: %d", BATCH_SIZE)
 
 
 class IndexProgress(BaseModel):
-    status: str = "idle"  # idle | running | completed | error
+    status: str = "idle"  # idle | queued | running | completed | error
     processed_files: int = 0
     total_files: int = 0
     processed_chunks: int = 0
@@ -376,6 +725,8 @@ class IndexProgress(BaseModel):
     started_at: float | None = None
     finished_at: float | None = None
     error: str | None = None
+    # Exponentially smoothed wall time of one embedding batch.
+    embed_latency_ms: float | None = None
 
     def asdict(self) -> Dict[str, Any]:
         """FastAPI converts models automatically; sometimes we still want dicts."""
@@ -383,600 +734,4411 @@ class IndexProgress(BaseModel):
         return self.model_dump()
 
 
-# Shared, mutable progress instance.  We guard mutations with a lock so the
-# HTTP handler and the background thread never step on each other.
-_progress = IndexProgress()
-_progress_lock = threading.Lock()
-
 # ---------------------------------------------------------------------------
-# Helper – path normalisation across multiple workspace roots
+# Cross-process state – lets the service run under `uvicorn --workers N`
 # ---------------------------------------------------------------------------
 
+# A workspace's `progress` only describes runs owned by *this* process.  Progress,
+# indexer ownership and generation counters are additionally mirrored into a
+# small SQLite database so every worker reports the same status and exactly
+# one worker indexes at a time.  SQLite's own file locking provides the
+# mutual exclusion – no extra infrastructure is required.
+
+STATE_DIR = Path(
+    os.getenv("CODEX_STATE_DIR", Path.home() / ".cache" / "codex-index")
+).expanduser().resolve()
+
+# An indexer that has not renewed its lease for this many seconds is
+# considered dead (e.g. the worker was killed) and may be replaced.
+LEADER_LEASE_SECONDS = float(os.getenv("CODEX_LEADER_LEASE", "30"))
+
+# Minimum delay between two progress snapshots written to the shared store.
+PROGRESS_PUBLISH_INTERVAL = 0.5
+
+# Smoothing factor for the moving averages reported as live metrics.
+EWMA_ALPHA = 0.3
+
+# Identity of this worker process in the leader table.
+WORKER_ID = f"{os.uname().nodename}:{os.getpid()}:{os.urandom(4).hex()}"
+
+
+def _lease_token() -> str:
+    """Return a fresh lease owner – one per run, so the lease never nests."""
+
+    return f"{WORKER_ID}:{os.urandom(4).hex()}"
+
+
+class SharedState:
+    """Progress, leader lease, run queue, generations, metrics, checkpoints, aliases and workspaces."""
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self._initialised = False
+
+    def _connect(self):
+        if not self._initialised:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+
+        if not self._initialised:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS progress (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS leader (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    owner TEXT NOT NULL,
+                    heartbeat REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS generations (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS metrics (
+                    name TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS checkpoints (
+                    root TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS workspaces (
+                    id TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS aliases (
+                    name TEXT PRIMARY KEY,
+                    target TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS queued_run (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                """
+            )
+            self._initialised = True
 
-def _relative_to_roots(fp: Path) -> str:
-    """Return *fp* relative to the first matching root in *ROOT_PATHS*.
+        return conn
 
-    When *fp* is outside *all* configured roots we fall back to the absolute
-    path so callers always receive a meaningful string.
-    """
+    # Leader election ---------------------------------------------------
 
-    for root in ROOT_PATHS:
-        try:
-            return str(fp.relative_to(root))
-        except ValueError:
-            continue
+    def try_acquire(self, owner: str) -> bool:
+        """Claim the indexer lease for *owner* unless a live lease exists.
 
-    return str(fp)
+        The lease is not re-entrant: *owner* is a per-run token (see
+        `_lease_token`), so even a second run of the same worker is refused.
+        """
 
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT owner, heartbeat FROM leader WHERE id = 1").fetchone()
 
-def _update_progress(**kwargs):
-    with _progress_lock:
-        for k, v in kwargs.items():
-            setattr(_progress, k, v)
+            if row and time.time() - row[1] < LEADER_LEASE_SECONDS:
+                conn.execute("ROLLBACK")
+                return False
 
+            conn.execute(
+                "INSERT OR REPLACE INTO leader (id, owner, heartbeat) VALUES (1, ?, ?)",
+                (owner, time.time()),
+            )
+            conn.execute("COMMIT")
+            return True
+        finally:
+            conn.close()
 
-# ---------------------------------------------------------------------------
-# Core indexing helpers
-# ---------------------------------------------------------------------------
+    def renew(self, owner: str) -> None:
+        conn = self._connect()
+        try:
+            conn.execute(
+                "UPDATE leader SET heartbeat = ? WHERE id = 1 AND owner = ?", (time.time(), owner)
+            )
+        finally:
+            conn.close()
 
+    def release(self, owner: str) -> None:
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM leader WHERE id = 1 AND owner = ?", (owner,))
+        finally:
+            conn.close()
 
-def _iter_source_files(roots: list[Path]) -> List[Path]:
-    """Recursively walk *roots* and return a list of paths to index."""
+    def leader(self) -> tuple[str, float] | None:
+        """Return ``(owner, heartbeat)`` of the current lease holder, if any."""
 
-    out: List[Path] = []
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT owner, heartbeat FROM leader WHERE id = 1").fetchone()
+        finally:
+            conn.close()
 
-    for root in roots:
-        logger.debug("Scanning %s for source files (excluding %s)…", root, sorted(EXCLUDE_DIRS))
+        return (row[0], row[1]) if row else None
 
-        for dirpath, dirnames, filenames in os.walk(root):
-            # Prune excluded directories **in-place** so `os.walk` doesn’t even
-            # visit them.
-            dirnames[:] = [d for d in dirnames if d not in EXCLUDE_DIRS]
+    # Run queue ---------------------------------------------------------
+    #
+    # At most one run waits behind the one in progress; further requests
+    # are merged into it (a queued full or rebuild run stays one).
 
-            for filename in filenames:
-                fp = Path(dirpath, filename)
+    def queue_run(self, full: bool, rebuild: bool) -> None:
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT data FROM queued_run WHERE id = 1").fetchone()
+            queued = json.loads(row[0]) if row else {"full": False, "rebuild": False}
+            queued = {"full": queued["full"] or full, "rebuild": queued["rebuild"] or rebuild}
+            conn.execute(
+                "INSERT OR REPLACE INTO queued_run (id, data, updated_at) VALUES (1, ?, ?)",
+                (json.dumps(queued), time.time()),
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
 
-                # Skip obvious non-source files using simple heuristics.
-                # 1. Plain *.log files – typically large & irrelevant.
-                if fp.suffix.lower() == ".log":
-                    continue
-                try:
-                    if fp.stat().st_size > MAX_FILE_SIZE:
-                        continue
-                    with open(fp, "rb") as fh:
-                        sample = fh.read(2048)
-                        if b"\0" in sample:
-                            continue  # binary file
-                except Exception:
-                    # Permission errors or races → skip file.
-                    continue
+    def read_queued_run(self) -> Dict[str, bool] | None:
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT data FROM queued_run WHERE id = 1").fetchone()
+        finally:
+            conn.close()
 
-                out.append(fp)
+        return json.loads(row[0]) if row else None
 
-                # Log every 1000th file to avoid excessive logging noise while
-                # still providing feedback on very large repositories.
-                if len(out) % 1000 == 0:
-                    logger.debug(
-                        "Discovered %d candidate files so far – latest: %s", len(out), fp
-                    )
+    def take_queued_run(self) -> Dict[str, bool] | None:
+        """Remove and return the queued run – only call while holding the lease."""
 
-    logger.debug("Scanning completed – %d files matched across %d roots", len(out), len(roots))
-    return out
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT data FROM queued_run WHERE id = 1").fetchone()
+            conn.execute("DELETE FROM queued_run WHERE id = 1")
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
 
+        return json.loads(row[0]) if row else None
 
-def _chunk_text(text: str) -> List[str]:
-    """Split *text* into overlapping character chunks and return the list.
+    # Progress ----------------------------------------------------------
 
-    A debug log with the resulting chunk count helps to correlate later
-    embedding/upsert calls with the original input size.
-    """
+    def write_progress(self, progress: Dict[str, Any]) -> None:
+        conn = self._connect()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO progress (id, data, updated_at) VALUES (1, ?, ?)",
+                (json.dumps(progress), time.time()),
+            )
+        finally:
+            conn.close()
 
-    chunks: List[str] = []
-    start = 0
-    total = len(text)
-    while start < total:
-        end = min(start + CHUNK_SIZE, total)
-        chunks.append(text[start:end])
-        start = end - CHUNK_OVERLAP  # keep overlap for context
-        if start < 0:
-            start = 0
-    logger.debug("Chunked document into %d pieces", len(chunks))
-    return chunks
+    def read_progress(self) -> Dict[str, Any] | None:
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT data FROM progress WHERE id = 1").fetchone()
+        finally:
+            conn.close()
 
+        return json.loads(row[0]) if row else None
 
-def _embed_texts(texts: List[str]) -> List[List[float]] | None:
-    """Return embedding vectors for *texts*.
+    # Generations -------------------------------------------------------
 
-    The helper transparently splits larger inputs into **smaller batches** so
-    the peak memory usage stays low even for very large files.  Splitting is
-    especially important when using high-dimensional models such as
-    *text-embedding-3-small* where a single vector already contains >1500
-    floats.
-    """
+    def bump_generation(self, name: str) -> int:
+        """Increment and return the counter *name* (used to invalidate caches)."""
 
-    logger.debug(
-        "Embedding %d chunks using %s (batch size=%d)",
-        len(texts),
-        "callable wrapper" if callable(EmbeddingFunction) else type(EmbeddingFunction),
-        BATCH_SIZE,
-    )
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT INTO generations (name, value) VALUES (?, 1) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+                (name,),
+            )
+            (value,) = conn.execute(
+                "SELECT value FROM generations WHERE name = ?", (name,)
+            ).fetchone()
+            conn.execute("COMMIT")
+            return value
+        finally:
+            conn.close()
+
+    def generation(self, name: str) -> int:
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT value FROM generations WHERE name = ?", (name,)).fetchone()
+        finally:
+            conn.close()
 
-    all_vectors: List[List[float]] = []
-    t0 = time.perf_counter()
+        return row[0] if row else 0
 
-    # Process the incoming list in reasonably sized windows so we never hold
-    # on to more data than necessary.
-    for ofs in range(0, len(texts), BATCH_SIZE):
-        batch = texts[ofs : ofs + BATCH_SIZE]
+    # Metrics -----------------------------------------------------------
 
+    def write_metric(self, name: str, data: Dict[str, Any]) -> None:
+        conn = self._connect()
         try:
-            # Optimistically try the batched form first …
-            vectors = EmbeddingFunction(batch)  # type: ignore[arg-type]
+            conn.execute(
+                "INSERT OR REPLACE INTO metrics (name, data, updated_at) VALUES (?, ?, ?)",
+                (name, json.dumps(data), time.time()),
+            )
+        finally:
+            conn.close()
 
-            # … but detect helpers that incorrectly return a *single* vector
-            # instead of a list.
-            if isinstance(vectors, list) and vectors and not isinstance(vectors[0], list):
-                raise TypeError
-        except Exception:
-            # Fallback – call per chunk.
-            vectors = [EmbeddingFunction(t) for t in batch]  # type: ignore[arg-type]
+    def read_metric(self, name: str) -> Dict[str, Any] | None:
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT data FROM metrics WHERE name = ?", (name,)).fetchone()
+        finally:
+            conn.close()
 
-        all_vectors.extend(vectors)  # type: ignore[arg-type]
+        return json.loads(row[0]) if row else None
 
-    duration = time.perf_counter() - t0
+    def read_metrics(self, prefix: str) -> Dict[str, Dict[str, Any]]:
+        """Return every metric whose name starts with *prefix*."""
 
-    if logger.isEnabledFor(logging.DEBUG) and all_vectors:
-        logger.debug(
-            "Embedding completed in %.2fs (total %d vectors) – first vector preview: %s…",
-            duration,
-            len(all_vectors),
-            all_vectors[0][:5],
-        )
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT name, data FROM metrics WHERE substr(name, 1, ?) = ?",
+                (len(prefix), prefix),
+            ).fetchall()
+        finally:
+            conn.close()
 
-    return all_vectors
+        return {name: json.loads(data) for name, data in rows}
 
+    # Checkpoints -------------------------------------------------------
 
-def _run_indexing():
-    """The heavy-lifting background task that performs a full re-index."""
+    def write_checkpoint(self, root: str, data: Dict[str, Any]) -> None:
+        conn = self._connect()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO checkpoints (root, data, updated_at) VALUES (?, ?, ?)",
+                (root, json.dumps(data), time.time()),
+            )
+        finally:
+            conn.close()
 
-    logger.info(
-        "Starting full workspace index run … (roots=%s, exclude=%s)",
-        ", ".join(str(p) for p in ROOT_PATHS),
-        sorted(EXCLUDE_DIRS),
-    )
+    def read_checkpoint(self, root: str) -> Dict[str, Any] | None:
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT data FROM checkpoints WHERE root = ?", (root,)).fetchone()
+        finally:
+            conn.close()
 
-    _t0 = time.perf_counter()
+        return json.loads(row[0]) if row else None
 
-    _update_progress(
-        status="running",
-        processed_files=0,
-        processed_chunks=0,
-        current_file=None,
-        error=None,
-        started_at=time.time(),
-        finished_at=None,
-    )
+    # Collection aliases ------------------------------------------------
 
-    try:
-        files = _iter_source_files(ROOT_PATHS)
-        _update_progress(total_files=len(files))
+    def read_alias(self, name: str) -> str | None:
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT target FROM aliases WHERE name = ?", (name,)).fetchone()
+        finally:
+            conn.close()
 
-        logger.info(
-            "Discovered %s candidate files under %s in %.2fs",
-            len(files),
-            ROOT_PATH,
-            time.perf_counter() - _t0,
-        )
+        return row[0] if row else None
 
+    def read_aliases(self) -> Dict[str, tuple[str, float]]:
+        """Return every alias as ``{name: (target, updated_at)}``."""
 
-        # We no longer perform a **separate** full workspace pass to precount all
-        # chunks because loading every single file into memory doubled the total
-        # memory footprint during indexing and kept the high-water RSS at the
-        # peak value even after the pass completed (Python’s allocator seldom
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT name, target, updated_at FROM aliases").fetchall()
+        finally:
+            conn.close()
+
+        return {name: (target, updated_at) for name, target, updated_at in rows}
+
+    def write_alias(self, name: str, target: str | None) -> None:
+        conn = self._connect()
+        try:
+            if target is None:
+                conn.execute("DELETE FROM aliases WHERE name = ?", (name,))
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO aliases (name, target, updated_at) VALUES (?, ?, ?)",
+                    (name, target, time.time()),
+                )
+        finally:
+            conn.close()
+
+    def swap_alias(self, name: str, expected: str | None, target: str) -> bool:
+        """Point *name* at *target* unless it no longer points at *expected*."""
+
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT target FROM aliases WHERE name = ?", (name,)).fetchone()
+
+            if (row[0] if row else None) != expected:
+                conn.execute("ROLLBACK")
+                return False
+
+            conn.execute(
+                "INSERT OR REPLACE INTO aliases (name, target, updated_at) VALUES (?, ?, ?)",
+                (name, target, time.time()),
+            )
+            conn.execute("COMMIT")
+            return True
+        finally:
+            conn.close()
+
+    # Workspace registry ------------------------------------------------
+
+    def write_workspace(self, ws_id: str, data: Dict[str, Any]) -> None:
+        conn = self._connect()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO workspaces (id, data, updated_at) VALUES (?, ?, ?)",
+                (ws_id, json.dumps(data), time.time()),
+            )
+        finally:
+            conn.close()
+
+    def delete_workspace(self, ws_id: str) -> None:
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM workspaces WHERE id = ?", (ws_id,))
+        finally:
+            conn.close()
+
+    def read_workspaces(self) -> Dict[str, Dict[str, Any]]:
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT id, data FROM workspaces").fetchall()
+        finally:
+            conn.close()
+
+        return {ws_id: json.loads(data) for ws_id, data in rows}
+
+
+# ---------------------------------------------------------------------------
+# Workspaces – one process serves any number of them
+# ---------------------------------------------------------------------------
+
+
+class Workspace:
+    """Roots, collection, progress and shared state of one workspace.
+
+    Everything else – embedding backend, Chroma client, memory governor,
+    search QoS and the index scheduler – is shared by all workspaces of the
+    process, so serving another workspace costs little more than its state.
+    """
+
+    def __init__(self, roots: List[Path], name: str | None = None):
+        self.roots = roots
+        self.primary_root = roots[0]
+        self.collection_name = _derive_collection_name(self.primary_root)
+        self.id = self.collection_name.rsplit("_", 1)[1]
+        self.name = name or self.primary_root.name
+
+        # Progress of runs owned by this process.  Mutations hold the lock so
+        # HTTP handlers and the indexing thread never step on each other.
+        self.progress = IndexProgress()
+        self.progress_lock = threading.Lock()
+        self.last_publish = 0.0
+        # Lease owner token of the run this process is executing, if any.
+        self.lease_token: str | None = None
+        # Exclusive non-indexing operation in progress (snapshot export or
+        # import) – it does not show up in *progress*.
+        self.operation: str | None = None
+
+        self.state = SharedState(STATE_DIR / f"{self.collection_name}.sqlite3")
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "roots": [str(root) for root in self.roots],
+            "collection": self.collection_name,
+        }
+
+
+# The workspace configured through the environment serves every request that
+# does not name another one.
+_default_workspace = Workspace(ROOT_PATHS)
+
+_current_workspace: contextvars.ContextVar[Workspace] = contextvars.ContextVar(
+    "workspace", default=_default_workspace
+)
+
+
+def _ws() -> Workspace:
+    """Return the workspace the current request or indexing run works on."""
+
+    return _current_workspace.get()
+
+
+def _get_shared_state() -> SharedState:
+    """Return the :class:`SharedState` of the current workspace."""
+
+    return _ws().state
+
+
+_service_state_instance: SharedState | None = None
+
+
+def _service_state() -> SharedState:
+    """State shared by all workspaces – the registry and search latencies."""
+
+    global _service_state_instance
+
+    if _service_state_instance is None:
+        _service_state_instance = SharedState(STATE_DIR / "service.sqlite3")
+
+    return _service_state_instance
+
+
+def _start_thread(target, *args, name: str | None = None) -> threading.Thread:
+    """Start a daemon thread that inherits the caller's current workspace."""
+
+    thread = threading.Thread(
+        target=contextvars.copy_context().run, args=(target, *args), name=name, daemon=True
+    )
+    thread.start()
+    return thread
+
+
+_workspaces: Dict[str, Workspace] = {_default_workspace.id: _default_workspace}
+_workspaces_lock = threading.Lock()
+
+
+def _sync_workspaces() -> None:
+    """Pick up workspaces registered (or removed) by other worker processes."""
+
+    registered = _service_state().read_workspaces()
+
+    with _workspaces_lock:
+        for ws_id, data in registered.items():
+            if ws_id not in _workspaces:
+                _workspaces[ws_id] = Workspace([Path(r) for r in data["roots"]], data.get("name"))
+
+        for ws_id in list(_workspaces):
+            if ws_id not in registered and ws_id != _default_workspace.id:
+                del _workspaces[ws_id]
+
+
+def _lookup_workspace(key: str) -> Workspace | None:
+    """Return the registered workspace with id or name *key*."""
+
+    def _find() -> Workspace | None:
+        with _workspaces_lock:
+            for ws in _workspaces.values():
+                if key in (ws.id, ws.name):
+                    return ws
+        return None
+
+    found = _find()
+    if found is None:
+        _sync_workspaces()
+        found = _find()
+
+    return found
+
+
+def _register_workspace(roots: List[Path], name: str | None = None) -> Workspace:
+    """Register a workspace (idempotent – the primary root decides identity)."""
+
+    ws = Workspace(roots, name)
+
+    with _workspaces_lock:
+        existing = _workspaces.get(ws.id)
+        if existing is not None:
+            return existing
+        _workspaces[ws.id] = ws
+
+    _service_state().write_workspace(ws.id, {"roots": [str(r) for r in roots], "name": ws.name})
+    logger.info("Registered workspace %s (%s)", ws.name, ", ".join(str(r) for r in roots))
+    return ws
+
+
+def _publish_progress(force: bool = False) -> None:
+    """Mirror the workspace progress into the shared store (rate limited unless *force*)."""
+
+    ws = _ws()
+
+    now = time.monotonic()
+    if not force and now - ws.last_publish < PROGRESS_PUBLISH_INTERVAL:
+        return
+
+    with ws.progress_lock:
+        snapshot = ws.progress.asdict()
+        ws.last_publish = now
+
+    try:
+        state = _get_shared_state()
+        state.write_progress(snapshot)
+        if ws.lease_token is not None:
+            state.renew(ws.lease_token)
+    except Exception as exc:  # pragma: no cover – status is best-effort
+        logger.debug("Failed to publish progress to shared state: %s", exc)
+
+# ---------------------------------------------------------------------------
+# Helper – path normalisation across multiple workspace roots
+# ---------------------------------------------------------------------------
+
+
+def _relative_to_roots(fp: Path) -> str:
+    """Return *fp* relative to the first matching root of the workspace.
+
+    When *fp* is outside *all* configured roots we fall back to the absolute
+    path so callers always receive a meaningful string.
+    """
+
+    for root in _ws().roots:
+        try:
+            return str(fp.relative_to(root))
+        except ValueError:
+            continue
+
+    return str(fp)
+
+
+def _root_for(fp: Path) -> Path | None:
+    """Return the workspace root that contains *fp* (or *None*)."""
+
+    for root in _ws().roots:
+        try:
+            fp.relative_to(root)
+            return root
+        except ValueError:
+            continue
+
+    return None
+
+
+def _root_key(fp: Path, rel_path: str) -> tuple[str, str]:
+    """Return ``(root, path)`` of *fp* as recorded in its chunk metadata."""
+
+    root = _root_for(fp)
+    return (str(root) if root is not None else "", rel_path)
+
+
+def _path_metadata(fp: Path, rel_path: str) -> Dict[str, Any]:
+    """Return the per-file metadata attached to every chunk of *fp*.
+
+    Besides the relative *path* we store the lower-cased extension, the owning
+    root and one ``dir_<n>`` key per ancestor directory (up to
+    *PATH_PREFIX_DEPTH*).  Chroma's ``where`` clause has no string prefix
+    operator, so the ancestor keys turn a directory prefix filter into a
+    plain equality comparison that is evaluated inside the store.
+    """
+
+    root = _root_for(fp)
+    meta: Dict[str, Any] = {
+        "path": rel_path,
+        "ext": fp.suffix.lower(),
+        "root": str(root) if root is not None else "",
+    }
+
+    parts = Path(rel_path).parts[:-1]
+    for depth in range(1, min(len(parts), PATH_PREFIX_DEPTH) + 1):
+        meta[f"dir_{depth}"] = "/".join(parts[:depth])
+
+    return meta
+
+
+def _update_progress(**kwargs):
+    ws = _ws()
+    with ws.progress_lock:
+        for k, v in kwargs.items():
+            setattr(ws.progress, k, v)
+
+    # Status transitions are published immediately, counters rate limited.
+    _publish_progress(force="status" in kwargs)
+
+
+# ---------------------------------------------------------------------------
+# Core indexing helpers
+# ---------------------------------------------------------------------------
+
+
+# ---------------------------------------------------------------------------
+# Content classification – skip lockfiles, assets, minified & generated code
+# ---------------------------------------------------------------------------
+
+# Files that are technically text but carry little value for code search and
+# would otherwise dominate the index (a single package-lock.json easily
+# yields more chunks than the rest of a frontend repository).
+
+_LOCKFILE_NAMES = {
+    "package-lock.json",
+    "npm-shrinkwrap.json",
+    "yarn.lock",
+    "pnpm-lock.yaml",
+    "bun.lockb",
+    "composer.lock",
+    "Cargo.lock",
+    "Gemfile.lock",
+    "Pipfile.lock",
+    "poetry.lock",
+    "uv.lock",
+    "go.sum",
+}
+
+_ASSET_SUFFIXES = {
+    ".svg", ".png", ".jpg", ".jpeg", ".gif", ".ico", ".webp", ".bmp", ".pdf",
+    ".ttf", ".otf", ".woff", ".woff2", ".eot", ".map",
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".7z", ".jar",
+    ".mp3", ".mp4", ".wav", ".mov", ".webm",
+}
+
+# Assets that are text and would otherwise have been chunked – only these
+# count towards the "chunks saved" estimate, binary assets never were.
+_TEXT_ASSET_SUFFIXES = {".svg", ".map"}
+
+_DATA_SUFFIXES = {".csv", ".tsv", ".jsonl", ".ndjson", ".parquet", ".sqlite", ".db"}
+
+_MINIFIED_SUFFIXES = (".min.js", ".min.css", ".min.mjs", ".bundle.js", ".chunk.js")
+
+# Markers that code generators put near the top of their output.
+_GENERATED_MARKERS = (
+    b"@generated",
+    b"do not edit",
+    b"code generated by",
+    b"auto-generated",
+    b"autogenerated",
+    b"this file was generated",
+)
+
+# Per-extension size limits below MAX_FILE_SIZE for formats that are mostly
+# data once they grow beyond hand-written size.
+CLASSIFIER_SIZE_LIMITS: Dict[str, int] = {
+    ".json": 256 * 1024,
+    ".yaml": 256 * 1024,
+    ".yml": 256 * 1024,
+    ".xml": 256 * 1024,
+    ".sql": 256 * 1024,
+}
+
+# Bytes of a file inspected by the content heuristics.
+_CLASSIFIER_SAMPLE = 64 * 1024
+
+
+def _load_classifier_config() -> Dict[str, Any]:
+    """Return the classifier overrides from *CODEX_INDEX_CLASSIFIER*.
+
+    The variable points to a JSON file such as::
+
+        {"allow": ["docs/*.svg"], "deny": ["fixtures/*"],
+         "size_limits": {".json": "1M"}, "disabled_categories": ["generated"]}
+
+    Patterns use `fnmatch` semantics against the root relative path; *allow*
+    wins over every classifier rule, *deny* always skips.
+    """
+
+    path = os.getenv("CODEX_INDEX_CLASSIFIER")
+    if not path:
+        return {}
+
+    try:
+        config = json.loads(Path(path).expanduser().read_text())
+    except Exception as exc:
+        logger.warning("Ignoring unreadable classifier config %s – %s", path, exc)
+        return {}
+
+    for ext, limit in (config.get("size_limits") or {}).items():
+        CLASSIFIER_SIZE_LIMITS[ext.lower()] = _parse_size(str(limit)) or 0
+
+    return config
+
+
+_classifier_config: Dict[str, Any] | None = None
+
+
+def _classifier() -> Dict[str, Any]:
+    global _classifier_config
+
+    if _classifier_config is None:
+        _classifier_config = _load_classifier_config()
+
+    return _classifier_config
+
+
+def _matches_any(rel_path: str, patterns) -> bool:
+    return any(fnmatch.fnmatch(rel_path, pattern) for pattern in patterns)
+
+
+def _summarise_skipped(
+    skipped: Dict[tuple[str, str], tuple[str, int | None]]
+) -> Dict[str, Dict[str, Any]]:
+    """Group *skipped* by category with file, byte and estimated chunk totals."""
+
+    summary: Dict[str, Dict[str, Any]] = {}
+    for (_root, rel_path), (category, size) in sorted(skipped.items()):
+        entry = summary.setdefault(
+            category, {"files": 0, "bytes": 0, "chunks": 0, "examples": []}
+        )
+        entry["files"] += 1
+        entry["bytes"] += size or 0
+        if category != "asset" or os.path.splitext(rel_path)[1].lower() in _TEXT_ASSET_SUFFIXES:
+            entry["chunks"] += _estimate_chunks(size or 0)
+        if len(entry["examples"]) < 10:
+            entry["examples"].append(rel_path)
+
+    return summary
+
+
+def _paths_where(keys: Iterable[tuple[str, str]]) -> Dict[str, Any]:
+    """Return a ``where`` clause matching every chunk of the ``(root, path)`` *keys*.
+
+    Relative paths are only unique within their root – ``README.md`` exists
+    in most of them – so every path is matched together with its root.
+    Entries without a root (written before chunks recorded one) can only be
+    matched by path.
+    """
+
+    by_root: Dict[str, List[str]] = {}
+    for root, path in keys:
+        by_root.setdefault(root, []).append(path)
+
+    # Chroma expects exactly one top-level operator per `where`, and `$and`
+    # / `$or` need at least two operands.
+    clauses: List[Dict[str, Any]] = []
+    for root, paths in sorted(by_root.items()):
+        path_clause = {"path": {"$in": paths}} if len(paths) > 1 else {"path": {"$eq": paths[0]}}
+        clauses.append(path_clause if not root else {"$and": [{"root": {"$eq": root}}, path_clause]})
+
+    return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+
+def _delete_paths(col, keys: List[tuple[str, str]]) -> None:
+    """Remove every chunk of the ``(root, path)`` *keys* from *col* in a few bulk calls."""
+
+    for ofs in range(0, len(keys), 1_000):
+        batch = keys[ofs : ofs + 1_000]
+        try:
+            col.delete(where=_paths_where(batch))
+        except Exception as exc:
+            logger.debug("Failed to delete %d skipped paths – %s", len(batch), exc)
+
+
+MANIFEST_PAGE_SIZE = 1_000
+
+
+def _load_manifest(
+    col, keys: List[tuple[str, str]] | None = None, by_root: bool = False
+) -> Dict[Any, Dict[str, Any]]:
+    """Return the chunk-0 metadata of every stored file keyed by relative path.
+
+    Chunk 0 carries the mtime, content hash, chunk count and schema of its
+    file, so this single paginated query answers the freshness question for
+    the whole workspace instead of one lookup per file.  *keys* restricts
+    the lookup to the given ``(root, path)`` files.  *by_root* keys the
+    entries by ``(root, path)`` instead, which tells apart files of
+    different roots that share a relative path (e.g. ``README.md``).
+    """
+
+    manifest: Dict[Any, Dict[str, Any]] = {}
+
+    def _key(meta: Dict[str, Any]) -> Any:
+        return (meta.get("root", ""), meta["path"]) if by_root else meta["path"]
+
+    if keys is not None:
+        for ofs in range(0, len(keys), MANIFEST_PAGE_SIZE):
+            batch = keys[ofs : ofs + MANIFEST_PAGE_SIZE]
+            page = col.get(
+                where={"$and": [_paths_where(batch), {"chunk_index": {"$eq": 0}}]},
+                include=["metadatas"],
+            )
+            for meta in page.get("metadatas") or []:
+                if meta and meta.get("path") is not None:
+                    manifest[_key(meta)] = meta
+        return manifest
+
+    offset = 0
+
+    while True:
+        page = col.get(
+            where={"chunk_index": {"$eq": 0}},
+            limit=MANIFEST_PAGE_SIZE,
+            offset=offset,
+            include=["metadatas"],
+        )
+        metadatas = page.get("metadatas") or []
+        if not metadatas:
+            break
+        offset += len(metadatas)
+
+        for meta in metadatas:
+            if meta and meta.get("path") is not None:
+                manifest[_key(meta)] = meta
+
+    return manifest
+
+
+# Rough characters-per-token ratio of source code, used for estimates only.
+CHARS_PER_TOKEN = 4
+
+
+def _record_throughput(chunks: int, size: int, seconds: float) -> None:
+    """Fold the embed + write rate of a finished run into the shared metrics."""
+
+    if chunks <= 0 or seconds <= 0:
+        return
+
+    state = _get_shared_state()
+    previous = state.read_metric("throughput") or {}
+    measured = {"chunks_per_second": chunks / seconds, "bytes_per_second": size / seconds}
+
+    # Smooth across runs – a run that re-embedded three files should not
+    # replace the figure measured over a full index.
+    for key, value in measured.items():
+        if previous.get(key):
+            measured[key] = previous[key] + EWMA_ALPHA * (value - previous[key])
+
+    state.write_metric("throughput", {**measured, "measured_at": time.time()})
+
+
+def _classify_path(rel_path: str, size: int | None) -> str | None:
+    """Return the skip category of *rel_path* from its name and size alone.
+
+    *None* means the file should be indexed (subject to the content check).
+    """
+
+    config = _classifier()
+    if _matches_any(rel_path, config.get("allow", ())):
+        return None
+    if _matches_any(rel_path, config.get("deny", ())):
+        return "denied"
+
+    name = rel_path.rsplit("/", 1)[-1]
+    lower = name.lower()
+    suffix = os.path.splitext(lower)[1]
+    disabled = set(config.get("disabled_categories", ()))
+
+    category: str | None = None
+    if name in _LOCKFILE_NAMES:
+        category = "lockfile"
+    elif suffix in _ASSET_SUFFIXES:
+        category = "asset"
+    elif lower.endswith(_MINIFIED_SUFFIXES):
+        category = "minified"
+    elif suffix in _DATA_SUFFIXES:
+        category = "data"
+    elif size is not None and size > CLASSIFIER_SIZE_LIMITS.get(suffix, MAX_FILE_SIZE):
+        category = "oversized"
+
+    return category if category not in disabled else None
+
+
+def _classify_content(rel_path: str, size: int, sample: bytes) -> str | None:
+    """Return the skip category of a file from its size and leading bytes.
+
+    Runs on the buffer the indexer reads anyway, so classification never
+    costs an extra read.
+    """
+
+    category = _classify_path(rel_path, size)
+    if category is not None:
+        return category
+
+    config = _classifier()
+    if _matches_any(rel_path, config.get("allow", ())):
+        return None
+
+    disabled = set(config.get("disabled_categories", ()))
+    sample = sample[:_CLASSIFIER_SAMPLE]
+
+    head = sample[:1024].lower()
+    if "generated" not in disabled and any(marker in head for marker in _GENERATED_MARKERS):
+        return "generated"
+
+    if "minified" not in disabled and len(sample) >= 1024:
+        lines = sample.split(b"\n")
+        long_bytes = sum(len(line) for line in lines if len(line) > 500)
+        whitespace = sum(sample.count(c) for c in b" \t\r\n") / len(sample)
+
+        # Minified bundles and files dominated by embedded blobs (data URIs,
+        # base64) consist mostly of very long lines with little whitespace.
+        if long_bytes / len(sample) >= 0.25 or (
+            len(sample) / len(lines) > 200 and whitespace < 0.1
+        ):
+            return "minified"
+
+    return None
+
+
+# File enumeration strategy: "auto" reads the git index for roots that are
+# repositories and walks the filesystem otherwise, "git" / "walk" force one of
+# the two (a root that is not a repository always falls back to walking).
+ENUMERATION_MODE = os.getenv("CODEX_INDEX_ENUMERATION", "auto").lower()
+
+# Git index entry modes we never index: symlinks and gitlinks (submodules).
+_GIT_MODE_SYMLINK = 0o120000
+_GIT_MODE_GITLINK = 0o160000
+
+
+def _git(root: Path, *args: str) -> bytes | None:
+    """Run ``git -C root …`` and return stdout, or *None* on any failure."""
+
+    try:
+        proc = subprocess.run(
+            ["git", "-C", str(root), *args],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+    except Exception:
+        return None
+
+    return proc.stdout
+
+
+def _read_git_index_stats(index_file: Path) -> Dict[str, tuple[int, int]]:
+    """Return ``{repo relative path: (mode, size)}`` parsed from a git index.
+
+    Git caches the stat data of every tracked file in ``.git/index``; reading
+    it once is far cheaper than one ``stat`` per file.  Versions 2 to 4 of the
+    format are supported.  Any parsing problem yields an empty mapping so
+    callers transparently fall back to ``stat``.
+    """
+
+    import struct
+
+    try:
+        data = index_file.read_bytes()
+        signature, version, count = struct.unpack_from(">4sII", data, 0)
+        if signature != b"DIRC" or version not in (2, 3, 4):
+            return {}
+
+        out: Dict[str, tuple[int, int]] = {}
+        ofs = 12
+        prev_name = b""
+
+        for _ in range(count):
+            start = ofs
+            mode, _uid, _gid, size = struct.unpack_from(">IIII", data, ofs + 24)
+            (flags,) = struct.unpack_from(">H", data, ofs + 60)
+            ofs += 62
+
+            if version >= 3 and flags & 0x4000:
+                ofs += 2  # extended flags
+
+            if version == 4:
+                # Prefix compressed path: varint "strip N bytes from the
+                # previous name" followed by a NUL terminated suffix.
+                byte = data[ofs]
+                ofs += 1
+                strip = byte & 0x7F
+                while byte & 0x80:
+                    byte = data[ofs]
+                    ofs += 1
+                    strip = ((strip + 1) << 7) | (byte & 0x7F)
+                end = data.index(b"\0", ofs)
+                name = prev_name[: len(prev_name) - strip] + data[ofs:end]
+                ofs = end + 1
+            else:
+                end = data.index(b"\0", ofs)
+                name = data[ofs:end]
+                # Entries are NUL padded to a multiple of eight bytes.
+                ofs = start + ((end - start + 8) & ~7)
+
+            prev_name = name
+            # Stage > 0 entries belong to unresolved merges – keep stage 0.
+            if (flags >> 12) & 0x3:
+                continue
+            out[os.fsdecode(name)] = (mode, size)
+
+        return out
+    except Exception as exc:
+        logger.debug("Unable to parse git index %s (%s) – falling back to stat", index_file, exc)
+        return {}
+
+
+def _iter_git_files(root: Path) -> List[tuple[Path, int | None]] | None:
+    """Return ``(path, cached size)`` pairs for *root* via the git index.
+
+    Tracked files plus untracked files that are **not** ignored are listed so
+    ``.gitignore`` is honoured exactly like git itself does.  Sizes come from
+    the index stat cache where available – *None* for untracked files and
+    for files modified since they were staged, whose cached size is stale.
+    Returns *None* when *root* is not inside a git work tree.
+    """
+
+    info = _git(root, "rev-parse", "--show-prefix", "--absolute-git-dir")
+    if info is None:
+        return None
+
+    try:
+        prefix, git_dir = info.decode().splitlines()[:2]
+    except ValueError:
+        return None
+
+    listed = _git(root, "ls-files", "-z", "--cached", "--others", "--exclude-standard")
+    if listed is None:
+        return None
+
+    # Tracked files deleted in the working tree are still part of the index.
+    deleted = set((_git(root, "ls-files", "-z", "--deleted") or b"").split(b"\0"))
+    # Git compares the cached stat data with the working tree for us.
+    modified = _git(root, "ls-files", "-z", "--modified")
+    modified = set(modified.split(b"\0")) if modified is not None else None
+
+    stats = _read_git_index_stats(Path(git_dir) / "index")
+
+    out: List[tuple[Path, int | None]] = []
+    for raw in listed.split(b"\0"):
+        if not raw or raw in deleted:
+            continue
+
+        rel = os.fsdecode(raw)
+        cached = stats.get(prefix + rel)
+        size: int | None = None
+
+        if cached is not None:
+            mode, size = cached
+            if mode & 0o170000 in (_GIT_MODE_SYMLINK, _GIT_MODE_GITLINK):
+                continue
+            if modified is None or raw in modified:
+                size = None  # checked on the single read instead
+
+        out.append((root / rel, size))
+
+    return out
+
+
+def _iter_walk_files(root: Path) -> List[tuple[Path, int | None]]:
+    """Return ``(path, None)`` pairs for *root* using a plain ``os.walk``."""
+
+    out: List[tuple[Path, int | None]] = []
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        # Prune excluded directories **in-place** so `os.walk` doesn’t even
+        # visit them.
+        dirnames[:] = [d for d in dirnames if d not in EXCLUDE_DIRS]
+
+        for filename in filenames:
+            out.append((Path(dirpath, filename), None))
+
+    return out
+
+
+def _accept_candidate(
+    root: Path,
+    fp: Path,
+    size: int | None,
+    skipped: Dict[tuple[str, str], tuple[str, int | None]] | None,
+) -> bool:
+    """Apply the discovery filters to one enumerated file of *root*."""
+
+    # The git listing is not pruned by directory – apply the same
+    # exclusions so both strategies index the same kind of files.
+    if any(part in EXCLUDE_DIRS for part in fp.relative_to(root).parts[:-1]):
+        return False
+
+    # Skip obvious non-source files using simple heuristics.
+    # 1. Plain *.log files – typically large & irrelevant.
+    if fp.suffix.lower() == ".log":
+        return False
+    # 2. Oversized files – only when the size is already known from
+    #    the git index (and the file unchanged since).  Everything else (size limit for walked files,
+    #    binary sniff) happens on the single read during indexing so
+    #    discovery never opens or stats a file.
+    if size is not None and size > MAX_FILE_SIZE:
+        return False
+    # 3. Lockfiles, assets, minified bundles, data dumps …
+    category = _classify_path(fp.relative_to(root).as_posix(), size)
+    if category is not None:
+        if skipped is not None:
+            skipped[_root_key(fp, _relative_to_roots(fp))] = (category, size)
+        return False
+
+    return True
+
+
+def _iter_source_files(
+    roots: list[Path], skipped: Dict[tuple[str, str], tuple[str, int | None]] | None = None
+) -> List[Path]:
+    """Enumerate *roots* and return a list of paths to index.
+
+    Files rejected by `_classify_path` are recorded in *skipped* (when given)
+    as ``{(root, relative path): (category, size or None)}``.
+    """
+
+    out: List[Path] = []
+
+    for root in roots:
+        candidates = None
+
+        if ENUMERATION_MODE != "walk":
+            candidates = _iter_git_files(root)
+            if candidates is not None:
+                logger.debug("Enumerating %s from the git index (%d entries)", root, len(candidates))
+
+        if candidates is None:
+            logger.debug("Scanning %s for source files (excluding %s)…", root, sorted(EXCLUDE_DIRS))
+            candidates = _iter_walk_files(root)
+
+        for fp, size in candidates:
+            if not _accept_candidate(root, fp, size, skipped):
+                continue
+
+            out.append(fp)
+
+            # Log every 1000th file to avoid excessive logging noise while
+            # still providing feedback on very large repositories.
+            if len(out) % 1000 == 0:
+                logger.debug(
+                    "Discovered %d candidate files so far – latest: %s", len(out), fp
+                )
+
+    logger.debug("Scanning completed – %d files matched across %d roots", len(out), len(roots))
+    return out
+
+
+# ---------------------------------------------------------------------------
+# Incremental discovery – only files git reports as changed
+# ---------------------------------------------------------------------------
+
+# "auto" re-indexes only the files changed since the last run's commit when
+# every root is a git repository with a usable checkpoint; "off" always scans
+# the whole workspace.
+INCREMENTAL_MODE = os.getenv("CODEX_INDEX_INCREMENTAL", "auto").lower()
+
+
+def _git_head(root: Path) -> Dict[str, Any] | None:
+    """Return the checkpoint describing *root* right now (commit + dirty files).
+
+    *dirty* lists the files whose working-tree state differs from the commit
+    – modified, deleted or untracked – relative to *root*.  They are indexed
+    from the working tree, so the next run has to look at them again even if
+    git no longer reports them (e.g. after ``git checkout -- file``).
+    """
+
+    head = _git(root, "rev-parse", "--verify", "-q", "HEAD")
+    # Without rename detection both sides of an uncommitted rename are listed.
+    modified = _git(root, "diff", "--name-only", "--no-renames", "-z", "--relative", "HEAD")
+    untracked = _git(root, "ls-files", "-z", "--others", "--exclude-standard")
+    if head is None or modified is None or untracked is None:
+        return None
+
+    dirty = {os.fsdecode(raw) for raw in (modified + b"\0" + untracked).split(b"\0") if raw}
+    return {"commit": head.decode().strip(), "dirty": sorted(dirty)}
+
+
+def _git_changes(root: Path, since: str) -> tuple[set[str], Dict[str, str]] | None:
+    """Return ``(changed paths, {new path: old path})`` between *since* and HEAD.
+
+    Paths are relative to *root* and limited to it; renamed files appear in
+    both the change set (old and new path) and the rename mapping.  Returns
+    *None* when the commit is unknown (e.g. garbage collected after a rebase).
+    """
+
+    if _git(root, "cat-file", "-e", f"{since}^{{commit}}") is None:
+        return None
+
+    out = _git(root, "diff", "--name-status", "-z", "-M", "--relative", since, "HEAD")
+    if out is None:
+        return None
+
+    changed: set[str] = set()
+    renames: Dict[str, str] = {}
+    fields = iter(os.fsdecode(raw) for raw in out.split(b"\0") if raw)
+
+    for status in fields:
+        if status[0] in "RC":
+            old, new = next(fields), next(fields)
+            changed.add(new)
+            if status[0] == "R":
+                changed.add(old)
+                renames[new] = old
+        else:
+            changed.add(next(fields))
+
+    return changed, renames
+
+
+def _index_fingerprint() -> str:
+    """Digest of every setting that decides *what* ends up in the index.
+
+    A checkpoint written under different settings cannot be trusted – files
+    that were skipped or chunked differently would never be revisited.
+    """
+
+    settings = [
+        _get_embedding_backend_id(),
+        INDEX_SCHEMA_VERSION,
+        CHUNK_SIZE,
+        CHUNK_OVERLAP,
+        MAX_FILE_SIZE,
+        PROJECTION_KIND,
+        PROJECTION_DIM,
+        sorted(EXCLUDE_DIRS),
+        _classifier(),
+        [str(root) for root in _ws().roots],
+    ]
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+def _git_heads() -> Dict[str, Dict[str, Any]]:
+    """Return `_git_head` of every root of the workspace that is a git repository."""
+
+    heads: Dict[str, Dict[str, Any]] = {}
+    if INCREMENTAL_MODE != "off" and ENUMERATION_MODE != "walk":
+        for root in _ws().roots:
+            head = _git_head(root)
+            if head is not None:
+                heads[str(root)] = head
+
+    return heads
+
+
+def _incremental_files(
+    heads: Dict[str, Dict[str, Any]], skipped: Dict[tuple[str, str], tuple[str, int | None]]
+) -> tuple[List[Path], List[tuple[str, str]], Dict[tuple[str, str], tuple[str, str]]] | None:
+    """Return ``(files, removed, renames)`` for a diff-only run.
+
+    *heads* maps every root to its current `_git_head`.  Returns *None* when
+    any root lacks a checkpoint that is still valid – the caller then falls
+    back to a full scan.  *removed* and the rename mapping (new → old) use
+    the ``(root, path)`` keys stored in the index, so a change in one root
+    never touches a file of another root that shares its relative path.
+    """
+
+    if INCREMENTAL_MODE == "off" or ENUMERATION_MODE == "walk" or len(heads) != len(_ws().roots):
+        return None
+
+    state = _get_shared_state()
+    fingerprint = _index_fingerprint()
+    generation = state.generation("index")
+
+    files: List[Path] = []
+    removed: List[tuple[str, str]] = []
+    renames: Dict[tuple[str, str], tuple[str, str]] = {}
+
+    def _key(fp: Path) -> tuple[str, str]:
+        return _root_key(fp, _relative_to_roots(fp))
+
+    for root in _ws().roots:
+        checkpoint = state.read_checkpoint(str(root))
+        if (
+            checkpoint is None
+            or checkpoint.get("fingerprint") != fingerprint
+            # Anything else that wrote to the collection in the meantime
+            # (e.g. a snapshot import) has bumped the generation.
+            or checkpoint.get("generation") != generation
+        ):
+            return None
+
+        changes = _git_changes(root, checkpoint["commit"])
+        if changes is None:
+            return None
+
+        changed, root_renames = changes
+        changed.update(checkpoint.get("dirty", ()))
+        changed.update(heads[str(root)]["dirty"])
+
+        for rel in sorted(changed):
+            fp = root / rel
+            try:
+                st = fp.lstat()
+                exists = fp.is_file() and not fp.is_symlink()
+            except OSError:
+                exists = False
+
+            if exists and _accept_candidate(root, fp, st.st_size, skipped):
+                files.append(fp)
+            elif _key(fp) not in skipped:
+                removed.append(_key(fp))
+
+        for new, old in root_renames.items():
+            renames[_key(root / new)] = _key(root / old)
+
+    return files, removed, renames
+
+
+def _write_checkpoints(heads: Dict[str, Dict[str, Any]], generation: int) -> None:
+    """Record the commit every root was indexed at after a successful run."""
+
+    state = _get_shared_state()
+    fingerprint = _index_fingerprint()
+
+    for root, head in heads.items():
+        state.write_checkpoint(root, {**head, "fingerprint": fingerprint, "generation": generation})
+
+
+def _estimate_chunks(length: int) -> int:
+    """Return the number of chunks a text of *length* characters yields.
+
+    Exact for character lengths given the deterministic chunking parameters
+    (size & overlap); callers may pass a byte size as a cheap approximation.
+    """
+
+    step = CHUNK_SIZE - CHUNK_OVERLAP
+    return (length + step - 1) // step if length else 0
+
+
+def _iter_text_segments(fh, first_segment: bytes, hasher) -> Iterator[str]:
+    """Yield decoded text segments of *fh*, starting with *first_segment*.
+
+    Bytes are fed into *hasher* as they are read; the handle is closed once
+    the file is exhausted (or the generator is discarded).
+    """
+
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+
+    with fh:
+        segment = first_segment
+        while segment:
+            hasher.update(segment)
+            yield decoder.decode(segment)
+            segment = fh.read(SEGMENT_BYTES)
+
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def _iter_chunks(segments: Iterable[str]) -> Iterator[tuple[str, int, int]]:
+    """Yield ``(chunk, start_line, end_line)`` for text split into *segments*.
+
+    Produces exactly the chunks `_chunk_text` would for the concatenated
+    text, but only ever holds the current segment plus one chunk of carry-over
+    so arbitrarily large files can be processed in bounded memory.
+    """
+
+    step = CHUNK_SIZE - CHUNK_OVERLAP
+    buf = ""
+    pos = 0
+
+    # 1-based line number of *pos*, advanced incrementally so every
+    # character is scanned for newlines only about once.
+    line = 1
+
+    for segment in segments:
+        buf = buf[pos:] + segment if pos else buf + segment
+        pos = 0
+
+        while len(buf) - pos >= CHUNK_SIZE:
+            chunk = buf[pos : pos + CHUNK_SIZE]
+            yield chunk, line, line + chunk.count("\n")
+            line += buf.count("\n", pos, pos + step)
+            pos += step
+
+    while pos < len(buf):
+        chunk = buf[pos : pos + CHUNK_SIZE]
+        yield chunk, line, line + chunk.count("\n")
+        line += buf.count("\n", pos, pos + step)
+        pos += step
+
+
+def _chunk_text(text: str) -> List[str]:
+    """Split *text* into overlapping character chunks and return the list.
+
+    A debug log with the resulting chunk count helps to correlate later
+    embedding/upsert calls with the original input size.
+    """
+
+    chunks: List[str] = []
+    start = 0
+    total = len(text)
+    while start < total:
+        end = min(start + CHUNK_SIZE, total)
+        chunks.append(text[start:end])
+        start = end - CHUNK_OVERLAP  # keep overlap for context
+        if start < 0:
+            start = 0
+    logger.debug("Chunked document into %d pieces", len(chunks))
+    return chunks
+
+
+def _embed_texts(texts: List[str], backend: str | None = None) -> "np.ndarray | None":
+    """Return embedding vectors for *texts* as a ``(len(texts), dim)`` array.
+
+    *backend* selects another backend than the configured one by identity
+    (ValueError when it is unavailable).
+
+    The helper transparently splits larger inputs into **smaller batches** so
+    the peak memory usage stays low even for very large files.  Splitting is
+    especially important when using high-dimensional models such as
+    *text-embedding-3-small* where a single vector already contains >1500
+    floats.
+
+    Vectors are written straight into one contiguous *float32* array instead
+    of a list of lists of boxed Python floats – about 6 kB instead of ~50 kB
+    per 1536-dimensional vector.  Conversion to whatever the Chroma client
+    needs happens only at the client boundary.
+    """
+
+    import numpy as np
+
+    embedding_fn = _get_embedding_function() if backend is None else _get_embedding_backend(backend)
+
+    logger.debug(
+        "Embedding %d chunks using %s (batch size=%d)",
+        len(texts),
+        "callable wrapper" if callable(embedding_fn) else type(embedding_fn),
+        BATCH_SIZE,
+    )
+
+    # Allocated once the first batch reveals the dimensionality.
+    all_vectors: "np.ndarray | None" = None
+    t0 = time.perf_counter()
+
+    # Process the incoming list in reasonably sized windows so we never hold
+    # on to more data than necessary.
+    for ofs in range(0, len(texts), BATCH_SIZE):
+        batch = texts[ofs : ofs + BATCH_SIZE]
+
+        try:
+            # Optimistically try the batched form first …
+            vectors = np.asarray(embedding_fn(batch), dtype=np.float32)  # type: ignore[arg-type]
+
+            # … but detect helpers that incorrectly return a *single* vector
+            # instead of a list.
+            if vectors.ndim != 2 or len(vectors) != len(batch):
+                raise TypeError
+        except Exception:
+            # Fallback – call per chunk.
+            vectors = np.stack(
+                [np.asarray(embedding_fn(t), dtype=np.float32) for t in batch]  # type: ignore[arg-type]
+            )
+
+        if all_vectors is None:
+            all_vectors = np.empty((len(texts), vectors.shape[1]), dtype=np.float32)
+
+        all_vectors[ofs : ofs + len(batch)] = vectors
+
+    duration = time.perf_counter() - t0
+
+    if logger.isEnabledFor(logging.DEBUG) and all_vectors is not None:
+        logger.debug(
+            "Embedding completed in %.2fs (total %d vectors) – first vector preview: %s…",
+            duration,
+            len(all_vectors),
+            all_vectors[0][:5],
+        )
+
+    return all_vectors
+
+
+# ---------------------------------------------------------------------------
+# Optional dimensionality reduction of stored vectors
+# ---------------------------------------------------------------------------
+
+# "random" (Gaussian random projection) or "pca" (fitted on a sample of the
+# index) reduce every embedding to *PROJECTION_DIM* components before it is
+# stored or used as a query.  Smaller vectors make the store and every
+# distance computation cheaper at some recall cost – GET /index/projection/eval
+# measures that tradeoff.  "none" stores the backend's vectors unchanged.
+PROJECTION_KIND = os.getenv("CODEX_INDEX_PROJECTION", "none").lower()
+PROJECTION_DIM = int(os.getenv("CODEX_INDEX_PROJECTION_DIM", "256"))
+PROJECTION_SEED = 0x5EED
+
+# Number of chunk vectors the PCA basis is fitted on.
+PCA_SAMPLE_SIZE = int(os.getenv("CODEX_INDEX_PCA_SAMPLE", "2000"))
+
+
+class Projection:
+    """Linear map ``(x - mean) @ matrix`` applied to embeddings.
+
+    *identity* is recorded in the collection metadata; vectors written under
+    one projection are meaningless under any other.
+    """
+
+    def __init__(self, kind: str, matrix, mean=None, identity: str | None = None):
+        self.kind = kind
+        self.matrix = matrix
+        self.mean = mean
+        self.source_dim, self.dim = matrix.shape
+
+        if identity is None:
+            digest = hashlib.sha1(matrix.tobytes())
+            if mean is not None:
+                digest.update(mean.tobytes())
+            identity = f"{kind}:{self.source_dim}x{self.dim}:{digest.hexdigest()[:12]}"
+        self.identity = identity
+
+    @classmethod
+    def random(cls, source_dim: int, dim: int, seed: int = PROJECTION_SEED) -> "Projection":
+        """Gaussian random projection – reproducible from its identity alone."""
+
+        import numpy as np
+
+        rng = np.random.default_rng(seed)
+        matrix = (rng.standard_normal((source_dim, dim)) / np.sqrt(dim)).astype(np.float32)
+        return cls("random", matrix, identity=f"random:{source_dim}x{dim}:s{seed}")
+
+    @classmethod
+    def fit_pca(cls, sample, dim: int) -> "Projection":
+        """Project onto the top *dim* principal components of *sample*."""
+
+        import numpy as np
+
+        sample = np.asarray(sample, dtype=np.float64)
+        mean = sample.mean(axis=0)
+        _, _, vt = np.linalg.svd(sample - mean, full_matrices=False)
+        return cls("pca", vt[:dim].T.astype(np.float32), mean.astype(np.float32))
+
+    def apply(self, vectors):
+        import numpy as np
+
+        if self.mean is not None:
+            vectors = vectors - self.mean
+        return np.ascontiguousarray(vectors @ self.matrix, dtype=np.float32)
+
+    def save(self, path: Path) -> None:
+        import numpy as np
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        arrays = {"matrix": self.matrix, "identity": self.identity}
+        if self.mean is not None:
+            arrays["mean"] = self.mean
+        with open(tmp, "wb") as fh:
+            np.savez(fh, **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "Projection":
+        import numpy as np
+
+        with np.load(path, allow_pickle=False) as data:
+            identity = str(data["identity"])
+            mean = data["mean"] if "mean" in data.files else None
+            return cls(identity.split(":")[0], data["matrix"], mean, identity)
+
+
+_projections: Dict[str, Projection] = {}
+_embedding_dim: int | None = None
+
+
+def _get_embedding_dim() -> int:
+    """Dimensionality of the embedding backend's vectors (probed once)."""
+
+    global _embedding_dim
+
+    if _embedding_dim is None:
+        _embedding_dim = int(_embed_texts(["dimension probe"]).shape[1])
+
+    return _embedding_dim
+
+
+def _projection_path(identity: str) -> Path:
+    return STATE_DIR / f"{_ws().collection_name}.{identity.replace(':', '-')}.npz"
+
+
+def _collection_projection_id(col) -> str:
+    """Projection recorded on *col* – collections predating it store raw vectors."""
+
+    return (getattr(col, "metadata", None) or {}).get("projection", "none")
+
+
+def _projection_for(identity: str) -> Projection | None:
+    """Return the projection named *identity* (ValueError when unavailable)."""
+
+    if identity == "none":
+        return None
+
+    if identity not in _projections:
+        try:
+            kind, shape, tag = identity.split(":")
+            if kind == "random":
+                source_dim, dim = (int(n) for n in shape.split("x"))
+                projection = Projection.random(source_dim, dim, int(tag[1:]))
+            else:
+                projection = Projection.load(_projection_path(identity))
+        except Exception as exc:
+            raise ValueError(f"Projection {identity!r} is not available: {exc}") from exc
+        _projections[identity] = projection
+
+    return _projections[identity]
+
+
+def _sample_chunk_texts(limit: int, per_file: int = 4) -> List[str]:
+    """Return up to *limit* chunk texts spread evenly across the workspace."""
+
+    files = _iter_source_files(_ws().roots)
+    stride = max(1, len(files) * per_file // max(limit, 1))
+    texts: List[str] = []
+
+    for fp in files[::stride]:
+        try:
+            data = fp.read_bytes()
+        except OSError:
+            continue
+        if len(data) > MAX_FILE_SIZE or b"\0" in data[:2048]:
+            continue
+
+        for n, (chunk, _, _) in enumerate(_iter_chunks([data.decode("utf-8", errors="ignore")])):
+            if n >= per_file or len(texts) >= limit:
+                break
+            texts.append(chunk)
+
+        if len(texts) >= limit:
+            break
+
+    return texts
+
+
+def _configured_projection(col) -> Projection | None:
+    """Build the projection the configuration asks for.
+
+    PCA reuses the basis *col* was built with when the dimensions still
+    match; otherwise it is fitted on the stored raw vectors or, for an empty
+    or already projected collection, on freshly embedded workspace chunks.
+    """
+
+    import numpy as np
+
+    if PROJECTION_KIND == "none":
+        return None
+
+    source_dim = _get_embedding_dim()
+    if PROJECTION_KIND not in ("random", "pca") or not 0 < PROJECTION_DIM < source_dim:
+        logger.warning(
+            "Ignoring projection %s to %d dimensions for %d-dimensional embeddings",
+            PROJECTION_KIND,
+            PROJECTION_DIM,
+            source_dim,
+        )
+        return None
+
+    if PROJECTION_KIND == "random":
+        return Projection.random(source_dim, PROJECTION_DIM)
+
+    stored = _collection_projection_id(col)
+    if stored.startswith(f"pca:{source_dim}x{PROJECTION_DIM}:"):
+        try:
+            return _projection_for(stored)
+        except ValueError as exc:
+            logger.warning("%s – fitting a new PCA basis", exc)
+
+    sample = None
+    if stored == "none" and col.count():
+        sample = np.asarray(
+            col.get(limit=PCA_SAMPLE_SIZE, include=["embeddings"])["embeddings"], dtype=np.float32
+        )
+    if sample is None or sample.ndim != 2 or sample.shape[1] != source_dim:
+        sample = _embed_texts(_sample_chunk_texts(PCA_SAMPLE_SIZE))
+
+    if sample is None or len(sample) < PROJECTION_DIM:
+        logger.warning(
+            "Only %d sample vectors for a %d-dimensional PCA – using a random projection",
+            0 if sample is None else len(sample),
+            PROJECTION_DIM,
+        )
+        return Projection.random(source_dim, PROJECTION_DIM)
+
+    projection = Projection.fit_pca(sample, PROJECTION_DIM)
+    projection.save(_projection_path(projection.identity))
+    _projections[projection.identity] = projection
+    logger.info("Fitted %s on %d sample vectors", projection.identity, len(sample))
+    return projection
+
+
+# ---------------------------------------------------------------------------
+# Collection versions – shadow rebuilds behind an alias
+# ---------------------------------------------------------------------------
+
+# A rebuild (forced, or because the embedding backend, chunking, schema or
+# projection changed) writes into a new collection ``<collection>_v<N>`` while
+# searches keep using the live one.  Once the new version is complete and
+# verified the "live" alias in the workspace's shared state is flipped to it;
+# the old version is kept behind a ``retired:<name>`` alias and only dropped
+# once *ALIAS_GRACE_SECONDS* have passed, so searches that resolved the alias
+# just before the flip can still finish.  Every version
+# records the embedding backend it was built with, and queries are embedded
+# with that backend until the flip.  Only when it cannot be recreated in this
+# process (e.g. the OpenAI key was removed) does /search answer 409 until the
+# rebuild completes.
+ALIAS_GRACE_SECONDS = float(os.getenv("CODEX_INDEX_ALIAS_GRACE", "30"))
+
+
+def _build_id() -> str:
+    """Digest of the settings that decide which vectors a collection holds.
+
+    Files are only re-embedded when their content changes, so a collection
+    built under different settings is rebuilt as a whole instead.
+    """
+
+    settings = [
+        _get_embedding_backend_id(),
+        INDEX_SCHEMA_VERSION,
+        CHUNK_SIZE,
+        CHUNK_OVERLAP,
+        PROJECTION_KIND,
+        PROJECTION_DIM,
+    ]
+    return hashlib.sha1(json.dumps(settings).encode()).hexdigest()[:12]
+
+
+def _live_collection_name() -> str:
+    """Name of the collection searches use – the unversioned one until a rebuild."""
+
+    try:
+        live = _get_shared_state().read_alias("live")
+    except Exception as exc:  # pragma: no cover – fall back to the base name
+        logger.debug("Unable to resolve the live collection alias: %s", exc)
+        live = None
+
+    return live or _ws().collection_name
+
+
+def _collection_versions(ws: Workspace) -> List[str]:
+    """Names of every stored collection (version) of *ws*."""
+
+    names = [getattr(c, "name", c) for c in _remote_client().list_collections()]
+    return [
+        name
+        for name in names
+        if name == ws.collection_name or name.startswith(f"{ws.collection_name}_v")
+    ]
+
+
+def _drop_versions(ws: Workspace, delay: float = 0.0, keep_aliased: bool = True) -> None:
+    """Drop the collections of *ws* no alias points at, after *delay* seconds.
+
+    Versions retired less than *ALIAS_GRACE_SECONDS* ago are kept as well.
+    The aliases are read when the delay is over, so a rebuild started in
+    the meantime keeps its shadow.  *keep_aliased=False* drops everything.
+    """
+
+    if delay:
+        time.sleep(delay)
+
+    keep: set[str | None] = set()
+    try:
+        aliases = ws.state.read_aliases()
+        retired = {
+            target: retired_at
+            for name, (target, retired_at) in aliases.items()
+            if name.startswith("retired:")
+        }
+        if keep_aliased:
+            live = aliases.get("live", (ws.collection_name, 0.0))[0]
+            keep = {live, aliases.get("shadow", (None, 0.0))[0]}
+            keep.update(
+                name
+                for name, retired_at in retired.items()
+                if time.time() - retired_at < ALIAS_GRACE_SECONDS
+            )
+        versions = _collection_versions(ws)
+    except Exception as exc:
+        logger.warning("Listing the collections of %s failed – %s", ws.name, exc)
+        return
+
+    for name in versions:
+        if name in keep:
+            continue
+        try:
+            _remote_client().delete_collection(name)
+            logger.info("Dropped collection %s", name)
+        except Exception as exc:
+            logger.warning("Dropping collection %s failed – %s", name, exc)
+            continue
+        retired.pop(name, None)
+        ws.state.write_alias(f"retired:{name}", None)
+
+    # Retirements of versions that are gone already.
+    for name in retired:
+        if name not in versions:
+            ws.state.write_alias(f"retired:{name}", None)
+
+
+def _open_shadow(live, build: str, projection: Projection | None):
+    """Return the collection a rebuild writes into.
+
+    A shadow left behind by an interrupted rebuild under the same settings
+    is resumed – files it already holds completely are skipped by the usual
+    freshness check.  Otherwise a new version is created.
+    """
+
+    ws = _ws()
+    state = _get_shared_state()
+    client = _remote_client()
+    metadata = {
+        "build": build,
+        "backend": _get_embedding_backend_id(),
+        "projection": projection.identity if projection is not None else "none",
+    }
+
+    pending = state.read_alias("shadow")
+    if pending is not None and pending != live.name:
+        try:
+            col = client.get_collection(pending)
+            if all((col.metadata or {}).get(key) == value for key, value in metadata.items()):
+                logger.info("Resuming the rebuild into %s (%d chunks stored)", col.name, col.count())
+                return col
+        except Exception as exc:
+            logger.debug("Pending shadow %s is unusable – %s", pending, exc)
+
+    # Leftovers of earlier rebuilds (abandoned shadows, versions whose drop
+    # was interrupted) go before a new version is created.
+    state.write_alias("shadow", None)
+    _drop_versions(ws)
+
+    name = f"{ws.collection_name}_v{state.bump_generation('collection')}"
+    col = client.create_collection(name, metadata=metadata)
+    state.write_alias("shadow", name)
+    logger.info("Rebuilding the index into %s (live collection %s)", name, live.name)
+    return col
+
+
+def _prepare_build(live, rebuild: bool = False) -> tuple[Any, Projection | None, bool]:
+    """Return ``(collection, projection, shadow)`` for an index run.
+
+    Runs write into the live collection unless it was built under other
+    settings (or *rebuild* is set) – the run then fills a shadow collection
+    (*shadow*) that only replaces the live one once it is complete.
+    Collections predating build stamps are adopted as they are.
+    """
+
+    projection = _configured_projection(live)
+    wanted = projection.identity if projection is not None else "none"
+    build = _build_id()
+    stored_build = (live.metadata or {}).get("build")
+
+    outdated = live.count() and (
+        _collection_projection_id(live) != wanted or stored_build not in (None, build)
+    )
+    if rebuild or outdated:
+        if outdated:
+            logger.warning(
+                "Collection %s was built under other settings (build %s, projection %s) – "
+                "rebuilding it in the background",
+                live.name,
+                stored_build,
+                _collection_projection_id(live),
+            )
+        return _open_shadow(live, build, projection), projection, True
+
+    stamp = {"projection": wanted, "build": build, "backend": _get_embedding_backend_id()}
+    if any((live.metadata or {}).get(key) != value for key, value in stamp.items()):
+        live.modify(metadata={**(live.metadata or {}), **stamp})
+
+    # A shadow of an abandoned rebuild is useless once the live collection
+    # matches the configuration again.
+    state = _get_shared_state()
+    if state.read_alias("shadow") is not None:
+        state.write_alias("shadow", None)
+        _drop_versions(_ws())
+
+    return live, projection, False
+
+
+def _verify_collection(col, expected: Dict[tuple[str, str], int]) -> str | None:
+    """Check that *col* holds exactly the *expected* files and chunk counts.
+
+    *expected* is keyed by ``(root, path)`` like ``_load_manifest(by_root=True)``.
+    Returns a description of the first problem found or *None*.
+    """
+
+    manifest = _load_manifest(col, by_root=True)
+
+    incomplete = [
+        path
+        for path, n_chunks in expected.items()
+        if manifest.get(path, {}).get("n_chunks") != n_chunks
+        or manifest[path].get("schema") != INDEX_SCHEMA_VERSION
+    ]
+    if incomplete:
+        return f"{len(incomplete)} files incomplete (e.g. {incomplete[0][1]})"
+
+    unexpected = [path for path in manifest if path not in expected]
+    if unexpected:
+        return f"{len(unexpected)} unexpected files (e.g. {unexpected[0][1]})"
+
+    count = col.count()
+    if count != sum(expected.values()):
+        return f"{count} chunks stored, {sum(expected.values())} expected"
+
+    # Finally a stored vector has to find itself.
+    if count:
+        probe = col.get(limit=1, include=["embeddings"])
+        res = col.query(
+            query_embeddings=[probe["embeddings"][0]], n_results=1, include=["distances"]
+        )
+        if not res["distances"][0] or res["distances"][0][0] > 1e-3:
+            return "stored vectors cannot be queried"
+
+    return None
+
+
+def _promote_shadow(shadow, live) -> None:
+    """Atomically make *shadow* the live collection and drop *live* later."""
+
+    ws = _ws()
+    state = _get_shared_state()
+
+    # The unversioned collection is live while no alias exists.
+    expected = None if live.name == ws.collection_name else live.name
+    if not state.swap_alias("live", expected, shadow.name):
+        raise RuntimeError("The live collection alias changed during the rebuild")
+    state.write_alias("shadow", None)
+    # Searches that resolved the alias just before the flip may still use it.
+    state.write_alias(f"retired:{live.name}", live.name)
+
+    logger.info("Switched searches from %s to %s", live.name, shadow.name)
+    _start_thread(_drop_versions, ws, ALIAS_GRACE_SECONDS, name=f"collection-gc-{ws.id}")
+
+
+# Built-in queries for the projection evaluation – typical code-search
+# questions, complemented by held-out workspace chunks.
+EVAL_QUERIES = (
+    "where is the HTTP client configured",
+    "refresh an expired authentication token",
+    "parse command line arguments",
+    "database connection settings",
+    "unit tests for the API endpoints",
+    "render a list of items in a component",
+    "error handling and logging",
+    "read configuration from environment variables",
+    "format dates for display",
+    "handle incoming websocket messages",
+    "validate form input",
+    "route definitions",
+    "global state management store",
+    "upload a file to the server",
+    "translations and localisation strings",
+    "build and deployment scripts",
+)
+EVAL_CORPUS_SIZE = 2_000
+EVAL_DEFAULT_DIMS = (32, 64, 128, 256, 512)
+
+
+def _knn(corpus, queries, k: int):
+    """Indices of the *k* nearest (L2) corpus rows for every query row."""
+
+    import numpy as np
+
+    distances = (
+        (queries**2).sum(axis=1)[:, None]
+        - 2 * queries @ corpus.T
+        + (corpus**2).sum(axis=1)[None, :]
+    )
+    nearest = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    return nearest
+
+
+def _evaluate_projections(dims: List[int], k: int) -> Dict[str, Any]:
+    """Recall@k of every projection kind and dimension against exact search."""
+
+    import numpy as np
+
+    texts = _sample_chunk_texts(EVAL_CORPUS_SIZE)
+    held_out = texts[::10]
+    corpus = _embed_texts([t for i, t in enumerate(texts) if i % 10])
+    queries = _embed_texts(list(EVAL_QUERIES) + held_out)
+
+    if corpus is None or queries is None or len(corpus) <= k:
+        raise ValueError("Not enough workspace chunks for an evaluation")
+
+    source_dim = corpus.shape[1]
+    truth = _knn(corpus, queries, k)
+    results: List[Dict[str, Any]] = []
+
+    for dim in sorted(d for d in dims if 0 < d < source_dim):
+        candidates = [Projection.random(source_dim, dim)]
+        if dim <= len(corpus):
+            candidates.append(Projection.fit_pca(corpus, dim))
+
+        for projection in candidates:
+            t0 = time.perf_counter()
+            found = _knn(projection.apply(corpus), projection.apply(queries), k)
+            elapsed_ms = (time.perf_counter() - t0) * 1000
+
+            hits = sum(len(np.intersect1d(a, b)) for a, b in zip(found, truth))
+            results.append(
+                {
+                    "kind": projection.kind,
+                    "dim": dim,
+                    "recall": round(hits / (k * len(truth)), 4),
+                    "bytes_per_vector": dim * 4,
+                    "search_ms": round(elapsed_ms, 2),
+                }
+            )
+
+    return {
+        "backend": _get_embedding_backend_id(),
+        "source_dim": source_dim,
+        "corpus": len(corpus),
+        "queries": len(queries),
+        "k": k,
+        "configured": {"kind": PROJECTION_KIND, "dim": PROJECTION_DIM},
+        "results": results,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Search QoS – interactive searches take priority over indexer traffic
+# ---------------------------------------------------------------------------
+
+# The indexer and /search share the embedding backend and the Chroma server.
+# While searches were seen within the last *QOS_WINDOW* seconds the indexer
+# may only use *INDEXER_MAX_SHARE* of the wall time for embedding and store
+# writes; the share shrinks further while the search p99 exceeds
+# *SEARCH_LATENCY_TARGET_MS*.  Without recent searches it runs unthrottled.
+SEARCH_LATENCY_TARGET_MS = float(os.getenv("CODEX_SEARCH_LATENCY_TARGET", "150"))
+INDEXER_MAX_SHARE = min(max(float(os.getenv("CODEX_INDEXER_MAX_SHARE", "0.5")), 0.05), 1.0)
+QOS_WINDOW = float(os.getenv("CODEX_QOS_WINDOW", "10"))
+
+# Lower bound for the indexer share so a run always makes progress, and the
+# longest the indexer waits for in-flight searches before proceeding.
+QOS_MIN_SHARE = 0.05
+QOS_MAX_WAIT = 2.0
+
+
+class SearchQoS:
+    """Track search latency and pace the indexer accordingly.
+
+    Searches served by other worker processes are accounted for through the
+    shared state: every worker publishes its recent p99 (rate limited) and
+    the indexing worker merges them with its own observations.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._in_flight = 0
+        self._latencies: deque[tuple[float, float]] = deque(maxlen=512)
+        self._last_publish = 0.0
+        self._shared: Dict[str, Any] | None = None
+        self._shared_read = 0.0
+        # Pause each indexer thread owes for its last throttled operation.
+        self._owed = threading.local()
+
+    @contextmanager
+    def track(self):
+        """Context manager wrapped around every /search request."""
+
+        with self._lock:
+            self._in_flight += 1
+
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            latency_ms = (time.perf_counter() - t0) * 1000
+            with self._idle:
+                self._in_flight -= 1
+                self._latencies.append((time.time(), latency_ms))
+                if not self._in_flight:
+                    self._idle.notify_all()
+            self._publish()
+
+    def _local(self) -> tuple[float | None, float | None]:
+        """Return ``(p99_ms, last_search_at)`` of searches within the window."""
+
+        cutoff = time.time() - QOS_WINDOW
+        with self._lock:
+            recent = sorted(ms for at, ms in self._latencies if at >= cutoff)
+            last = self._latencies[-1][0] if self._latencies else None
+
+        if not recent:
+            return None, last
+        return recent[min(len(recent) - 1, int(len(recent) * 0.99))], last
+
+    def _publish(self) -> None:
+        now = time.monotonic()
+        if now - self._last_publish < PROGRESS_PUBLISH_INTERVAL:
+            return
+        self._last_publish = now
+
+        p99, last = self._local()
+        try:
+            _service_state().write_metric(
+                f"search:{WORKER_ID}", {"p99_ms": p99, "last_search_at": last}
+            )
+        except Exception as exc:  # pragma: no cover – QoS is best-effort
+            logger.debug("Failed to publish search latency: %s", exc)
+
+    def _read_shared(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        if self._shared is None or now - self._shared_read >= PROGRESS_PUBLISH_INTERVAL:
+            self._shared_read = now
+            try:
+                self._shared = _service_state().read_metrics("search:")
+            except Exception as exc:  # pragma: no cover – QoS is best-effort
+                logger.debug("Failed to read shared search latency: %s", exc)
+                self._shared = {}
+
+        return self._shared
+
+    def status(self) -> Dict[str, Any]:
+        """Search p99 and indexer share as seen by this worker."""
+
+        p99, last = self._local()
+        cutoff = time.time() - QOS_WINDOW
+
+        for key, entry in self._read_shared().items():
+            if key == f"search:{WORKER_ID}" or (entry.get("last_search_at") or 0) < cutoff:
+                continue
+            last = max(last or 0, entry["last_search_at"])
+            if entry.get("p99_ms") is not None:
+                p99 = max(p99 or 0, entry["p99_ms"])
+
+        share = 1.0
+        if last is not None and last >= cutoff:
+            share = INDEXER_MAX_SHARE
+            if p99 is not None and p99 > SEARCH_LATENCY_TARGET_MS:
+                share *= SEARCH_LATENCY_TARGET_MS / p99
+            share = max(share, QOS_MIN_SHARE)
+
+        with self._lock:
+            in_flight = self._in_flight
+
+        return {
+            "in_flight": in_flight,
+            "p99_ms": p99,
+            "target_ms": SEARCH_LATENCY_TARGET_MS,
+            "indexer_share": share,
+        }
+
+    def batch_size(self, default: int) -> int:
+        """Scale a store write batch by the indexer share – smaller writes
+        hold the Chroma server for shorter stretches."""
+
+        return max(16, int(default * self.status()["indexer_share"]))
+
+    @staticmethod
+    def pause_for(elapsed: float, share: float) -> float:
+        """Pause after an operation of *elapsed* seconds so it makes up *share* of the time."""
+
+        return elapsed * (1 - share) / share if share < 1.0 else 0.0
+
+    def pace(self) -> None:
+        """Sleep off the pause the calling thread owes for its last operation.
+
+        Called before queueing for a scheduler slot, so the pause never holds
+        capacity that other workspaces could use.
+        """
+
+        pause = getattr(self._owed, "seconds", 0.0)
+        self._owed.seconds = 0.0
+        if pause > 0:
+            time.sleep(pause)
+
+    @contextmanager
+    def throttled(self):
+        """Context manager wrapped around indexer embed and write calls.
+
+        Pays the pause still owed (see `pace`) and waits for searches of this
+        process to finish first.  The pause that keeps the operation's
+        duration within the current indexer share of the elapsed time is
+        only recorded – the next `pace` or throttled operation of the thread
+        sleeps it off.
+        """
+
+        self.pace()
+
+        deadline = time.monotonic() + QOS_MAX_WAIT
+        with self._idle:
+            while self._in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._idle.wait(remaining)
+
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            share = self.status()["indexer_share"]
+            self._owed.seconds = self.pause_for(time.perf_counter() - t0, share)
+
+
+_search_qos = SearchQoS()
+
+
+# ---------------------------------------------------------------------------
+# Index scheduler – fair share of capacity across workspaces
+# ---------------------------------------------------------------------------
+
+# At most *INDEX_MAX_RUNS* index runs (over all workspaces) execute at once;
+# further runs queue in arrival order.  Embedding calls of concurrent runs
+# share *EMBED_CONCURRENCY* slots: every run queues for a slot once per batch,
+# so busy workspaces take turns instead of the largest one starving the rest.
+INDEX_MAX_RUNS = max(1, int(os.getenv("CODEX_INDEX_MAX_RUNS", "2")))
+EMBED_CONCURRENCY = max(1, int(os.getenv("CODEX_EMBED_CONCURRENCY", "1")))
+
+
+class FairScheduler:
+    """Pool of slots granted strictly first come, first served.
+
+    Each indexing run waits for at most one slot at a time, so FIFO order
+    amounts to round-robin between the workspaces competing for capacity.
+    """
+
+    def __init__(self, slots: int):
+        self._cond = threading.Condition()
+        self._free = slots
+        self._queue: deque[object] = deque()
+        self.busy_seconds: Dict[str, float] = {}
+
+    @contextmanager
+    def slot(self, owner: str):
+        ticket = object()
+        with self._cond:
+            self._queue.append(ticket)
+            while self._free == 0 or self._queue[0] is not ticket:
+                self._cond.wait()
+            self._queue.popleft()
+            self._free -= 1
+            # The next ticket may be served right away if slots are left.
+            self._cond.notify_all()
+
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._free += 1
+                self.busy_seconds[owner] = (
+                    self.busy_seconds.get(owner, 0.0) + time.perf_counter() - t0
+                )
+                self._cond.notify_all()
+
+    def waiting(self) -> int:
+        with self._cond:
+            return len(self._queue)
+
+
+_run_scheduler = FairScheduler(INDEX_MAX_RUNS)
+_embed_scheduler = FairScheduler(EMBED_CONCURRENCY)
+
+
+# Store writes are coalesced across files: upserts are flushed once this many
+# chunks are pending (or the oldest pending write is *WRITE_FLUSH_INTERVAL*
+# seconds old) so the number of round trips scales with data volume rather
+# than with the number of – mostly small – files.
+WRITE_BATCH_SIZE = int(os.getenv("CODEX_INDEX_WRITE_BATCH", "256"))
+WRITE_FLUSH_INTERVAL = float(os.getenv("CODEX_INDEX_WRITE_INTERVAL", "2"))
+
+
+class WriteCoalescer:
+    """Accumulate deletes, upserts and metadata updates for the store.
+
+    A flush issues at most one call per operation kind, always in the order
+    deletes → upserts → updates.  Operations on a file therefore take effect
+    in the order they were queued as long as a delete never overlaps a
+    pending write; when it would, the pending writes are flushed first.
+    Files are identified by their ``(root, path)`` key.
+    """
+
+    def __init__(self, col):
+        self.col = col
+        self._add_or_upsert = getattr(col, "upsert", None) or getattr(col, "add")
+        # Bytes reserved with the memory governor for the pending chunks.
+        self._reserved = 0
+        self._reset()
+
+    def _reset(self) -> None:
+        _memory_governor.release(self._reserved)
+        self._reserved = 0
+        self._delete_ids: List[str] = []
+        self._delete_paths: List[tuple[str, str]] = []
+        self._ids: List[str] = []
+        self._documents: List[str] = []
+        self._metadatas: List[Dict[str, Any]] = []
+        self._embeddings: List[Any] = []
+        self._update_ids: List[str] = []
+        self._update_metadatas: List[Dict[str, Any]] = []
+        self._pending_paths: set[tuple[str, str]] = set()
+        self._pending_ids: set[str] = set()
+        self._first_queued: float | None = None
+
+    def _queued(self, key: tuple[str, str]) -> None:
+        self._pending_paths.add(key)
+        if self._first_queued is None:
+            self._first_queued = time.monotonic()
+
+    def delete_paths(self, keys: List[tuple[str, str]]) -> None:
+        if self._pending_paths.intersection(keys):
+            self.flush()
+        self._delete_paths.extend(keys)
+        for key in keys:
+            self._queued(key)
+
+    def delete_ids(self, key: tuple[str, str], ids: List[str]) -> None:
+        if self._pending_ids.intersection(ids):
+            self.flush()
+        self._delete_ids.extend(ids)
+        self._queued(key)
+
+    def upsert(self, key, ids, documents, metadatas, embeddings) -> None:
+        """Queue chunks of the file *key*; the lists are copied, callers may reuse them."""
+
+        footprint = len(ids) * _memory_governor.chunk_footprint
+        _memory_governor.reserve(footprint)
+        self._reserved += footprint
+
+        self._ids.extend(ids)
+        self._documents.extend(documents)
+        self._metadatas.extend(metadatas)
+        self._embeddings.append(embeddings)
+        self._pending_ids.update(ids)
+        self._queued(key)
+        self._maybe_flush()
+
+    def update(self, key: tuple[str, str], ids: List[str], metadatas: List[Dict[str, Any]]) -> None:
+        self._update_ids.extend(ids)
+        self._update_metadatas.extend(metadatas)
+        self._queued(key)
+        self._maybe_flush()
+
+    def _maybe_flush(self) -> None:
+        # Respect the memory budget – pending chunks hold their vectors.
+        limit = _memory_governor.batch_size(_search_qos.batch_size(WRITE_BATCH_SIZE))
+        pending = len(self._ids) + len(self._update_ids)
+
+        if pending >= limit or (
+            self._first_queued is not None
+            and time.monotonic() - self._first_queued >= WRITE_FLUSH_INTERVAL
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        """Persist all pending operations."""
+
+        if self._first_queued is None:
+            return
+
+        import numpy as np
+
+        t0 = time.perf_counter()
+
+        with _search_qos.throttled():
+            if self._delete_ids:
+                self.col.delete(ids=self._delete_ids)
+
+            for ofs in range(0, len(self._delete_paths), 1_000):
+                self.col.delete(where=_paths_where(self._delete_paths[ofs : ofs + 1_000]))
+
+            if self._ids:
+                self._add_or_upsert(
+                    ids=self._ids,
+                    documents=self._documents,
+                    metadatas=self._metadatas,
+                    embeddings=np.concatenate(self._embeddings),
+                )
+
+            if self._update_ids:
+                self.col.update(ids=self._update_ids, metadatas=self._update_metadatas)
+
+        logger.debug(
+            "Flushed %d upserts, %d updates and %d deletes for %d files in %.2fs",
+            len(self._ids),
+            len(self._update_ids),
+            len(self._delete_ids) + len(self._delete_paths),
+            len(self._pending_paths),
+            time.perf_counter() - t0,
+        )
+
+        ws = _ws()
+        with ws.progress_lock:
+            ws.progress.processed_chunks += len(self._ids)
+
+        self._reset()
+
+    def discard(self) -> None:
+        """Drop the pending operations of a failed run and their memory reservation."""
+
+        self._reset()
+
+
+def _move_file(col, writer: WriteCoalescer, old: tuple[str, str], fp: Path, mtime: int) -> int:
+    """Re-key the stored chunks of the ``(root, path)`` *old* to the renamed file *fp*.
+
+    Documents and vectors are copied as they are – only IDs and the path
+    derived metadata change – so a rename never re-embeds anything.  Returns
+    the number of chunks moved.
+    """
+
+    import numpy as np
+
+    page = col.get(where=_paths_where([old]), include=["embeddings", "documents", "metadatas"])
+    if not page.get("ids"):
+        return 0
+
+    rel_path = _relative_to_roots(fp)
+    file_metadata = _path_metadata(fp, rel_path)
+    ids: List[str] = []
+    metadatas: List[Dict[str, Any]] = []
+
+    for meta in page["metadatas"]:
+        kept = {
+            key: value
+            for key, value in meta.items()
+            if key not in ("path", "ext", "root") and not key.startswith("dir_")
+        }
+        metadatas.append({**kept, **file_metadata, "mtime": mtime})
+        ids.append(f"{fp}:{meta['chunk_index']}")
+
+    writer.delete_paths([old])
+    writer.upsert(
+        _root_key(fp, rel_path),
+        ids,
+        page["documents"],
+        metadatas,
+        np.asarray(page["embeddings"], dtype=np.float32),
+    )
+    return len(ids)
+
+
+def _run_indexing(full: bool = False, rebuild: bool = False):
+    """The heavy-lifting background task that performs a (re-)index run.
+
+    Unless *full* is set, roots that are git repositories are only checked
+    for the files changed since the previous run (see `_incremental_files`).
+    *rebuild* re-embeds everything into a shadow collection that replaces
+    the live one once complete (see `_prepare_build`).
+    """
+
+    ws = _ws()
+
+    logger.info(
+        "Starting index run for workspace %s … (roots=%s, exclude=%s)",
+        ws.name,
+        ", ".join(str(p) for p in ws.roots),
+        sorted(EXCLUDE_DIRS),
+    )
+
+    _t0 = time.perf_counter()
+
+    writer: WriteCoalescer | None = None
+    # Bytes reserved with the memory governor for the file being indexed.
+    file_reserved = 0
+
+    _update_progress(
+        status="running",
+        processed_files=0,
+        processed_chunks=0,
+        embed_latency_ms=None,
+        current_file=None,
+        error=None,
+        started_at=time.time(),
+        finished_at=None,
+    )
+
+    try:
+        skipped: Dict[tuple[str, str], tuple[str, int | None]] = {}
+
+        # Commit and dirty files of every git root, captured *before* any
+        # file is read so changes made during the run are picked up next time.
+        heads = _git_heads()
+
+        incremental = None if full else _incremental_files(heads, skipped)
+
+        removed: List[tuple[str, str]] = []
+        renames: Dict[tuple[str, str], tuple[str, str]] = {}
+        if incremental is not None:
+            files, removed, renames = incremental
+        else:
+            skipped.clear()
+            files = _iter_source_files(ws.roots, skipped)
+
+        _update_progress(total_files=len(files))
+
+        logger.info(
+            "Discovered %s %s files under %s in %.2fs",
+            len(files),
+            "changed" if incremental is not None else "candidate",
+            ws.primary_root,
+            time.perf_counter() - _t0,
+        )
+
+
+        # We no longer perform a **separate** full workspace pass to precount all
+        # chunks because loading every single file into memory doubled the total
+        # memory footprint during indexing and kept the high-water RSS at the
+        # peak value even after the pass completed (Python’s allocator seldom
         # returns large arenas to the OS).  Instead we update *total_chunks*
         # **incrementally** while we are already reading and chunking the file
         # for embedding/upsert below.  This keeps the memory usage tightly
         # bound to the currently processed batch.
 
-        _update_progress(total_chunks=0)
+        _update_progress(total_chunks=0)
+
+        # ------------------------------------------------------------------
+        # Prepare *remote* Chroma collection running on the developer machine.
+        # The service now **requires** the remote instance to be reachable at
+        # http://localhost:8000 (or CHROMA_URL / CHROMADB_URL) and will raise
+        # an explicit error otherwise so that configuration problems become
+        # obvious immediately instead of silently falling back to an embedded
+        # DuckDB store.
+        # ------------------------------------------------------------------
+
+        # Remote collection helper -------------------------------------------------
+        remote_collection: "chromadb.Collection | None" = None  # type: ignore[name-defined]
+
+        # ------------------------------------------------------------------
+        # Remote Chroma helper ------------------------------------------------
+
+        endpoint = (
+            os.environ.get("CHROMA_URL")
+            or os.environ.get("CHROMADB_URL")
+            or "http://localhost:8000"
+        ).rstrip("/")
+
+        logger.debug("Attempting to connect to remote Chroma at %s", endpoint)
+
+        def _start_local_chroma_server(path: str) -> None:  # pragma: no cover – best-effort helper
+            """Attempt to spawn a local Chroma server in the background.
+
+            Mirrors the logic used by the JS helper (`explain-memory.ts`) so the Python index
+            service works when invoked standalone (e.g. via `curl`) where the CLI hasn’t already
+            spun up a Chroma instance.
+            """
+
+            # Prevent multiple invocations.
+            if getattr(_start_local_chroma_server, "_proc", None):  # type: ignore[attr-defined]
+                return
+
+            chroma_data = os.path.expanduser(path)
+            os.makedirs(chroma_data, exist_ok=True)
+
+            cmds = [
+                ["chroma", "--path", chroma_data],
+                ["python", "-m", "chromadb.cli.cli", "--path", chroma_data],
+            ]
+
+            for cmd in cmds:
+                try:
+                    proc = subprocess.Popen(
+                        cmd,
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL,
+                        start_new_session=True,
+                    )
+                    setattr(_start_local_chroma_server, "_proc", proc)  # type: ignore[attr-defined]
+                    logger.info("Spawned local Chroma server via %s", " ".join(cmd))
+                    return
+                except FileNotFoundError:
+                    continue  # try next variant
+                except Exception as exc:
+                    logger.warning("Failed to spawn Chroma using %s – %s", cmd, exc)
+
+            logger.warning("Unable to spawn a local Chroma server – binary not found")
+
+        def _get_remote_collection() -> "chromadb.Collection | None":  # type: ignore[name-defined]
+            """Try to connect to the configured Chroma endpoint and create the index collection."""
+
+            try:
+                client_remote = _remote_client()
+
+                name = _live_collection_name()
+
+                logger.debug("Requesting collection %s from %s …", name, endpoint)
+
+                col = client_remote.get_or_create_collection(name)
+
+                logger.debug(
+                    "Remote Chroma collection '%s' ready at %s – currently %s items",
+                    col.name,  # type: ignore[attr-defined]
+                    endpoint,
+                    col.count() if hasattr(col, "count") else "?",
+                )
+
+                return col
+            except Exception as exc:
+                logger.debug("Remote Chroma connection attempt failed: %s", exc)
+                return None
+
+        # Try once to connect to the remote Chroma instance.
+        remote_collection = _get_remote_collection()
+
+        if remote_collection is None:
+            raise RuntimeError(
+                f"Unable to connect to the remote Chroma server at {endpoint}. "
+                "Please make sure it is running (e.g. via `chroma --path <data-dir>`) "
+                "before starting the index service."
+            )
+
+        # Vectors are stored under the configured settings; a collection
+        # built under other ones is rebuilt into a shadow by a full scan
+        # while searches keep using it.
+        live_collection = remote_collection
+        remote_collection, projection, shadow = _prepare_build(live_collection, rebuild)
+        # An empty live collection (new, or dropped since the last run)
+        # only gets complete when every file is visited.
+        if (shadow or not live_collection.count()) and incremental is not None:
+            incremental, removed, renames = None, [], {}
+            skipped.clear()
+            files = _iter_source_files(ws.roots, skipped)
+            _update_progress(total_files=len(files))
+
+        # Freshness metadata of every stored file by (root, path), fetched in
+        # one paginated pass.  *None* when the lookup failed – every file is
+        # then treated as unknown and re-indexed, which is slow but always
+        # correct.  Incremental runs only look up the changed files (rename
+        # sources and newly skipped files included).
+        try:
+            manifest: Dict[tuple[str, str], Dict[str, Any]] | None = _load_manifest(
+                remote_collection,
+                None
+                if incremental is None
+                else [_root_key(fp, _relative_to_roots(fp)) for fp in files]
+                + list(renames.values())
+                + list(skipped),
+                by_root=True,
+            )
+        except Exception as exc:
+            logger.warning("Loading the stored manifest failed (%s) – re-indexing all files", exc)
+            manifest = None
+
+        writer = WriteCoalescer(remote_collection)
+        try:
+            _memory_governor.vector_dim = _get_embedding_dim()
+        except Exception as exc:  # pragma: no cover – keep the previous estimate
+            logger.debug("Unable to determine the embedding dimension: %s", exc)
+
+        # Renamed files whose content is unchanged keep their chunks – only
+        # the IDs and path metadata move.  Anything else is re-indexed.
+        moved: set[tuple[str, str]] = set()
+        if renames and manifest is not None:
+            for fp in list(files):
+                key = _root_key(fp, _relative_to_roots(fp))
+                old_meta = manifest.get(renames[key]) if key in renames else None
+                if (
+                    old_meta is None
+                    or old_meta.get("schema") != INDEX_SCHEMA_VERSION
+                    or old_meta.get("n_chunks") is None
+                ):
+                    continue
+
+                try:
+                    data = fp.read_bytes()
+                    if hashlib.sha1(data).hexdigest() != old_meta.get("sha1"):
+                        continue
+                    n_moved = _move_file(
+                        remote_collection, writer, renames[key], fp, int(fp.stat().st_mtime)
+                    )
+                except Exception:
+                    logger.warning("Moving the chunks of %s failed – re-indexing", fp, exc_info=True)
+                    continue
+
+                if n_moved == old_meta["n_chunks"]:
+                    files.remove(fp)
+                    moved.add(renames[key])
+                    with ws.progress_lock:
+                        ws.progress.total_chunks += n_moved
+
+            if moved:
+                logger.info("Moved %d renamed files without re-embedding", len(moved))
+
+        # Drop chunks of files the classifier now rejects (e.g. indexed by
+        # an older version of the service) and of files that no longer exist
+        # so neither keeps showing up in /search.
+        # Only skipped files that are actually stored are deleted – most of
+        # them never were, and every delete is a server-side where scan.
+        vanished = [key for key in removed if key not in moved]
+        stale_skipped = list(skipped)
+        if manifest is not None:
+            stale_skipped = [key for key in skipped if key in manifest]
+        if manifest is not None and incremental is None:
+            present = {_root_key(fp, _relative_to_roots(fp)) for fp in files}
+            vanished = [key for key in manifest if key not in present and key not in skipped]
+        _delete_paths(remote_collection, stale_skipped + vanished)
+
+        if vanished:
+            logger.info("Removed %d files that no longer exist from the index", len(vanished))
+
+        # Chunk count of every file the collection holds after the run, by
+        # (root, path) – what a rebuilt collection is verified against.
+        stored: Dict[tuple[str, str], int] = {}
+
+        # Time spent embedding and writing changed files – recorded as the
+        # measured throughput the /index/plan estimates are based on.
+        work_seconds = 0.0
+        work_chunks = 0
+        work_bytes = 0
+
+        # Second pass -> actually store data.
+        for idx, fp in enumerate(files, 1):
+            _update_progress(current_file=str(fp), processed_files=idx)
+
+            # Calculate frequently used values **once** so they can be reused
+            # across the whole file processing pipeline.
+
+            rel_path = _relative_to_roots(fp)
+            key = _root_key(fp, rel_path)
+
+            _memory_governor.release(file_reserved)
+            file_reserved = 0
+
+            # Every file is opened and read exactly **once**: `fstat` on the
+            # open descriptor supplies size & mtime, and the binary sniff,
+            # content hash, decode and chunking below all operate on the same
+            # in-memory buffer.  Discovery no longer touches the file at all.
+            try:
+                fh = open(fp, "rb")
+            except Exception:
+                logger.warning("Failed to open %s – skipping", fp, exc_info=True)
+                continue
+
+            # Large files – or files that would not fit into the remaining
+            # memory budget – are streamed in segments instead of being
+            # loaded whole.  Their handle stays open for the segment reader
+            # which closes it once the last segment has been consumed.
+            streamed = False
+
+            try:
+                st = os.fstat(fh.fileno())
+                file_mtime = int(st.st_mtime)
+
+                if st.st_size > MAX_FILE_SIZE:
+                    logger.debug("Skipping %s – %d bytes exceed MAX_FILE_SIZE", fp, st.st_size)
+                    continue
+
+                # ------------------------------------------------------------
+                # Fast-path – skip files that are already up-to-date
+                # ------------------------------------------------------------
+
+                # We attach the file modification timestamp (*mtime*, second
+                # resolution), the content hash and the chunk count to the
+                # *first* chunk’s metadata (chunk_index == 0) so subsequent
+                # full index runs can very cheaply decide whether the on-disk
+                # version still matches the persisted representation – and
+                # account for its chunks without reading the file again.
+
+                meta0 = manifest.get(key) if manifest is not None else None
+
+                # Number of chunks currently stored for the file – 0 when
+                # there are none, *None* when unknown (manifest unavailable or
+                # the entry predates chunk counts).
+                stored_chunks: int | None = None
+                if manifest is not None:
+                    stored_chunks = meta0.get("n_chunks") if meta0 is not None else 0
+
+                if meta0 is not None and meta0.get("schema") != INDEX_SCHEMA_VERSION:
+                    meta0 = None  # written by an older layout – re-index
+
+                if meta0 is not None and meta0.get("mtime") == file_mtime:
+                    # File unchanged – update progress counters and move on.
+                    # Entries written before the chunk count was recorded
+                    # fall back to an estimate from the on-disk size.
+                    n_chunks = meta0.get("n_chunks")
+                    if n_chunks is None:
+                        n_chunks = _estimate_chunks(st.st_size)
+
+                    with ws.progress_lock:
+                        ws.progress.total_chunks += n_chunks
+                        ws.progress.processed_chunks += n_chunks
+
+                    stored[key] = n_chunks
+                    logger.debug("Skipping up-to-date file %s", fp)
+                    continue
+
+                streamed = _memory_governor.should_stream(st.st_size)
+                file_reserved = (SEGMENT_BYTES if streamed else st.st_size) * _FILE_FOOTPRINT_FACTOR
+                _memory_governor.reserve(file_reserved)
+
+                if streamed:
+                    first_segment = fh.read(SEGMENT_BYTES)
+                else:
+                    first_segment = data = fh.read()
+            except Exception:
+                logger.warning("Failed to read %s – skipping", fp, exc_info=True)
+                streamed = False
+                continue
+            finally:
+                if not streamed:
+                    fh.close()
+
+            category = (
+                "binary"
+                if b"\0" in first_segment[:2048]
+                else _classify_content(rel_path, st.st_size, first_segment)
+            )
+            if category is not None:
+                logger.debug("Skipping %s file %s", category, fp)
+                if streamed:
+                    fh.close()
+                if category != "binary":
+                    skipped[key] = (category, st.st_size)
+                    if stored_chunks != 0:
+                        writer.delete_paths([key])
+                continue
+
+            # Stored without a chunk count (an interrupted rewrite, or the
+            # manifest is unavailable): chunks beyond the new end cannot be
+            # trimmed, so the file is written from scratch.
+            if stored_chunks is None:
+                writer.delete_paths([key])
+
+            if streamed:
+                # Hash, decode and chunk incrementally; the chunk count and
+                # content hash are only known at the end of the file.
+                hasher = hashlib.sha1()
+                text_segments = _iter_text_segments(fh, first_segment, hasher)
+                n_chunks = None
+                del first_segment
+            else:
+                content_sha1 = hashlib.sha1(data).hexdigest()
+
+                if (
+                    meta0 is not None
+                    and meta0.get("sha1") == content_sha1
+                    and meta0.get("n_chunks") is not None
+                ):
+                    # Only the timestamp changed (checkout, touch, …) – refresh
+                    # the stored mtime instead of re-embedding identical content.
+                    n_chunks = meta0["n_chunks"]
+                    writer.update(
+                        key,
+                        ids=[f"{fp}:{i}" for i in range(n_chunks)],
+                        metadatas=[{"mtime": file_mtime} for _ in range(n_chunks)],
+                    )
+
+                    with ws.progress_lock:
+                        ws.progress.total_chunks += n_chunks
+                        ws.progress.processed_chunks += n_chunks
+
+                    stored[key] = n_chunks
+                    logger.debug("Content of %s unchanged – refreshed mtime only", fp)
+                    continue
+
+                text = data.decode("utf-8", errors="ignore")
+                del data, first_segment
+
+                # Pre-calculate the chunk count so the total work estimate is
+                # available early without having to materialise the whole
+                # chunk list in memory.  We derive the number directly from
+                # the character length – this is exact given the
+                # deterministic chunking parameters (size & overlap).
+                n_chunks = _estimate_chunks(len(text))
+                text_segments = [text]
+                del text
+
+            # ----------------------------------------------------------------
+            # More memory-efficient, *streaming* chunk processing
+            # ----------------------------------------------------------------
+
+            # Previously indexed chunks are overwritten in place because chunk
+            # IDs are deterministic; only surplus chunks of a file that shrank
+            # need deleting, which happens by ID once the new count is known.
+            # When the stored count is unknown fall back to a *where* delete
+            # of the whole path before uploading new chunks.
+
+            t_work = time.perf_counter()
+
+            if stored_chunks is None:
+                writer.delete_paths([key])
+
+            if n_chunks is not None:
+                with ws.progress_lock:
+                    ws.progress.total_chunks += n_chunks
+
+            # Stream through the file character data and accumulate exactly
+            # `BATCH_SIZE` chunks before we invoke the (potentially network
+            # bound) embedding & upsert calls.  This keeps the peak RSS tightly
+            # bound to the batch size no matter how large a single source file
+            # grows.
+
+            batch_chunks: List[str] = []
+            batch_ids: List[str] = []
+            batch_metadatas: List[Dict[str, Any]] = []
+
+            def _flush_batch() -> None:
+                """Helper – embed the current batch and queue it for upsert."""
+
+                if not batch_chunks:
+                    return
+
+                # The batch is reserved with the memory governor until the
+                # coalescer, which reserves its pending chunks, holds it.
+                footprint = len(batch_chunks) * _memory_governor.chunk_footprint
+                _memory_governor.reserve(footprint)
+                try:
+                    # Pause for the search QoS before queueing for the shared
+                    # embedding slot, never while holding it.  Only the embed
+                    # call itself counts as indexer work for the pacing, not
+                    # the time spent waiting behind other workspaces.
+                    _search_qos.pace()
+                    with _embed_scheduler.slot(ws.id):
+                        with _search_qos.throttled():
+                            t_embed = time.perf_counter()
+                            embeddings = _embed_texts(batch_chunks)
+                            latency_ms = (time.perf_counter() - t_embed) * 1000
+
+                        if projection is not None:
+                            embeddings = projection.apply(embeddings)
+
+                    with ws.progress_lock:
+                        previous = ws.progress.embed_latency_ms
+                        ws.progress.embed_latency_ms = (
+                            latency_ms
+                            if previous is None
+                            else previous + EWMA_ALPHA * (latency_ms - previous)
+                        )
+
+                    # Hand the batch to the write coalescer which persists it
+                    # together with the chunks of other files.
+                    writer.upsert(key, batch_ids, batch_chunks, batch_metadatas, embeddings)
+                finally:
+                    _memory_governor.release(footprint)
+
+                # Clear the batch lists *in-place* so existing allocations can
+                # be reused by the next fill cycle which avoids the small-yet
+                # noticeable fragmentation that a fresh list would introduce.
+                batch_chunks.clear()
+                batch_ids.clear()
+                batch_metadatas.clear()
+
+            # Iterate lazily over the character data -------------------------------------------------
+
+            file_metadata = _path_metadata(fp, rel_path)
+
+            chunk_index = 0
+            batch_limit = _memory_governor.batch_size(BATCH_SIZE)
+
+            for chunk_text, start_line, end_line in _iter_chunks(text_segments):
+                batch_chunks.append(chunk_text)
+                batch_ids.append(f"{fp}:{chunk_index}")
+                metadata: Dict[str, Any] = {
+                    **file_metadata,
+                    "chunk_index": chunk_index,
+                    "mtime": file_mtime,
+                    "start_line": start_line,
+                    "end_line": end_line,
+                }
+                if chunk_index == 0:
+                    # Chroma merges the metadata of upserted records, so the
+                    # previous version's stamp has to be cleared explicitly –
+                    # otherwise an interrupted rewrite looks complete.
+                    metadata.update(sha1=None, n_chunks=None, schema=None)
+                batch_metadatas.append(metadata)
+
+                chunk_index += 1
+
+                if n_chunks is None:
+                    # Streamed file – the total grows as segments arrive.
+                    with ws.progress_lock:
+                        ws.progress.total_chunks += 1
+
+                if len(batch_chunks) >= batch_limit:
+                    _flush_batch()
+                    # Re-evaluate after every flush so the batch shrinks as
+                    # soon as the process approaches its memory budget.
+                    batch_limit = _memory_governor.batch_size(BATCH_SIZE)
+
+            # Flush remaining chunks < BATCH_SIZE.
+            _flush_batch()
+
+            if streamed:
+                content_sha1 = hasher.hexdigest()
+            n_chunks = chunk_index
+
+            # Trim chunks left over from a longer previous version.
+            if stored_chunks and stored_chunks > n_chunks:
+                writer.delete_ids(key, [f"{fp}:{i}" for i in range(n_chunks, stored_chunks)])
+
+            # The hash, chunk count and schema on chunk 0 mark the file as
+            # complete for the fast path.  They are written as the file's last
+            # operation so an interrupted run never leaves a partially stored
+            # file that looks up-to-date.
+            if n_chunks:
+                stored[key] = n_chunks
+                writer.update(
+                    key,
+                    ids=[f"{fp}:0"],
+                    metadatas=[{
+                        "sha1": content_sha1,
+                        "n_chunks": n_chunks,
+                        "schema": INDEX_SCHEMA_VERSION,
+                    }],
+                )
+
+            logger.debug(
+                "Indexed %s (%d chunks, progress %d/%d files)",
+                fp,
+                n_chunks,
+                idx,
+                len(files),
+            )
+
+            work_seconds += time.perf_counter() - t_work
+            work_chunks += n_chunks
+            work_bytes += st.st_size
+
+            # Finished with the (potentially large) text buffers → drop them
+            # so the memory becomes available for the next file *immediately*
+            # and give the governor a chance to return freed memory.
+            del text_segments
+            _memory_governor.checkpoint()
+
+        t_work = time.perf_counter()
+        writer.flush()
+        work_seconds += time.perf_counter() - t_work
+
+        try:
+            _record_throughput(work_chunks, work_bytes, work_seconds)
+        except Exception as exc:  # pragma: no cover – metrics are best-effort
+            logger.debug("Failed to record indexing throughput: %s", exc)
+
+        # A rebuilt collection only goes live once it holds every file.
+        # Searches stay on the old one otherwise: a run that failed halfway
+        # is resumed by the next rebuild, one that failed verification is
+        # started over.
+        if shadow:
+            problem = _verify_collection(remote_collection, stored)
+            if problem is not None:
+                _get_shared_state().write_alias("shadow", None)
+                raise RuntimeError(
+                    f"Rebuilt collection {remote_collection.name} failed verification: {problem}"
+                )
+            _promote_shadow(remote_collection, live_collection)
+
+        generation = _get_shared_state().bump_generation("index")
+        _update_progress(status="completed", finished_at=time.time(), current_file=None)
+        logger.debug("Index generation advanced to %d", generation)
+
+        try:
+            _write_checkpoints(heads, generation)
+        except Exception as exc:  # pragma: no cover – next run is simply a full one
+            logger.warning("Failed to record the indexed commits: %s", exc)
+
+        if skipped:
+            summary = _summarise_skipped(skipped)
+            logger.info(
+                "Classifier skipped %d files (~%d chunks): %s",
+                len(skipped),
+                sum(entry["chunks"] for entry in summary.values()),
+                ", ".join(f"{cat}={entry['files']}" for cat, entry in sorted(summary.items())),
+            )
+
+        logger.info(
+            "Indexing completed successfully – %d files, %d chunks (total %.2fs, peak RSS %s)",
+            ws.progress.processed_files,
+            ws.progress.processed_chunks,
+            time.perf_counter() - _t0,
+            f"{_memory_governor.peak_rss // 1024**2} MiB" if _memory_governor.peak_rss else "n/a",
+        )
+
+    except Exception as exc:  # noqa: BLE001 – want to capture *any* failure.
+        _update_progress(status="error", error=str(exc), finished_at=time.time())
+        logger.exception("Indexing run failed with an unexpected error")
+    finally:
+        # Reservations left by a failed run would shrink every later batch.
+        _memory_governor.release(file_reserved)
+        if writer is not None:
+            writer.discard()
 
-        # ------------------------------------------------------------------
-        # Prepare *remote* Chroma collection running on the developer machine.
-        # The service now **requires** the remote instance to be reachable at
-        # http://localhost:8000 (or CHROMA_URL / CHROMADB_URL) and will raise
-        # an explicit error otherwise so that configuration problems become
-        # obvious immediately instead of silently falling back to an embedded
-        # DuckDB store.
-        # ------------------------------------------------------------------
 
-        # Remote collection helper -------------------------------------------------
-        remote_collection: "chromadb.Collection | None" = None  # type: ignore[name-defined]
+# ---------------------------------------------------------------------------
+# FastAPI entry-points
+# ---------------------------------------------------------------------------
 
-        # ------------------------------------------------------------------
-        # Remote Chroma helper ------------------------------------------------
 
-        endpoint = (
-            os.environ.get("CHROMA_URL")
-            or os.environ.get("CHROMADB_URL")
-            or "http://localhost:8000"
-        ).rstrip("/")
+app = FastAPI(title="Codex Index Service", version="0.1.0")
+
+# ---------------------------------------------------------------------------
+# Pydantic models for the *search* endpoint
+# ---------------------------------------------------------------------------
+
+
+class SearchRequest(BaseModel):
+    """Incoming payload for /search."""
+
+    query: str
+    k: int = 6  # number of nearest neighbours to return
+    # Optional filters – pushed down into Chroma's `where` clause.
+    path_prefix: str | None = None  # e.g. "src/components" (relative to a root)
+    extensions: list[str] | None = None  # e.g. [".vue", "ts"]
+    root: str | None = None  # workspace root, by path or directory name
+    # Merge hits from the same file into line ranges (one result per file).
+    collapse: bool = False
+
+
+class SearchResponse(BaseModel):
+    """Outgoing payload for /search."""
+
+    documents: list[str]
+    metadatas: list[dict]
+
+
+# ---------------------------------------------------------------------------
+# FastAPI lifecycle hooks
+# ---------------------------------------------------------------------------
+
+
+class ReadinessState(BaseModel):
+    """Readiness reported by /readyz.
+
+    *embedding_backend* and *collection* record the outcome of the
+    background warm-up and stay set once it succeeded; *chroma_reachable* is
+    the latest heartbeat, re-checked by the probes themselves.
+    """
+
+    embedding_backend: bool = False
+    collection: bool = False
+    chroma_reachable: bool = False
+    attempts: int = 0
+    last_checked_at: float | None = None
+    error: str | None = None
+
+    @property
+    def ready(self) -> bool:
+        return self.embedding_backend and self.collection and self.chroma_reachable
+
+
+_readiness = ReadinessState()
+_readiness_lock = threading.Lock()
+
+# Delay between warm-up attempts while Chroma is unreachable.
+READY_RETRY_INTERVAL = float(os.getenv("CODEX_READY_RETRY_INTERVAL", "5"))
+
+# Seconds a Chroma heartbeat is reused by /readyz, so probes arriving in
+# quick succession do not each cost a round trip.
+READY_CHECK_TTL = float(os.getenv("CODEX_READY_CHECK_TTL", "2"))
+_heartbeat_at = 0.0  # time.monotonic() of the last heartbeat
+
+
+def _check_chroma() -> None:
+    """Refresh *chroma_reachable* unless the last heartbeat is recent enough."""
+
+    global _heartbeat_at
+
+    with _readiness_lock:
+        if time.monotonic() - _heartbeat_at < READY_CHECK_TTL:
+            return
+        _heartbeat_at = time.monotonic()
+
+    try:
+        _remote_client().heartbeat()
+        error = None
+    except Exception as exc:
+        logger.debug("Chroma heartbeat failed: %s", exc)
+        error = f"Chroma server is unreachable: {exc}"
+
+    with _readiness_lock:
+        if error is not None and _readiness.chroma_reachable:
+            logger.warning("Chroma stopped answering heartbeats – /readyz reports 503")
+        _readiness.chroma_reachable = error is None
+        _readiness.last_checked_at = time.time()
+        _readiness.error = error
+
+
+def _warm_backends() -> None:
+    """Import the embedding backend and validate Chroma until both succeed.
+
+    Runs on a daemon thread so neither a slow Chroma server nor the heavy
+    client imports delay the moment the service starts accepting requests.
+    """
+
+    while True:
+        error: str | None = None
+
+        try:
+            _get_embedding_function()
+            backend_ok = True
+        except Exception as exc:  # pragma: no cover – defensive
+            backend_ok = False
+            error = f"embedding backend: {exc}"
+
+        collection_ok = _ensure_remote_collection() is not None
+        if not collection_ok and error is None:
+            error = "Chroma server is unreachable"
+
+        with _readiness_lock:
+            _readiness.embedding_backend = backend_ok
+            _readiness.collection = collection_ok
+            _readiness.chroma_reachable = collection_ok
+            _readiness.attempts += 1
+            _readiness.last_checked_at = time.time()
+            _readiness.error = error
+            attempts = _readiness.attempts
+
+        if backend_ok and collection_ok:
+            logger.info("Backends warmed up after %d attempt(s) – service is ready", attempts)
+            return
+
+        if attempts == 1:
+            logger.warning(
+                "Remote Chroma collection could not be validated during startup – "
+                "/readyz reports 503 and /index requests will raise until the server "
+                "becomes reachable."
+            )
+
+        time.sleep(READY_RETRY_INTERVAL)
+
+
+@app.on_event("startup")
+def _on_startup() -> None:  # noqa: D401 – simple hook
+    """FastAPI *startup* – schedule backend validation in the background.
+
+    The Chroma check used to run inline here which meant a slow or missing
+    server delayed time-to-listening.  It now runs on a daemon thread and its
+    outcome is surfaced through */readyz* instead.
+    """
+
+    # Emit the configured batch size **early** so users can easily verify the
+    # runtime setting without digging through *DEBUG* level logs.
+    logger.info("Configured embedding batch size: %d", BATCH_SIZE)
+
+    threading.Thread(target=_warm_backends, name="backend-warmup", daemon=True).start()
+
+
+@app.get("/healthz")
+def healthz() -> Dict[str, Any]:
+    """Liveness probe – succeeds as long as the process serves requests."""
+
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+def readyz():
+    """Readiness probe – 200 while the backends are warm and Chroma answers.
+
+    The warm-up is only done once; Chroma is re-checked with a heartbeat
+    that is cached for *READY_CHECK_TTL* seconds.
+    """
+
+    with _readiness_lock:
+        warm = _readiness.embedding_backend and _readiness.collection
+
+    if warm:
+        _check_chroma()
+
+    with _readiness_lock:
+        state = _readiness.model_dump()
+        ready = _readiness.ready
+
+    state["status"] = "ready" if ready else "starting" if not warm else "unavailable"
+    return JSONResponse(status_code=200 if ready else 503, content=state)
+
+
+@contextmanager
+def _holding_lease(token: str):
+    """Renew the acquired lease *token* until the block ends, then release it."""
+
+    done = threading.Event()
+
+    def _heartbeat() -> None:
+        while not done.wait(LEADER_LEASE_SECONDS / 3):
+            try:
+                _get_shared_state().renew(token)
+            except Exception as exc:  # pragma: no cover – best-effort
+                logger.debug("Leader lease renewal failed: %s", exc)
+
+    _start_thread(_heartbeat, name="indexer-heartbeat")
+
+    try:
+        yield
+    finally:
+        done.set()
+        _get_shared_state().release(token)
+
+
+def _run_indexing_as_leader(token: str, full: bool = False, rebuild: bool = False) -> None:
+    """Thread target – run the indexer while holding (and renewing) lease *token*."""
+
+    ws = _ws()
+    ws.lease_token = token
+
+    try:
+        # Queue behind the runs of other workspaces when all slots are taken.
+        with _holding_lease(token), _run_scheduler.slot(ws.id):
+            _run_indexing(full, rebuild)
+    finally:
+        ws.lease_token = None
+
+    _start_queued_run()
+
+
+def _launch_run(token: str, full: bool, rebuild: bool) -> None:
+    # Mark the run as queued right away so status requests served by any
+    # worker in the meantime never observe a stale "completed" snapshot.
+    _update_progress(status="queued", error=None, finished_at=None)
+
+    _start_thread(_run_indexing_as_leader, token, full, rebuild, name=f"indexer-{_ws().id}")
+
+
+def _start_queued_run() -> None:
+    """Start the run requested while the lease was held, if there is one.
+
+    Called by every lease holder right after releasing the lease.  Whoever
+    wins the lease next takes the queued request over, so it runs exactly
+    once even when several workers race for it.
+    """
+
+    state = _get_shared_state()
+    token = _lease_token()
+    try:
+        if state.read_queued_run() is None or not state.try_acquire(token):
+            return
+        queued = state.take_queued_run()
+    except Exception as exc:  # pragma: no cover – retried by the next run
+        logger.warning("Unable to start the queued indexing run – %s", exc)
+        return
+
+    if queued is None:
+        state.release(token)
+        return
+
+    logger.info("Starting queued indexing run (full=%s, rebuild=%s)", queued["full"], queued["rebuild"])
+    _launch_run(token, queued["full"], queued["rebuild"])
+
+
+@app.post("/index")
+def start_indexing(full: bool = False, rebuild: bool = False):
+    """Kick off a new indexing run, or queue one behind the run in progress.
+
+    The check spans all worker processes: the caller must win the indexer
+    lease in the shared state, so concurrent requests hitting different
+    workers never start two runs against the same collection.  Requests
+    arriving while the workspace is being indexed are queued (and merged
+    into a single follow-up run) in the shared state; the run in progress
+    starts it once it has released the lease.  Runs of other workspaces
+    are independent and only share the ``INDEX_MAX_RUNS`` slots.  Runs only
+    revisit the files git reports as changed since the last run unless
+    *full* is set; *rebuild* re-embeds everything into a new collection
+    that searches switch to once it is complete.
+    """
+
+    ws = _ws()
+    with ws.progress_lock:
+        if ws.operation is not None:
+            logger.warning("Received /index request during a snapshot operation")
+            raise HTTPException(status_code=409, detail="Snapshot operation in progress")
+
+    state = _get_shared_state()
+    token = _lease_token()
+    try:
+        acquired = state.try_acquire(token)
+        if not acquired:
+            state.queue_run(full, rebuild)
+            # The run may have ended in between – whoever wins the lease now
+            # takes the queued request over.
+            acquired = state.try_acquire(token)
+        queued = state.take_queued_run() if acquired else None
+    except Exception as exc:
+        logger.error("Unable to access shared index state – %s", exc)
+        raise HTTPException(status_code=503, detail=f"Shared state unavailable: {exc}")
+
+    if not acquired:
+        logger.info("Received /index request while indexing – queued a follow-up run")
+        return {"detail": "Indexing queued"}
+
+    if queued is not None:
+        full = full or queued["full"]
+        rebuild = rebuild or queued["rebuild"]
+
+    logger.info("Received /index request – starting background indexing thread")
+    _launch_run(token, full, rebuild)
+    return {"detail": "Indexing started"}
+
+
+def _read_status() -> Dict[str, Any]:
+    """Return the current/last run's progress as seen by all workers."""
+
+    try:
+        state = _get_shared_state()
+        status = state.read_progress()
+
+        if status is not None and status.get("status") in ("queued", "running"):
+            leader = state.leader()
+            if leader is None or time.time() - leader[1] >= LEADER_LEASE_SECONDS:
+                # The owning worker died without recording an outcome.
+                status["status"] = "error"
+                status["error"] = "Indexing worker stopped responding"
+
+        if status is not None:
+            status["generation"] = state.generation("index")
+    except Exception as exc:  # pragma: no cover – fall back to local view
+        logger.debug("Shared state unavailable (%s) – serving local progress", exc)
+        status = None
+
+    if status is None:
+        ws = _ws()
+        with ws.progress_lock:
+            status = ws.progress.asdict()
+
+    return status
+
+
+@app.get("/index/status")
+def index_status() -> Dict[str, Any]:
+    """Return progress of the current/last indexing run (across all workers)."""
+
+    status = _read_status()
+    status["queued_run"] = _get_shared_state().read_queued_run()
+    status["search_qos"] = _search_qos.status()
+    status["collection"] = _live_collection_name()
+    status["rebuilding_into"] = _get_shared_state().read_alias("shadow")
+
+    logger.debug("Status request served: %s", status)
+    return status
+
+
+# ---------------------------------------------------------------------------
+# Workspace registry endpoints
+# ---------------------------------------------------------------------------
+#
+# Every endpoint is also served below ``/workspaces/{id}/…`` (``id`` may be
+# the workspace name as well); requests without the prefix keep targeting the
+# workspace configured through the environment.
+
+
+class WorkspaceRequest(BaseModel):
+    """Incoming payload for POST /workspaces."""
+
+    path: str
+    extra_roots: list[str] = []
+    name: str | None = None
+
+
+def _workspace_status(ws: Workspace) -> Dict[str, Any]:
+    token = _current_workspace.set(ws)
+    try:
+        return _read_status()
+    finally:
+        _current_workspace.reset(token)
+
+
+@app.post("/workspaces")
+def register_workspace(req: WorkspaceRequest) -> Dict[str, Any]:
+    """Register a workspace at runtime; POST /workspaces/{id}/index indexes it."""
+
+    roots: List[Path] = []
+    for raw in [req.path, *req.extra_roots]:
+        root = Path(raw).expanduser().resolve()
+        if not root.is_dir():
+            raise HTTPException(status_code=400, detail=f"Not a directory: {raw}")
+        if root not in roots:
+            roots.append(root)
+
+    try:
+        ws = _register_workspace(roots, req.name)
+    except Exception as exc:
+        logger.error("Unable to register workspace – %s", exc)
+        raise HTTPException(status_code=503, detail=f"Shared state unavailable: {exc}")
+
+    return ws.describe()
+
+
+@app.get("/workspaces")
+def list_workspaces() -> Dict[str, Any]:
+    """List the registered workspaces with their index status."""
+
+    _sync_workspaces()
+    with _workspaces_lock:
+        registered = list(_workspaces.values())
+
+    return {
+        "workspaces": [
+            {**ws.describe(), "status": _workspace_status(ws)} for ws in registered
+        ],
+        "scheduler": {
+            "max_runs": INDEX_MAX_RUNS,
+            "runs_waiting": _run_scheduler.waiting(),
+            "run_seconds": _run_scheduler.busy_seconds,
+            "embed_concurrency": EMBED_CONCURRENCY,
+            "embed_waiting": _embed_scheduler.waiting(),
+            "embed_seconds": _embed_scheduler.busy_seconds,
+        },
+    }
+
+
+@app.get("/workspaces/{workspace_id}")
+def get_workspace(workspace_id: str) -> Dict[str, Any]:
+    ws = _lookup_workspace(workspace_id)
+    if ws is None:
+        raise HTTPException(status_code=404, detail="Unknown workspace")
+
+    return {**ws.describe(), "status": _workspace_status(ws)}
+
+
+@app.delete("/workspaces/{workspace_id}")
+def delete_workspace(workspace_id: str, drop_index: bool = False) -> Dict[str, Any]:
+    """Unregister a workspace, optionally dropping its collections as well."""
+
+    ws = _lookup_workspace(workspace_id)
+    if ws is None:
+        raise HTTPException(status_code=404, detail="Unknown workspace")
+    if ws is _default_workspace:
+        raise HTTPException(status_code=400, detail="The default workspace cannot be removed")
+    if _workspace_status(ws).get("status") in ("queued", "running") or ws.operation is not None:
+        raise HTTPException(status_code=409, detail="Indexing in progress")
+
+    _service_state().delete_workspace(ws.id)
+    with _workspaces_lock:
+        _workspaces.pop(ws.id, None)
+
+    if drop_index:
+        ws.state.write_alias("live", None)
+        ws.state.write_alias("shadow", None)
+        _drop_versions(ws, keep_aliased=False)
+
+    logger.info("Removed workspace %s (drop_index=%s)", ws.name, drop_index)
+    return {"detail": "Workspace removed", **ws.describe()}
+
+
+class WorkspaceRouting:
+    """ASGI middleware scoping ``/workspaces/{id}/<endpoint>`` to a workspace.
+
+    The prefix is stripped and the workspace becomes the current one for the
+    duration of the request; the indexing threads it starts inherit it.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith("/workspaces/"):
+            await self.app(scope, receive, send)
+            return
+
+        key, _, rest = scope["path"][len("/workspaces/") :].partition("/")
+        if not rest:
+            # The registry endpoints themselves.
+            await self.app(scope, receive, send)
+            return
+
+        ws = await run_in_threadpool(_lookup_workspace, key)
+        if ws is None:
+            response = JSONResponse(status_code=404, content={"detail": "Unknown workspace"})
+            await response(scope, receive, send)
+            return
+
+        scope = {**scope, "path": "/" + rest, "raw_path": ("/" + rest).encode()}
+        token = _current_workspace.set(ws)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current_workspace.reset(token)
+
+
+app.add_middleware(WorkspaceRouting)
+
+
+@app.get("/index/classify")
+def classify_dry_run() -> Dict[str, Any]:
+    """Report which files the content classifier would skip – nothing is indexed.
+
+    Reads at most the classifier sample of every candidate file, so the
+    report is cheap even for large workspaces.
+    """
+
+    t0 = time.perf_counter()
+    skipped: Dict[tuple[str, str], tuple[str, int | None]] = {}
+    files = _iter_source_files(_ws().roots, skipped)
+    indexed = 0
+
+    for fp in files:
+        try:
+            with open(fp, "rb") as fh:
+                size = os.fstat(fh.fileno()).st_size
+                sample = fh.read(_CLASSIFIER_SAMPLE)
+        except OSError:
+            continue
+
+        if size > MAX_FILE_SIZE or b"\0" in sample[:2048]:
+            continue
+
+        rel_path = _relative_to_roots(fp)
+        category = _classify_content(rel_path, size, sample)
+        if category is not None:
+            skipped[_root_key(fp, rel_path)] = (category, size)
+        else:
+            indexed += 1
+
+    summary = _summarise_skipped(skipped)
+    return {
+        "indexed_files": indexed,
+        "skipped_files": len(skipped),
+        "skipped_bytes": sum(entry["bytes"] for entry in summary.values()),
+        "chunks_saved": sum(entry["chunks"] for entry in summary.values()),
+        "categories": summary,
+        "duration_seconds": round(time.perf_counter() - t0, 3),
+    }
+
+
+@app.get("/index/plan")
+def index_plan(verify: bool = False, full: bool = False, rebuild: bool = False) -> Dict[str, Any]:
+    """Report what the next /index run would do – nothing is embedded or written.
+
+    Discovery and the mtime freshness check are the indexer's own and only
+    ``stat`` files.  With ``verify=true`` files whose mtime changed are read
+    as well, so timestamp-only changes and content-classified skips are
+    reported exactly as the indexer will treat them.  *full* and *rebuild*
+    mirror the /index parameters; the planned *mode* is "incremental" when
+    the run would only visit the files git reports as changed.  Rebuilds
+    (requested or due to changed settings) are planned against the shadow
+    collection.  A missing or empty live collection is reported as
+    *collection_missing* and planned as a full build; the plan never creates it.
+    """
+
+    try:
+        col = _existing_live_collection()
+        count = col.count() if col is not None else 0
+    except Exception as exc:
+        logger.debug("Unable to read the live collection: %s", exc)
+        raise HTTPException(status_code=503, detail="Chroma server is unreachable")
+
+    t0 = time.perf_counter()
+    skipped: Dict[tuple[str, str], tuple[str, int | None]] = {}
+
+    build = _build_id()
+    rebuild = rebuild or bool(count and (col.metadata or {}).get("build") not in (None, build))
+
+    incremental = (
+        None if full or rebuild or not count else _incremental_files(_git_heads(), skipped)
+    )
+
+    removed: List[tuple[str, str]] = []
+    renames: Dict[tuple[str, str], tuple[str, str]] = {}
+    if incremental is not None:
+        files, removed, renames = incremental
+    else:
+        skipped.clear()
+        files = _iter_source_files(_ws().roots, skipped)
+
+    mode = "rebuild" if rebuild else "full" if incremental is None else "incremental"
+
+    try:
+        if rebuild:
+            # Only an interrupted rebuild under the same settings is resumed.
+            pending = _get_shared_state().read_alias("shadow")
+            shadow = _remote_client().get_collection(pending) if pending else None
+            manifest = (
+                _load_manifest(shadow, by_root=True)
+                if shadow is not None and (shadow.metadata or {}).get("build") == build
+                else {}
+            )
+        elif not count:
+            manifest = {}
+        else:
+            manifest = _load_manifest(
+                col,
+                None
+                if incremental is None
+                else [_root_key(fp, _relative_to_roots(fp)) for fp in files]
+                + list(renames.values())
+                + list(skipped)
+                + removed,
+                by_root=True,
+            )
+    except Exception as exc:
+        raise HTTPException(status_code=503, detail=f"Loading the stored manifest failed: {exc}")
+
+    kinds = ("added", "changed", "touched", "unchanged", "deleted")
+    file_counts = dict.fromkeys(kinds, 0)
+    chunk_counts = dict.fromkeys(kinds, 0)
+    examples: Dict[str, List[str]] = {kind: [] for kind in ("added", "changed", "deleted")}
+    ignored = 0
+    bytes_to_read = 0
+    tokens = 0
+    present: set[tuple[str, str]] = set()
+
+    def _count(kind: str, rel_path: str, n_chunks: int) -> None:
+        file_counts[kind] += 1
+        chunk_counts[kind] += n_chunks
+        if kind in examples and len(examples[kind]) < 10:
+            examples[kind].append(rel_path)
+
+    for fp in files:
+        rel_path = _relative_to_roots(fp)
+        key = _root_key(fp, rel_path)
+        present.add(key)
+
+        try:
+            st = fp.stat()
+        except OSError:
+            ignored += 1
+            continue
+
+        if st.st_size > MAX_FILE_SIZE:
+            ignored += 1
+            continue
+
+        # Renamed files are compared with the entry of their old path – the
+        # run moves their chunks when the content is unchanged.
+        meta0 = manifest.get(key) or (manifest.get(renames[key]) if key in renames else None)
+        kind = "added" if meta0 is None else "changed"
+        if meta0 is not None and meta0.get("schema") != INDEX_SCHEMA_VERSION:
+            meta0 = None
+
+        if meta0 is not None and meta0.get("mtime") == int(st.st_mtime):
+            _count("unchanged", rel_path, meta0.get("n_chunks") or _estimate_chunks(st.st_size))
+            continue
+
+        length = st.st_size
+
+        if verify:
+            try:
+                with open(fp, "rb") as fh:
+                    data = fh.read()
+            except OSError:
+                ignored += 1
+                continue
+
+            if b"\0" in data[:2048]:
+                ignored += 1
+                continue
+
+            category = _classify_content(rel_path, st.st_size, data[:_CLASSIFIER_SAMPLE])
+            if category is not None:
+                skipped[key] = (category, st.st_size)
+                continue
+
+            bytes_to_read += st.st_size
+
+            if (
+                meta0 is not None
+                and meta0.get("n_chunks") is not None
+                and meta0.get("sha1") == hashlib.sha1(data).hexdigest()
+            ):
+                _count("touched", rel_path, meta0["n_chunks"])
+                continue
+
+            length = len(data.decode("utf-8", errors="ignore"))
+        else:
+            bytes_to_read += st.st_size
+
+        n_chunks = _estimate_chunks(length)
+        if n_chunks == 0:
+            ignored += 1  # empty files are never stored
+            continue
+
+        _count(kind, rel_path, n_chunks)
+        # Overlapping chunks embed some characters twice.
+        tokens += (length + max(n_chunks - 1, 0) * CHUNK_OVERLAP) // CHARS_PER_TOKEN
+
+    moved = set(renames.values())
+    for key, meta in manifest.items():
+        if key in moved and key not in skipped:
+            continue
+        if key in skipped or key not in present:
+            _count("deleted", key[1], meta.get("n_chunks") or 0)
+
+    try:
+        throughput = _get_shared_state().read_metric("throughput")
+    except Exception as exc:  # pragma: no cover – estimates are best-effort
+        logger.debug("Reading the measured throughput failed: %s", exc)
+        throughput = None
+
+    to_embed = chunk_counts["added"] + chunk_counts["changed"]
+    estimated_seconds = None
+    if throughput and throughput.get("chunks_per_second"):
+        estimated_seconds = round(to_embed / throughput["chunks_per_second"], 1)
+
+    return {
+        "files": {**file_counts, "skipped": len(skipped) + ignored},
+        "chunks": chunk_counts,
+        "bytes_to_read": bytes_to_read,
+        "estimated_tokens": tokens,
+        "estimated_seconds": estimated_seconds,
+        "throughput": throughput,
+        "mode": mode,
+        "rebuild": rebuild,
+        "collection_missing": not count,
+        "verified": verify,
+        "examples": examples,
+        "duration_seconds": round(time.perf_counter() - t0, 3),
+    }
+
+
+@app.get("/index/projection/eval")
+def projection_eval(dims: str | None = None, k: int = 10) -> Dict[str, Any]:
+    """Measure recall@k versus dimension for random and PCA projections.
+
+    Built-in code-search queries plus held-out workspace chunks are matched
+    against a sample of workspace chunks; exact search on the unprojected
+    vectors is the ground truth.  Nothing is written to the index.
+    """
+
+    try:
+        wanted = [int(d) for d in dims.split(",")] if dims else list(EVAL_DEFAULT_DIMS)
+    except ValueError:
+        raise HTTPException(status_code=422, detail="dims must be a comma separated list of integers")
+
+    if not dims:
+        # Small backends (e.g. the hash fallback) have fewer dimensions than
+        # the defaults – evaluate fractions of their size instead.
+        source_dim = _get_embedding_dim()
+        if all(d >= source_dim for d in wanted):
+            wanted = [source_dim // 4, source_dim // 2]
+
+    t0 = time.perf_counter()
+    try:
+        result = _evaluate_projections(wanted, max(1, min(k, 100)))
+    except ValueError as exc:
+        raise HTTPException(status_code=409, detail=str(exc))
+
+    result["duration_seconds"] = round(time.perf_counter() - t0, 3)
+    return result
+
+
+# ---------------------------------------------------------------------------
+# /index/events – Server-Sent Events progress stream
+# ---------------------------------------------------------------------------
+
+# Bounds for the client supplied push interval (seconds) and the delay after
+# which an idle stream emits a keep-alive comment.
+EVENTS_MIN_INTERVAL = 0.2
+EVENTS_DEFAULT_INTERVAL = 1.0
+EVENTS_KEEPALIVE = 15.0
+# Seconds of progress the reported rates and ETA are averaged over.
+EVENTS_RATE_WINDOW = 10.0
 
-        logger.debug("Attempting to connect to remote Chroma at %s", endpoint)
 
-        def _start_local_chroma_server(path: str) -> None:  # pragma: no cover – best-effort helper
-            """Attempt to spawn a local Chroma server in the background.
+class _ThroughputTracker:
+    """Derive files/s, chunks/s and an ETA from progress snapshots.
 
-            Mirrors the logic used by the JS helper (`explain-memory.ts`) so the Python index
-            service works when invoked standalone (e.g. via `curl`) where the CLI hasn’t already
-            spun up a Chroma instance.
-            """
+    Rates are measured over the last *EVENTS_RATE_WINDOW* seconds of the run
+    – from its start while it is younger – rather than between consecutive
+    snapshots: the write coalescer reports chunks in bursts, so the counters
+    often do not move from one snapshot to the next.
+    """
 
-            # Prevent multiple invocations.
-            if getattr(_start_local_chroma_server, "_proc", None):  # type: ignore[attr-defined]
-                return
+    def __init__(self, clock=time.time) -> None:
+        self._clock = clock
+        self._samples: deque[tuple[float, int, int]] = deque()
+        self._run: float | None = None
+        self.files_per_second: float | None = None
+        self.chunks_per_second: float | None = None
+
+    def update(self, status: Dict[str, Any]) -> Dict[str, Any]:
+        now = self._clock()
+        files = status.get("processed_files") or 0
+        chunks = status.get("processed_chunks") or 0
+        self.files_per_second = self.chunks_per_second = None
+
+        if status.get("status") != "running":
+            self._samples.clear()
+            self._run = None
+        else:
+            started_at = status.get("started_at")
+            if started_at != self._run:
+                # A new run – its counters started from zero.
+                self._samples.clear()
+                self._run = started_at
+                if started_at is not None and started_at < now:
+                    self._samples.append((started_at, 0, 0))
+
+            self._samples.append((now, files, chunks))
+            while len(self._samples) > 2 and self._samples[1][0] <= now - EVENTS_RATE_WINDOW:
+                self._samples.popleft()
+
+            since, files0, chunks0 = self._samples[0]
+            if now > since:
+                self.files_per_second = max(files - files0, 0) / (now - since)
+                self.chunks_per_second = max(chunks - chunks0, 0) / (now - since)
+
+        return {
+            "files_per_second": _round(self.files_per_second),
+            "chunks_per_second": _round(self.chunks_per_second),
+            "embed_latency_ms": _round(status.get("embed_latency_ms")),
+            "eta_seconds": _round(self._eta(status)),
+        }
+
+    def _eta(self, status: Dict[str, Any]) -> float | None:
+        if status.get("status") != "running":
+            return None
+
+        processed_files = status.get("processed_files") or 0
+        total_files = status.get("total_files") or 0
+
+        if self.chunks_per_second:
+            # *total_chunks* only covers files read so far – extrapolate it
+            # to the whole file list before deriving the remaining work.
+            total_chunks = status.get("total_chunks") or 0
+            if processed_files and total_files > processed_files:
+                total_chunks = total_chunks * total_files / processed_files
+
+            remaining = max(total_chunks - (status.get("processed_chunks") or 0), 0)
+            return remaining / self.chunks_per_second
+
+        # No chunk written yet in the window (e.g. before the first flush) –
+        # fall back to the file rate.
+        if self.files_per_second:
+            return max(total_files - processed_files, 0) / self.files_per_second
 
-            chroma_data = os.path.expanduser(path)
-            os.makedirs(chroma_data, exist_ok=True)
+        return None
 
-            cmds = [
-                ["chroma", "--path", chroma_data],
-                ["python", "-m", "chromadb.cli.cli", "--path", chroma_data],
-            ]
 
-            for cmd in cmds:
-                try:
-                    proc = subprocess.Popen(
-                        cmd,
-                        stdout=subprocess.DEVNULL,
-                        stderr=subprocess.DEVNULL,
-                        start_new_session=True,
-                    )
-                    setattr(_start_local_chroma_server, "_proc", proc)  # type: ignore[attr-defined]
-                    logger.info("Spawned local Chroma server via %s", " ".join(cmd))
-                    return
-                except FileNotFoundError:
-                    continue  # try next variant
-                except Exception as exc:
-                    logger.warning("Failed to spawn Chroma using %s – %s", cmd, exc)
+def _round(value: float | None) -> float | None:
+    return round(value, 2) if value is not None else None
 
-            logger.warning("Unable to spawn a local Chroma server – binary not found")
 
-        def _get_remote_collection() -> "chromadb.Collection | None":  # type: ignore[name-defined]
-            """Try to connect to the configured Chroma endpoint and create the index collection."""
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-            try:
-                parsed = urlparse(endpoint)
-                if parsed.scheme not in {"http", "https"}:
-                    raise ValueError("Unsupported scheme")
 
-                host = parsed.hostname or "localhost"
-                port = parsed.port or (443 if parsed.scheme == "https" else 80)
+@app.get("/index/events")
+async def index_events(request: Request, interval: float = EVENTS_DEFAULT_INTERVAL):
+    """Stream indexing progress as Server-Sent Events.
 
-                client_remote = chromadb.HttpClient(host=host, port=port)  # type: ignore[arg-type]
+    The first ``snapshot`` event carries the full status; subsequent
+    ``progress`` events only contain changed fields plus live throughput,
+    embedding latency and ETA.  At most one event is pushed per *interval*
+    seconds, and idle streams receive a keep-alive comment.
+    """
 
-                logger.debug(
-                    "Created Chroma HttpClient (host=%s, port=%s) – requesting collection …",
-                    host,
-                    port,
-                )
+    interval = max(interval, EVENTS_MIN_INTERVAL)
 
-                col = client_remote.get_or_create_collection(
-                    _derive_collection_name(PRIMARY_ROOT)
-                )
+    async def _stream():
+        tracker = _ThroughputTracker()
+        previous: Dict[str, Any] | None = None
+        last_sent = time.monotonic()
 
-                logger.debug(
-                    "Remote Chroma collection '%s' ready at %s – currently %s items",
-                    col.name,  # type: ignore[attr-defined]
-                    endpoint,
-                    col.count() if hasattr(col, "count") else "?",
-                )
+        while not await request.is_disconnected():
+            status = await run_in_threadpool(_read_status)
+            metrics = tracker.update(status)
 
-                return col
-            except Exception as exc:
-                logger.debug("Remote Chroma connection attempt failed: %s", exc)
-                return None
+            if previous is None:
+                yield _sse("snapshot", {**status, **metrics})
+                last_sent = time.monotonic()
+            else:
+                delta = {k: v for k, v in status.items() if previous.get(k) != v}
+                if delta or status.get("status") == "running":
+                    yield _sse("progress", {**delta, **metrics})
+                    last_sent = time.monotonic()
+                elif time.monotonic() - last_sent >= EVENTS_KEEPALIVE:
+                    yield ": keep-alive\n\n"
+                    last_sent = time.monotonic()
+
+            previous = status
+            await asyncio.sleep(interval)
+
+    return StreamingResponse(
+        _stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-        # Try once to connect to the remote Chroma instance.
-        remote_collection = _get_remote_collection()
 
-        if remote_collection is None:
-            raise RuntimeError(
-                f"Unable to connect to the remote Chroma server at {endpoint}. "
-                "Please make sure it is running (e.g. via `chroma --path <data-dir>`) "
-                "before starting the index service."
-            )
+# ---------------------------------------------------------------------------
+# /index/export & /index/import – snapshots for warm starts
+# ---------------------------------------------------------------------------
 
-        # Second pass -> actually store data.
-        for idx, fp in enumerate(files, 1):
-            _update_progress(current_file=str(fp), processed_files=idx)
+# Snapshot layout (little endian):
+#
+#   magic (8) | version u32 | dim u32 | count u64 | meta offset u64 | meta len u64
+#   … zero padding up to SNAPSHOT_DATA_OFFSET …
+#   count × dim float32 vectors (row major, memory-mappable)
+#   meta JSON – backend identity, roots, manifest, documents & metadatas
+#
+# Manifest entries name their file by root index and relative path – the
+# relative path alone is ambiguous in multi-root workspaces.  The vectors sit
+# at a fixed, aligned offset so an import can `np.memmap` the file and hand
+# slices straight to the store without copying.
 
-            # Calculate frequently used values **once** so they can be reused
-            # across the whole file processing pipeline.
+SNAPSHOT_MAGIC = b"CDXSNAP\0"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_DATA_OFFSET = 64
+_SNAPSHOT_PRELUDE = "<8sIIQQQ"
 
-            rel_path = _relative_to_roots(fp)
-            file_mtime = int(fp.stat().st_mtime)
+# Page size used when reading from / writing to Chroma in bulk.
+SNAPSHOT_PAGE_SIZE = 1_000
 
-            # ----------------------------------------------------------------
-            # Fast-path – skip files that are already up-to-date
-            # ----------------------------------------------------------------
 
-            # We attach the file modification timestamp (*mtime*, second
-            # resolution) to every chunk’s metadata so subsequent full index
-            # runs can very cheaply decide whether the on-disk version still
-            # matches the persisted representation.  When the timestamp of the
-            # *first* chunk (chunk_index == 0) matches we consider the **whole**
-            # file fresh and therefore skip expensive re-embedding & upsert
-            # work.
+# Snapshots are only ever read from and written to this directory.
+SNAPSHOT_DIR = STATE_DIR / "snapshots"
 
-            try:
-                # NOTE: Chroma's filtering syntax expects exactly **one** top-
-                # level *operator* such as `$and`, `$or`, `$eq`, … – passing
-                # multiple plain field names directly is therefore **invalid**
-                # and triggers the somewhat cryptic
-                #     "Expected where to have exactly one operator"
-                # error.  Wrap the individual equality comparisons in a
-                # single `$and` so the query remains semantically equivalent
-                # while satisfying the syntax requirements.
-
-                existing = remote_collection.get(
-                    where={
-                        "$and": [
-                            {"path": {"$eq": rel_path}},
-                            {"chunk_index": {"$eq": 0}},
-                        ]
-                    }
-                )
 
-                if existing.get("metadatas"):
-                    meta0 = existing["metadatas"][0]
-                    stored_mtime = meta0.get("mtime")
+class SnapshotRequest(BaseModel):
+    """Payload for /index/export and /index/import."""
 
-                    if stored_mtime == file_mtime:
-                        # File unchanged – update progress counters and move on.
-                        # For accurate progress reporting we roughly estimate the
-                        # chunk count using the *character* length because the
-                        # UTF-8 on-disk size can differ significantly for files
-                        # that contain non-ASCII characters.
+    model_config = {"extra": "forbid"}
 
-                        try:
-                            text_len = len(fp.read_text(encoding="utf-8", errors="ignore"))
-                        except Exception:
-                            text_len = fp.stat().st_size  # fallback → bytes length
+    name: str | None = None  # file below SNAPSHOT_DIR, defaults to <collection>.snapshot
 
-                        step = CHUNK_SIZE - CHUNK_OVERLAP
-                        n_chunks = (text_len + step - 1) // step if text_len else 0
 
-                        with _progress_lock:
-                            _progress.total_chunks += n_chunks
-                            _progress.processed_chunks += n_chunks
+def _snapshot_path(req: SnapshotRequest) -> Path:
+    """Resolve the snapshot *req* names below *SNAPSHOT_DIR* (400 for anything else).
 
-                        logger.debug("Skipping up-to-date file %s", fp)
-                        continue
-            except Exception as exc:
-                # Any failure (e.g. network hiccup or the first run where the
-                # collection is still empty) falls back to the regular slow
-                # path so robustness is unaffected.
-                logger.debug("Up-to-date check for %s failed (%s) – re-indexing", fp, exc)
+    Only plain file names are accepted so the endpoints can neither
+    overwrite nor read arbitrary files the service has access to.
+    """
 
-            try:
-                text = fp.read_text(encoding="utf-8", errors="ignore")
-            except Exception:
-                logger.warning("Failed to read %s – skipping", fp, exc_info=True)
-                continue
+    name = req.name or f"{_ws().collection_name}.snapshot"
+    if name in (".", "..") or Path(name).name != name or "\\" in name:
+        raise HTTPException(status_code=400, detail=f"Invalid snapshot name: {name!r}")
 
-            # ----------------------------------------------------------------
-            # More memory-efficient, *streaming* chunk processing
-            # ----------------------------------------------------------------
+    path = (SNAPSHOT_DIR / name).resolve()
+    if path.parent != SNAPSHOT_DIR.resolve():
+        raise HTTPException(status_code=400, detail=f"Invalid snapshot name: {name!r}")
 
-            # Remove any previously indexed chunks for the current file **before**
-            # we start uploading new ones.  Using a *where* filter keeps the
-            # deletion payload tiny no matter how many chunks the file generates –
-            # important for very large sources.
+    return path
 
-            try:
-                # See comment above regarding Chroma's filter syntax.  A single
-                # equality comparison can be expressed directly via `$eq`.
-                remote_collection.delete(where={"path": {"$eq": rel_path}})
-            except Exception:
-                # Ignore when the file hasn’t been indexed yet.
-                pass
 
-            # Pre-calculate a *rough* chunk count so the total work estimate is
-            # available early without having to materialise the whole chunk
-            # list in memory.  We derive the number directly from the character
-            # length – this is exact given the deterministic chunking
-            # parameters (size & overlap).
+def _root_index(root: str) -> int | None:
+    for i, candidate in enumerate(_ws().roots):
+        if str(candidate) == root:
+            return i
 
-            step = CHUNK_SIZE - CHUNK_OVERLAP
-            n_chunks = (len(text) + step - 1) // step if text else 0
+    return None
 
-            with _progress_lock:
-                _progress.total_chunks += n_chunks
 
-            # Stream through the file character data and accumulate exactly
-            # `BATCH_SIZE` chunks before we invoke the (potentially network
-            # bound) embedding & upsert calls.  This keeps the peak RSS tightly
-            # bound to the batch size no matter how large a single source file
-            # grows.
+def _export_snapshot(col, target: Path) -> Dict[str, Any]:
+    """Write every chunk of *col* into a snapshot at *target*.
 
-            rel_path = _relative_to_roots(fp)
+    Vectors are copied to disk page by page, but the documents, metadata and
+    manifest are buffered in memory until the trailing JSON block is written,
+    so peak memory grows with the size of the corpus text.  Only files whose
+    first chunk carries the current schema stamp are listed in the manifest.
+    """
 
-            batch_chunks: List[str] = []
-            batch_ids: List[str] = []
-            batch_metadatas: List[Dict[str, Any]] = []
+    import struct
 
-            def _flush_batch() -> None:
-                """Helper – embed the current batch and upsert it to Chroma."""
+    import numpy as np
 
-                if not batch_chunks:
-                    return
+    documents: List[str] = []
+    metadatas: List[Dict[str, Any]] = []
+    manifest: List[Dict[str, Any]] = []
+    dim = 0
 
-                try:
-                    embeddings = _embed_texts(batch_chunks)
-
-                    t_remote = time.perf_counter()
-                    # Prefer *upsert* when the client supports it so duplicate
-                    # IDs get **replaced** transparently.  Older Chroma
-                    # versions (<0.4) only expose *add* which raises an error
-                    # on duplicates – fall back to the legacy behaviour in
-                    # this case so we stay compatible with a wider range of
-                    # installations.
-
-                    add_or_upsert = (
-                        getattr(remote_collection, "upsert", None) or getattr(remote_collection, "add")
-                    )
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_suffix(target.suffix + ".tmp")
 
-                    add_or_upsert(
-                        ids=list(batch_ids),  # copy because we reuse the lists
-                        documents=list(batch_chunks),
-                        metadatas=list(batch_metadatas),
-                        embeddings=embeddings,
-                    )
+    with open(tmp, "wb") as out:
+        out.write(b"\0" * SNAPSHOT_DATA_OFFSET)
 
-                    logger.debug(
-                        "Persisted %d chunks for %s into remote store in %.2fs",
-                        len(batch_chunks),
-                        fp,
-                        time.perf_counter() - t_remote,
+        offset = 0
+        while True:
+            page = col.get(
+                limit=SNAPSHOT_PAGE_SIZE,
+                offset=offset,
+                include=["embeddings", "documents", "metadatas"],
+            )
+            ids = page.get("ids") or []
+            if not ids:
+                break
+            offset += len(ids)
+
+            vectors = np.asarray(page["embeddings"], dtype=np.float32)
+            dim = dim or vectors.shape[1]
+            out.write(vectors.tobytes())
+            documents.extend(page["documents"])
+
+            for meta in page["metadatas"]:
+                metadatas.append(meta)
+                if meta.get("chunk_index") == 0 and meta.get("schema") == INDEX_SCHEMA_VERSION:
+                    manifest.append(
+                        {
+                            "root": _root_index(meta.get("root", "")),
+                            "path": meta["path"],
+                            "sha1": meta.get("sha1"),
+                            "n_chunks": meta.get("n_chunks"),
+                        }
                     )
-                except Exception as exc:
-                    logger.error("Failed to add batch to remote Chroma – %s", exc)
-                    raise
 
-                with _progress_lock:
-                    _progress.processed_chunks += len(batch_chunks)
+        # Fitted projections travel with the snapshot so a fresh machine can
+        # project its queries the same way.
+        projection_id = _collection_projection_id(col)
+        basis = None
+        if _projection_path(projection_id).is_file():
+            import base64
+
+            basis = base64.b64encode(_projection_path(projection_id).read_bytes()).decode()
+
+        meta_blob = json.dumps(
+            {
+                "backend": (col.metadata or {}).get("backend") or _get_embedding_backend_id(),
+                "projection": projection_id,
+                "projection_basis": basis,
+                "schema": INDEX_SCHEMA_VERSION,
+                "chunk_size": CHUNK_SIZE,
+                "chunk_overlap": CHUNK_OVERLAP,
+                "roots": [str(r) for r in _ws().roots],
+                "created_at": time.time(),
+                "manifest": manifest,
+                "documents": documents,
+                "metadatas": metadatas,
+            }
+        ).encode()
+
+        meta_offset = out.tell()
+        out.write(meta_blob)
+        out.seek(0)
+        out.write(
+            struct.pack(
+                _SNAPSHOT_PRELUDE,
+                SNAPSHOT_MAGIC,
+                SNAPSHOT_VERSION,
+                dim,
+                len(metadatas),
+                meta_offset,
+                len(meta_blob),
+            )
+        )
 
-                # Clear the batch lists *in-place* so existing allocations can
-                # be reused by the next fill cycle which avoids the small-yet
-                # noticeable fragmentation that a fresh list would introduce.
-                batch_chunks.clear()
-                batch_ids.clear()
-                batch_metadatas.clear()
+    os.replace(tmp, target)
 
-            # Iterate lazily over the character data -------------------------------------------------
+    return {
+        "path": str(target),
+        "files": len(manifest),
+        "chunks": len(metadatas),
+        "dim": dim,
+        "bytes": target.stat().st_size,
+    }
 
-            chunk_index = 0
-            start = 0
-            step = CHUNK_SIZE - CHUNK_OVERLAP
 
-            while start < len(text):
-                end = min(start + CHUNK_SIZE, len(text))
-                chunk_text = text[start:end]
+def _import_snapshot(col, source: Path) -> Dict[str, Any]:
+    """Bulk-load the files of *source* that still match the working tree.
 
-                batch_chunks.append(chunk_text)
-                batch_ids.append(f"{fp}:{chunk_index}")
-                batch_metadatas.append({
-                    "path": rel_path,
-                    "chunk_index": chunk_index,
-                    "mtime": file_mtime,
-                })
+    The whole snapshot is validated before the store is touched, and the
+    chunks it held for the loaded files are only deleted once their
+    replacements have been written – a failed import never loses data.
+    """
 
-                chunk_index += 1
-                start += step
+    import struct
+
+    import numpy as np
+
+    with open(source, "rb") as fh:
+        prelude = fh.read(struct.calcsize(_SNAPSHOT_PRELUDE))
+        magic, version, dim, count, meta_offset, meta_len = struct.unpack(_SNAPSHOT_PRELUDE, prelude)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"{source} is not a version {SNAPSHOT_VERSION} index snapshot")
+        fh.seek(meta_offset)
+        meta = json.loads(fh.read(meta_len))
+
+    # The vectors have to match the collection they are loaded into – while
+    # a rebuild for another backend runs that is still the previous one.
+    backend = (col.metadata or {}).get("backend") or _get_embedding_backend_id()
+    if meta["backend"] != backend:
+        raise ValueError(
+            f"Snapshot was built with embedding backend {meta['backend']!r}, "
+            f"the collection holds {backend!r} vectors"
+        )
+    if (meta["schema"], meta["chunk_size"], meta["chunk_overlap"]) != (
+        INDEX_SCHEMA_VERSION,
+        CHUNK_SIZE,
+        CHUNK_OVERLAP,
+    ):
+        raise ValueError("Snapshot uses a different index schema or chunking configuration")
+
+    data_end = SNAPSHOT_DATA_OFFSET + count * dim * 4
+    if (
+        len(meta["metadatas"]) != count
+        or len(meta["documents"]) != count
+        or meta_offset < data_end
+        or source.stat().st_size < meta_offset + meta_len
+    ):
+        raise ValueError(f"{source} is truncated or inconsistent")
+
+    projection_id = meta.get("projection", "none")
+    stored = _collection_projection_id(col)
+    if col.count() and projection_id != stored:
+        raise ValueError(
+            f"Snapshot vectors use projection {projection_id!r}, the index uses {stored!r}"
+        )
+    if meta.get("projection_basis") and not _projection_path(projection_id).is_file():
+        import base64
 
-                if len(batch_chunks) >= BATCH_SIZE:
-                    _flush_batch()
+        _projection_path(projection_id).parent.mkdir(parents=True, exist_ok=True)
+        _projection_path(projection_id).write_bytes(base64.b64decode(meta["projection_basis"]))
+    _projection_for(projection_id)  # raises ValueError when the basis is missing
 
-            # Flush remaining chunks < BATCH_SIZE.
-            _flush_batch()
+    vectors = (
+        np.memmap(source, dtype=np.float32, mode="r", offset=SNAPSHOT_DATA_OFFSET, shape=(count, dim))
+        if count
+        else np.empty((0, dim), dtype=np.float32)
+    )
 
-            logger.debug(
-                "Indexed %s (%d chunks, progress %d/%d files)",
-                fp,
-                n_chunks,
-                idx,
-                len(files),
-            )
+    # Validate the manifest against the working tree: only files whose
+    # content hash still matches are loaded – everything else is left to the
+    # next /index run, which then only has to embed the differences.  Files
+    # are keyed by (root index, relative path).
+    roots = _ws().roots
+    current: Dict[tuple[int, str], Dict[str, Any]] = {}
+    stale = 0
+
+    for entry in meta["manifest"]:
+        root_index, rel_path = entry.get("root"), entry.get("path")
+        if root_index is None or root_index >= len(roots) or not rel_path:
+            stale += 1
+            continue
 
-            # Finished with the (potentially large) `text` buffer → drop it so
-            # the memory becomes available for the next file *immediately*.
-            del text
+        fp = roots[root_index] / rel_path
+        try:
+            with open(fp, "rb") as fh:
+                st = os.fstat(fh.fileno())
+                digest = hashlib.sha1(fh.read()).hexdigest()
+        except OSError:
+            stale += 1
+            continue
 
-        _update_progress(status="completed", finished_at=time.time(), current_file=None)
+        if digest != entry.get("sha1"):
+            stale += 1
+            continue
 
-        logger.info(
-            "Indexing completed successfully – %d files, %d chunks (total %.2fs)",
-            _progress.processed_files,
-            _progress.processed_chunks,
-            time.perf_counter() - _t0,
+        current[(root_index, rel_path)] = {
+            "fp": fp,
+            "mtime": int(st.st_mtime),
+            "n_chunks": entry.get("n_chunks"),
+            "rows": [],
+        }
+
+    # Chunk metadata names the root it was exported from by path.
+    exported_roots = {root: i for i, root in enumerate(meta.get("roots") or [])}
+    for row, chunk_meta in enumerate(meta["metadatas"]):
+        target = current.get((exported_roots.get(chunk_meta.get("root", "")), chunk_meta.get("path")))
+        if target is not None:
+            target["rows"].append(row)
+
+    # A file is only loaded with exactly its chunks 0 … n-1.
+    for key, target in list(current.items()):
+        indices = sorted(meta["metadatas"][row].get("chunk_index") for row in target["rows"])
+        if indices != list(range(target["n_chunks"] or 0)) or not indices:
+            logger.warning("Snapshot holds inconsistent chunks for %s – leaving it to /index", key[1])
+            del current[key]
+            stale += 1
+
+    # IDs the store holds for the files about to be loaded – whatever is not
+    # overwritten (chunks of a longer previous version) goes at the end.
+    keys = [(str(roots[root_index]), rel_path) for root_index, rel_path in current]
+    existing: set[str] = set()
+    for ofs in range(0, len(keys), SNAPSHOT_PAGE_SIZE):
+        existing.update(
+            col.get(where=_paths_where(keys[ofs : ofs + SNAPSHOT_PAGE_SIZE]), include=[])["ids"]
         )
 
-    except Exception as exc:  # noqa: BLE001 – want to capture *any* failure.
-        _update_progress(status="error", error=str(exc), finished_at=time.time())
-        logger.exception("Indexing run failed with an unexpected error")
-
+    if projection_id != stored:
+        col.modify(metadata={**(col.metadata or {}), "projection": projection_id})
 
-# ---------------------------------------------------------------------------
-# FastAPI entry-points
-# ---------------------------------------------------------------------------
+    add_or_upsert = getattr(col, "upsert", None) or getattr(col, "add")
+    loaded: set[str] = set()
+    batch_rows: List[int] = []
+    batch_ids: List[str] = []
+    batch_metadatas: List[Dict[str, Any]] = []
 
+    def _flush() -> None:
+        if not batch_rows:
+            return
 
-app = FastAPI(title="Codex Index Service", version="0.1.0")
+        add_or_upsert(
+            ids=batch_ids,
+            documents=[meta["documents"][row] for row in batch_rows],
+            metadatas=batch_metadatas,
+            embeddings=vectors[batch_rows],
+        )
+        loaded.update(batch_ids)
+        batch_rows.clear()
+        batch_ids.clear()
+        batch_metadatas.clear()
+
+    for (root_index, _rel_path), target in current.items():
+        for row in target["rows"]:
+            chunk_meta = meta["metadatas"][row]
+            batch_rows.append(row)
+            batch_ids.append(f"{target['fp']}:{chunk_meta['chunk_index']}")
+            batch_metadatas.append(
+                {**chunk_meta, "mtime": target["mtime"], "root": str(roots[root_index])}
+            )
 
-# ---------------------------------------------------------------------------
-# Pydantic models for the *search* endpoint
-# ---------------------------------------------------------------------------
+            if len(batch_rows) >= SNAPSHOT_PAGE_SIZE:
+                _flush()
 
+    _flush()
 
-class SearchRequest(BaseModel):
-    """Incoming payload for /search."""
+    leftover = sorted(existing - loaded)
+    for ofs in range(0, len(leftover), SNAPSHOT_PAGE_SIZE):
+        col.delete(ids=leftover[ofs : ofs + SNAPSHOT_PAGE_SIZE])
 
-    query: str
-    k: int = 6  # number of nearest neighbours to return
+    return {
+        "path": str(source),
+        "files": len(current),
+        "chunks": len(loaded),
+        "stale_files": stale,
+        "snapshot_created_at": meta.get("created_at"),
+    }
 
 
-class SearchResponse(BaseModel):
-    """Outgoing payload for /search."""
+def _run_exclusive(action, *args):
+    """Run *action* while holding the indexer lease (409 when taken).
 
-    documents: list[str]
-    metadatas: list[dict]
+    The workspace is marked busy in-process as well, so neither an index run
+    nor another snapshot operation of this worker starts in the meantime.
+    """
 
+    ws = _ws()
+    with ws.progress_lock:
+        busy = ws.progress.status in ("queued", "running") or ws.operation is not None
+        if not busy:
+            ws.operation = action.__name__
 
-# ---------------------------------------------------------------------------
-# FastAPI lifecycle hooks
-# ---------------------------------------------------------------------------
+    if busy:
+        raise HTTPException(status_code=409, detail="Indexing already in progress")
 
+    try:
+        token = _lease_token()
+        if not _get_shared_state().try_acquire(token):
+            raise HTTPException(status_code=409, detail="Indexing already in progress")
 
-@app.on_event("startup")
-def _on_startup() -> None:  # noqa: D401 – simple hook
-    """FastAPI *startup* – verify Chroma collection exists.
+        try:
+            with _holding_lease(token):
+                return action(*args)
+        finally:
+            _start_queued_run()
+    finally:
+        with ws.progress_lock:
+            ws.operation = None
 
-    Performing the check at service start provides *immediate* feedback when
-    the configured Chroma server is unreachable instead of failing later
-    during the first indexing request.
-    """
 
-    if _ensure_remote_collection() is None:
-        logger.warning(
-            "Remote Chroma collection could not be validated during startup – "
-            "/index requests will raise until the server becomes reachable."
-        )
+@app.post("/index/export")
+def export_index(req: SnapshotRequest | None = None) -> Dict[str, Any]:
+    """Write the current index into a versioned snapshot file."""
 
+    target = _snapshot_path(req or SnapshotRequest())
+    col = _ensure_remote_collection()
+    if col is None:
+        raise HTTPException(status_code=503, detail="Chroma server is unreachable")
 
-@app.post("/index")
-def start_indexing():
-    """Kick off a new indexing run unless one is already running."""
+    t0 = time.perf_counter()
+    try:
+        result = _run_exclusive(_export_snapshot, col, target)
+    except HTTPException:
+        raise
+    except Exception as exc:
+        logger.exception("Snapshot export failed")
+        raise HTTPException(status_code=500, detail=f"Export failed: {exc}")
 
-    with _progress_lock:
-        if _progress.status == "running":
-            logger.warning("Received /index request but an indexing run is already in progress")
-            raise HTTPException(status_code=409, detail="Indexing already in progress")
+    logger.info(
+        "Exported %d chunks of %d files to %s in %.2fs",
+        result["chunks"],
+        result["files"],
+        result["path"],
+        time.perf_counter() - t0,
+    )
+    return result
 
-    logger.info("Received /index request – starting background indexing thread")
 
-    threading.Thread(target=_run_indexing, daemon=True).start()
-    return {"detail": "Indexing started"}
+@app.post("/index/import")
+def import_index(req: SnapshotRequest | None = None) -> Dict[str, Any]:
+    """Bulk-load a snapshot; files changed since the export are left for /index."""
 
+    source = _snapshot_path(req or SnapshotRequest())
+    if not source.is_file():
+        raise HTTPException(status_code=404, detail=f"Snapshot not found: {source}")
 
-@app.get("/index/status")
-def index_status() -> Dict[str, Any]:
-    """Return progress of the current/last indexing run."""
+    col = _ensure_remote_collection()
+    if col is None:
+        raise HTTPException(status_code=503, detail="Chroma server is unreachable")
 
-    with _progress_lock:
-        status = _progress.asdict()
+    t0 = time.perf_counter()
+    try:
+        result = _run_exclusive(_import_snapshot, col, source)
+    except HTTPException:
+        raise
+    except ValueError as exc:
+        raise HTTPException(status_code=409, detail=str(exc))
+    except Exception as exc:
+        logger.exception("Snapshot import failed")
+        raise HTTPException(status_code=500, detail=f"Import failed: {exc}")
 
-    logger.debug("Status request served: %s", status)
-    return status
+    _get_shared_state().bump_generation("index")
+    logger.info(
+        "Imported %d chunks of %d files from %s in %.2fs (%d stale files left for re-indexing)",
+        result["chunks"],
+        result["files"],
+        result["path"],
+        time.perf_counter() - t0,
+        result["stale_files"],
+    )
+    return result
 
 
 # ---------------------------------------------------------------------------
@@ -988,6 +5150,133 @@ def index_status() -> Dict[str, Any]:
 # ---------------------------------------------------------------------------
 
 
+# Over-fetch factor applied when hits may be dropped after the query (result
+# collapsing or a prefix that cannot be pushed down) and the upper bound for
+# the widened *n_results*.
+SEARCH_OVERFETCH = 3
+SEARCH_MAX_RESULTS = int(os.getenv("CODEX_SEARCH_MAX_RESULTS", "200"))
+
+# Metadata keys that only matter to the indexer and are stripped from
+# /search responses to keep payloads small.
+_INTERNAL_METADATA_KEYS = {"sha1", "n_chunks", "schema"}
+
+
+def _build_search_where(req: SearchRequest) -> tuple[Dict[str, Any] | None, str | None]:
+    """Translate the filters of *req* into a Chroma ``where`` clause.
+
+    Returns ``(where, residual_prefix)`` – the second element is a path prefix
+    that could not be expressed in the store (not found in the working tree
+    or deeper than *PATH_PREFIX_DEPTH*) and must be applied to the hits
+    instead, see `_under_prefix`.
+    """
+
+    clauses: List[Dict[str, Any]] = []
+    residual: str | None = None
+    roots = _ws().roots
+
+    if req.root:
+        roots = [r for r in roots if req.root in (str(r), r.name)]
+        if not roots:
+            raise HTTPException(status_code=400, detail=f"Unknown workspace root: {req.root}")
+        clauses.append({"root": {"$eq": str(roots[0])}})
+
+    if req.extensions:
+        exts = sorted({e.lower() if e.startswith(".") else f".{e.lower()}" for e in req.extensions})
+        clauses.append({"ext": {"$in": exts}} if len(exts) > 1 else {"ext": {"$eq": exts[0]}})
+
+    prefix = (req.path_prefix or "").strip().removeprefix("./").strip("/")
+    if prefix:
+        parts = prefix.split("/")
+
+        if any((r / prefix).is_file() for r in roots):
+            clauses.append({"path": {"$eq": prefix}})
+        elif len(parts) <= PATH_PREFIX_DEPTH and any((r / prefix).is_dir() for r in roots):
+            clauses.append({f"dir_{len(parts)}": {"$eq": prefix}})
+        else:
+            # Push down the deepest directory we can and match the remainder
+            # on the returned hits.
+            depth = min(len(parts) - 1, PATH_PREFIX_DEPTH)
+            if depth:
+                clauses.append({f"dir_{depth}": {"$eq": "/".join(parts[:depth])}})
+            residual = prefix
+
+    if not clauses:
+        return None, residual
+
+    return (clauses[0] if len(clauses) == 1 else {"$and": clauses}), residual
+
+
+def _under_prefix(path: str, prefix: str) -> bool:
+    """Return whether *path* is *prefix* or lies below it.
+
+    Whole path segments are compared like the ``dir_<n>`` pushdown does –
+    ``src`` matches ``src/app.py`` but neither ``src2/app.py`` nor ``srcfoo.py``.
+    """
+
+    prefix = prefix.rstrip("/")
+    return path == prefix or path.startswith(prefix + "/")
+
+
+def _public_metadata(meta: Dict[str, Any]) -> Dict[str, Any]:
+    """Return *meta* without indexer bookkeeping and ``dir_<n>`` keys."""
+
+    return {
+        key: value
+        for key, value in meta.items()
+        if key not in _INTERNAL_METADATA_KEYS and not key.startswith("dir_")
+    }
+
+
+def _collapse_hits(
+    docs: List[str], metas: List[Dict[str, Any]], k: int
+) -> tuple[List[str], List[Dict[str, Any]]]:
+    """Merge hits from the same file and return at most *k* distinct files.
+
+    Files are told apart by ``(root, path)`` – roots may hold the same
+    relative paths.  Files keep the rank of their best hit.  Consecutive chunks are stitched
+    together (dropping the *CHUNK_OVERLAP* prefix of the follower) and
+    reported as one line range; non-adjacent chunks of the same file become
+    separate ranges whose text is joined with an ellipsis line.
+    """
+
+    by_file: Dict[tuple[str, str], List[tuple[str, Dict[str, Any]]]] = {}
+    for doc, meta in zip(docs, metas):
+        hits = by_file.setdefault((meta.get("root", ""), meta.get("path", "")), [])
+        if all(m.get("chunk_index") != meta.get("chunk_index") for _, m in hits):
+            hits.append((doc, meta))
+
+    out_docs: List[str] = []
+    out_metas: List[Dict[str, Any]] = []
+
+    for hits in list(by_file.values())[:k]:
+        hits.sort(key=lambda hit: hit[1].get("chunk_index", 0))
+
+        segments: List[str] = []
+        ranges: List[List[int]] = []
+        prev_index: int | None = None
+
+        for doc, meta in hits:
+            index = meta.get("chunk_index", 0)
+            if prev_index is not None and index == prev_index + 1:
+                segments[-1] += doc[CHUNK_OVERLAP:]
+                ranges[-1][1] = meta.get("end_line", ranges[-1][1])
+            else:
+                segments.append(doc)
+                ranges.append([meta.get("start_line", 0), meta.get("end_line", 0)])
+            prev_index = index
+
+        merged = _public_metadata(hits[0][1])
+        for key in ("chunk_index", "start_line", "end_line"):
+            merged.pop(key, None)
+        merged["chunk_indices"] = [m.get("chunk_index") for _, m in hits]
+        merged["line_ranges"] = ranges
+
+        out_docs.append("\n…\n".join(segments))
+        out_metas.append(merged)
+
+    return out_docs, out_metas
+
+
 @app.post("/search", response_model=SearchResponse)
 def search(req: SearchRequest) -> SearchResponse:  # noqa: D401 – FastAPI handler
     """Return the *k* most similar code chunks for *req.query*."""
@@ -1009,37 +5298,96 @@ def search(req: SearchRequest) -> SearchResponse:  # noqa: D401 – FastAPI hand
     # more common *INFO* log level.
     logger.info("/search → k=%d, query=%s", req.k, _preview)
 
-    col = _ensure_remote_collection()
-    if col is None:
-        raise HTTPException(status_code=503, detail="Chroma server is unreachable")
+    # Searches are timed for the QoS controller that paces the indexer.
+    with _search_qos.track():
+        col = _ensure_remote_collection()
+        if col is None:
+            raise HTTPException(status_code=503, detail="Chroma server is unreachable")
+
+        # Embed the incoming query **locally** so we don't rely on the remote
+        # Chroma instance having an embedding function attached – with the
+        # backend the collection was built with, which differs from the
+        # configured one while a rebuild for a new backend is running.
+        backend = (col.metadata or {}).get("backend")
+        if backend == _get_embedding_backend_id():
+            backend = None
+        try:
+            vecs = _embed_texts([req.query], backend)
+        except ValueError as exc:
+            raise HTTPException(
+                status_code=409,
+                detail=f"{exc} – the index is unavailable until it has been rebuilt",
+            )
+        if vecs is None or not len(vecs):
+            raise HTTPException(status_code=500, detail="Failed to embed query text")
 
-    # Embed the incoming query **locally** so we don't rely on the remote
-    # Chroma instance having an embedding function attached.
-    vecs = _embed_texts([req.query])
-    if not vecs:
-        raise HTTPException(status_code=500, detail="Failed to embed query text")
+        # Queries go through the projection the collection was built with.
+        try:
+            projection = _projection_for(_collection_projection_id(col))
+        except ValueError as exc:
+            raise HTTPException(status_code=409, detail=f"{exc} – re-run /index")
+        if projection is not None:
+            if vecs.shape[1] != projection.source_dim:
+                raise HTTPException(
+                    status_code=409,
+                    detail=f"Index was built with {projection.identity} for a different "
+                    "embedding backend – re-run /index",
+                )
+            vecs = projection.apply(vecs)
 
-    try:
-        res = col.query(
-            query_embeddings=vecs,
-            n_results=req.k,
-            include=["documents", "metadatas"],
-        )
+        where, residual_prefix = _build_search_where(req)
 
-        docs = res.get("documents", [[]])[0]
-        metas = res.get("metadatas", [[]])[0]
+        # Hits may be dropped after the query – over-fetch so that we can still
+        # return *k* distinct results and widen the window if that was not enough.
+        n_results = req.k * (SEARCH_OVERFETCH if req.collapse or residual_prefix else 1)
+
+        try:
+            while True:
+                n_results = min(n_results, SEARCH_MAX_RESULTS)
+
+                res = col.query(
+                    query_embeddings=vecs,
+                    n_results=n_results,
+                    include=["documents", "metadatas"],
+                    **({"where": where} if where else {}),
+                )
 
-        # Provide visibility into the outcome as well so that the log entry
-        # from above forms a clear request/response pair which greatly helps
-        # when grepping through historical logs.
-        hit_count = len(docs)
-        logger.debug("/search produced %d hits", hit_count)
-        logger.info("/search ← %d hits", hit_count)
+                docs = res.get("documents", [[]])[0]
+                metas = res.get("metadatas", [[]])[0]
+                exhausted = len(docs) < n_results or n_results >= SEARCH_MAX_RESULTS
+
+                if residual_prefix:
+                    kept = [
+                        (d, m)
+                        for d, m in zip(docs, metas)
+                        if _under_prefix(m.get("path", ""), residual_prefix)
+                    ]
+                    docs, metas = [d for d, _ in kept], [m for _, m in kept]
+
+                if req.collapse:
+                    docs, metas = _collapse_hits(docs, metas, req.k)
+                else:
+                    docs = docs[: req.k]
+                    metas = [_public_metadata(m) for m in metas[: req.k]]
+
+                if len(docs) >= req.k or exhausted:
+                    break
+
+                n_results *= 2
+
+            # Provide visibility into the outcome as well so that the log entry
+            # from above forms a clear request/response pair which greatly helps
+            # when grepping through historical logs.
+            hit_count = len(docs)
+            logger.debug(
+                "/search produced %d hits (where=%s, n_results=%d)", hit_count, where, n_results
+            )
+            logger.info("/search ← %d hits", hit_count)
 
-        return SearchResponse(documents=docs, metadatas=metas)
-    except Exception as exc:
-        logger.error("/search failed – %s", exc)
-        raise HTTPException(status_code=500, detail=f"Search failed: {exc}")
+            return SearchResponse(documents=docs, metadatas=metas)
+        except Exception as exc:
+            logger.error("/search failed – %s", exc)
+            raise HTTPException(status_code=500, detail=f"Search failed: {exc}")
 
 
 # Convenience when executed as `python scripts/index_service.py`.
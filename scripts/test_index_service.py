@@ -0,0 +1,1447 @@
+"""Tests for the index service (run with ``python -m pytest scripts``)."""
+
+from __future__ import annotations
+
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+
+# Generous compared to the ~0.3s a cold import takes – the budget only has to
+# catch a heavy backend being imported at module level again.
+IMPORT_BUDGET_SECONDS = 1.5
+
+
+def test_import_is_fast_and_side_effect_free(tmp_path):
+    log_dir = tmp_path / "logs"
+    state_dir = tmp_path / "state"
+    probe = (
+        "import json, sys, time\n"
+        "t0 = time.perf_counter()\n"
+        "import index_service\n"
+        "elapsed = time.perf_counter() - t0\n"
+        "heavy = [m for m in ('chromadb', 'numpy', 'openai') if m in sys.modules]\n"
+        "print(json.dumps({'elapsed': elapsed, 'heavy': heavy}))\n"
+    )
+    env = {
+        **os.environ,
+        "CODEX_LOG_DIR": str(log_dir),
+        "CODEX_STATE_DIR": str(state_dir),
+        "CODEX_WORKSPACE": str(tmp_path),
+    }
+
+    result = subprocess.run(
+        [sys.executable, "-c", probe],
+        cwd=SCRIPTS_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+
+    assert report["heavy"] == []
+    assert report["elapsed"] < IMPORT_BUDGET_SECONDS, report
+    assert not log_dir.exists()
+    assert not state_dir.exists()
+
+
+def _import_service(monkeypatch, tmp_path, **env):
+    monkeypatch.setenv("CODEX_LOG_DIR", str(tmp_path / "logs"))
+    monkeypatch.setenv("CODEX_STATE_DIR", str(tmp_path / "state"))
+    monkeypatch.setenv("CODEX_WORKSPACE", str(tmp_path))
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.syspath_prepend(str(SCRIPTS_DIR))
+    sys.modules.pop("index_service", None)
+
+    import index_service
+
+    return index_service
+
+
+def test_lease_is_not_reentrant_within_a_worker(monkeypatch, tmp_path):
+    svc = _import_service(monkeypatch, tmp_path)
+    state = svc.SharedState(tmp_path / "lease.sqlite3")
+    first, second = svc._lease_token(), svc._lease_token()
+
+    assert state.try_acquire(first)
+    assert not state.try_acquire(second)
+
+    # Only the token that acquired the lease can release it.
+    state.release(second)
+    assert state.leader()[0] == first
+    state.release(first)
+    assert state.try_acquire(second)
+
+
+def test_memory_reservations_shrink_batches(monkeypatch, tmp_path):
+    svc = _import_service(monkeypatch, tmp_path)
+    governor = svc.MemoryGovernor(budget=None)
+    governor.vector_dim = 20
+    footprint = governor.chunk_footprint
+    assert footprint == svc.CHUNK_SIZE * 2 + 20 * 4 + 1024
+
+    governor.budget = 100 * footprint
+    monkeypatch.setattr(svc.MemoryGovernor, "rss", staticmethod(lambda: 0))
+    assert governor.batch_size(1000) == 100
+
+    governor.reserve(60 * footprint)
+    assert governor.batch_size(1000) == 40
+    governor.release(60 * footprint)
+    assert governor.batch_size(1000) == 100
+
+
+@pytest.mark.parametrize("fail", [False, True])
+def test_index_runs_release_their_memory_reservations(monkeypatch, tmp_path, fail):
+    chromadb = pytest.importorskip("chromadb")
+
+    for name in ("alpha", "beta"):
+        (tmp_path / f"{name}.py").write_text(f"print('{name}')\n" * 200)
+
+    svc = _import_service(monkeypatch, tmp_path, CODEX_INDEX_ENUMERATION="walk")
+    client = chromadb.EphemeralClient()
+    monkeypatch.setattr(svc, "_remote_client", lambda: client)
+
+    flushed = []
+
+    def _flush(writer):
+        # Memory of the pending chunks is reserved until they are written.
+        flushed.append(svc._memory_governor.reserved)
+        if fail:
+            raise RuntimeError("store unavailable")
+        flush(writer)
+
+    flush = svc.WriteCoalescer.flush
+    monkeypatch.setattr(svc.WriteCoalescer, "flush", _flush)
+
+    svc._run_indexing()
+    assert svc._ws().progress.status == ("error" if fail else "completed")
+    # The footprint follows the dimension of the hash fallback backend.
+    assert svc._memory_governor.vector_dim == 20
+    assert max(flushed) > 0
+    assert svc._memory_governor.reserved == 0
+
+
+def test_snapshot_operation_blocks_index_runs(monkeypatch, tmp_path):
+    from fastapi import HTTPException
+    from fastapi.testclient import TestClient
+
+    svc = _import_service(monkeypatch, tmp_path)
+    started, finish = threading.Event(), threading.Event()
+
+    def _slow_import():
+        started.set()
+        finish.wait(5)
+
+    worker = threading.Thread(target=svc._run_exclusive, args=(_slow_import,))
+    worker.start()
+    assert started.wait(5)
+
+    try:
+        assert TestClient(svc.app).post("/index").status_code == 409
+        try:
+            svc._run_exclusive(lambda: None)
+        except HTTPException as exc:
+            assert exc.status_code == 409
+        else:
+            raise AssertionError("a second exclusive operation was admitted")
+    finally:
+        finish.set()
+        worker.join()
+
+    # Lease and busy marker are gone once the operation finished.
+    assert svc._get_shared_state().leader() is None
+    assert svc._ws().operation is None
+
+
+def _wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+def test_workspaces_index_at_once_and_queue_their_own_runs(monkeypatch, tmp_path):
+    from fastapi.testclient import TestClient
+
+    chromadb = pytest.importorskip("chromadb")
+
+    primary, other = tmp_path / "app", tmp_path / "other"
+    for root in (primary, other):
+        root.mkdir()
+        (root / "main.py").write_text(f"print('{root.name}')\n")
+
+    svc = _import_service(
+        monkeypatch, tmp_path, CODEX_WORKSPACE=str(primary), CODEX_INDEX_ENUMERATION="walk"
+    )
+    client = chromadb.EphemeralClient()
+    monkeypatch.setattr(svc, "_remote_client", lambda: client)
+    http = TestClient(svc.app)
+
+    gate = threading.Event()
+    embed = svc._embed_texts
+
+    def _gated_embed(texts, backend=None):
+        gate.wait(10)
+        return embed(texts, backend)
+
+    monkeypatch.setattr(svc, "_embed_texts", _gated_embed)
+
+    ws_id = http.post("/workspaces", json={"path": str(other)}).json()["id"]
+    assert http.post("/index").json()["detail"] == "Indexing started"
+    assert http.post(f"/workspaces/{ws_id}/index").json()["detail"] == "Indexing started"
+
+    # A second request for a busy workspace waits for its run to finish.
+    response = http.post("/index", params={"full": True})
+    assert response.status_code == 200
+    assert response.json()["detail"] == "Indexing queued"
+    assert http.get("/index/status").json()["queued_run"] == {"full": True, "rebuild": False}
+    for prefix in ("", f"/workspaces/{ws_id}"):
+        status = http.get(f"{prefix}/index/status").json()
+        assert status["status"] in ("queued", "running")
+    assert status["queued_run"] is None
+
+    gate.set()
+
+    def _done(prefix, generation):
+        status = http.get(f"{prefix}/index/status").json()
+        return status["status"] == "completed" and status["generation"] == generation
+
+    _wait_for(lambda: _done("", 2) and _done(f"/workspaces/{ws_id}", 1))
+    assert http.get("/index/status").json()["queued_run"] is None
+
+
+def test_rebuild_of_multi_root_workspace_goes_live(monkeypatch, tmp_path):
+    chromadb = pytest.importorskip("chromadb")
+
+    primary, sibling = tmp_path / "app", tmp_path / "backend"
+    for root, body, lines in ((primary, "frontend", 80), (sibling, "backend", 400)):
+        (root / "src").mkdir(parents=True)
+        # Same relative paths in both roots, different chunk counts.
+        (root / "README.md").write_text(f"# {body}\n" + f"{body} notes\n" * lines)
+        (root / "src" / "main.py").write_text(f"print('{body}')\n")
+
+    svc = _import_service(
+        monkeypatch,
+        tmp_path,
+        CODEX_WORKSPACE=str(primary),
+        CODEX_EXTRA_PATHS=str(sibling),
+        CODEX_INDEX_ENUMERATION="walk",
+    )
+    client = chromadb.EphemeralClient()
+    monkeypatch.setattr(svc, "_remote_client", lambda: client)
+
+    svc._run_indexing()
+    assert svc._ws().progress.status == "completed", svc._ws().progress.error
+    live = svc._live_collection_name()
+
+    svc._run_indexing(rebuild=True)
+    assert svc._ws().progress.status == "completed", svc._ws().progress.error
+
+    rebuilt = svc._live_collection_name()
+    assert rebuilt != live
+    assert len(svc._load_manifest(client.get_collection(rebuilt), by_root=True)) == 4
+
+
+def test_rebuilds_keep_retired_versions_for_the_grace_period(monkeypatch, tmp_path):
+    chromadb = pytest.importorskip("chromadb")
+
+    (tmp_path / "main.py").write_text("print('hello')\n")
+    svc = _import_service(
+        monkeypatch, tmp_path, CODEX_INDEX_ENUMERATION="walk", CODEX_INDEX_ALIAS_GRACE="3600"
+    )
+    client = chromadb.EphemeralClient()
+    monkeypatch.setattr(svc, "_remote_client", lambda: client)
+    ws = svc._ws()
+
+    svc._run_indexing()
+    versions = [svc._live_collection_name()]
+    for _ in range(2):
+        svc._run_indexing(rebuild=True)
+        assert ws.progress.status == "completed", ws.progress.error
+        versions.append(svc._live_collection_name())
+
+    # Opening the second shadow must not drop the version retired by the first.
+    assert sorted(svc._collection_versions(ws)) == sorted(versions)
+
+    monkeypatch.setattr(svc, "ALIAS_GRACE_SECONDS", 0)
+    svc._drop_versions(ws)
+    assert svc._collection_versions(ws) == [versions[-1]]
+    assert set(ws.state.read_aliases()) == {"live"}
+
+
+def test_search_keeps_working_while_rebuilding_for_a_new_backend(monkeypatch, tmp_path):
+    from fastapi.testclient import TestClient
+
+    chromadb = pytest.importorskip("chromadb")
+    np = pytest.importorskip("numpy")
+
+    (tmp_path / "src").mkdir()
+    for name in ("alpha", "beta", "gamma"):
+        (tmp_path / "src" / f"{name}.py").write_text(f"def {name}():\n    return '{name}'\n")
+
+    svc = _import_service(monkeypatch, tmp_path, CODEX_INDEX_ENUMERATION="walk")
+    client = chromadb.EphemeralClient()
+    monkeypatch.setattr(svc, "_remote_client", lambda: client)
+    http = TestClient(svc.app)
+
+    svc._run_indexing()
+    old = svc._live_collection_name()
+    assert client.get_collection(old).metadata["backend"] == "sha1-hash:20"
+
+    # Switch the configured backend to one with another dimensionality.
+    def _other_backend(batch):
+        return np.ones((len(batch), 8), dtype=np.float32)
+
+    monkeypatch.setattr(svc, "_embedding_function", _other_backend)
+    monkeypatch.setattr(svc, "_embedding_backend_id", "test:8")
+
+    assert http.get("/index/plan").json()["rebuild"] is True
+    response = http.post("/search", json={"query": "alpha", "k": 2})
+    assert response.status_code == 200, response.text
+    assert len(response.json()["documents"]) == 2
+
+    svc._run_indexing()
+    assert svc._ws().progress.status == "completed", svc._ws().progress.error
+    assert svc._live_collection_name() != old
+    assert http.post("/search", json={"query": "alpha", "k": 2}).status_code == 200
+
+    # A collection whose backend cannot be recreated is reported, not a 500.
+    live = client.get_collection(svc._live_collection_name())
+    live.modify(metadata={**live.metadata, "backend": "openai:unavailable"})
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    assert http.post("/search", json={"query": "alpha", "k": 2}).status_code == 409
+
+
+def test_list_returning_backends_are_stored_as_float32(monkeypatch, tmp_path):
+    from fastapi.testclient import TestClient
+
+    chromadb = pytest.importorskip("chromadb")
+    np = pytest.importorskip("numpy")
+    from chromadb.api.models.Collection import Collection
+
+    (tmp_path / "src").mkdir()
+    for name in ("alpha", "beta", "gamma"):
+        (tmp_path / "src" / f"{name}.py").write_text(f"def {name}():\n    return '{name}'\n")
+
+    svc = _import_service(monkeypatch, tmp_path, CODEX_INDEX_ENUMERATION="walk")
+    client = chromadb.EphemeralClient()
+    monkeypatch.setattr(svc, "_remote_client", lambda: client)
+
+    # Backends such as the OpenAI client return plain lists of Python floats.
+    def _list_backend(batch):
+        return [[(len(text) + i) / 100 for i in range(8)] for text in batch]
+
+    monkeypatch.setattr(svc, "_embedding_function", _list_backend)
+    monkeypatch.setattr(svc, "_embedding_backend_id", "test-list:8")
+
+    upserted = []
+    upsert = Collection.upsert
+
+    def _upsert(self, *args, **kwargs):
+        upserted.append(kwargs.get("embeddings"))
+        return upsert(self, *args, **kwargs)
+
+    monkeypatch.setattr(Collection, "upsert", _upsert)
+
+    svc._run_indexing()
+    assert svc._ws().progress.status == "completed", svc._ws().progress.error
+    assert upserted
+    for embeddings in upserted:
+        assert isinstance(embeddings, np.ndarray)
+        assert embeddings.dtype == np.float32
+        assert embeddings.shape[1] == 8
+
+    response = TestClient(svc.app).post("/search", json={"query": "alpha", "k": 2})
+    assert response.status_code == 200, response.text
+    assert len(response.json()["documents"]) == 2
+
+
+def _git(root, *args, check=True):
+    subprocess.run(
+        ["git", "-C", str(root), *args],
+        check=check,
+        capture_output=True,
+        env={
+            **os.environ,
+            "GIT_AUTHOR_NAME": "test",
+            "GIT_AUTHOR_EMAIL": "test@example.com",
+            "GIT_COMMITTER_NAME": "test",
+            "GIT_COMMITTER_EMAIL": "test@example.com",
+        },
+    )
+
+
+def _git_index_entries(root):
+    """``{path: (mode, size)}`` of the stage 0 index entries as git reports them."""
+
+    def _ls(*args):
+        return subprocess.run(
+            ["git", "-C", str(root), "ls-files", *args], check=True, capture_output=True, text=True
+        ).stdout.splitlines()
+
+    modes = {}
+    for line in _ls("-s"):
+        info, path = line.split("\t", 1)
+        mode, _sha, stage = info.split()
+        if stage == "0":
+            modes[path] = int(mode, 8)
+
+    sizes, path = {}, None
+    for line in _ls("--debug"):
+        if not line.startswith(" "):
+            path = line
+        elif line.strip().startswith("size:"):
+            sizes.setdefault(path, int(line.split()[1]))
+
+    return {path: (mode, sizes[path]) for path, mode in modes.items()}
+
+
+@pytest.mark.parametrize("version", [2, 3, 4])
+def test_git_index_parser_matches_git(monkeypatch, tmp_path, version):
+    repo = tmp_path / "repo"
+    (repo / "src" / "components" / "deeply" / "nested").mkdir(parents=True)
+    _git(repo, "init", "-q", "-b", "main")
+
+    # Names of every length exercise the entry padding, shared prefixes the
+    # path compression of version 4.
+    for n in range(1, 12):
+        (repo / ("f" * n)).write_text("x" * n)
+    for name in ("index.ts", "index.tsx", "indexer.ts", "deeply/nested/view.vue"):
+        (repo / "src" / "components" / name).write_text(f"// {name}\n")
+    (repo / "run.sh").write_text("#!/bin/sh\n")
+    (repo / "run.sh").chmod(0o755)
+    (repo / "link").symlink_to("run.sh")
+    (repo / "conflict.txt").write_text("base\n")
+    _git(repo, "add", ".")
+    _git(repo, "commit", "-qm", "base")
+
+    # An unresolved merge leaves stage 1-3 entries of conflict.txt behind.
+    _git(repo, "checkout", "-qb", "other")
+    (repo / "conflict.txt").write_text("other\n")
+    _git(repo, "commit", "-qam", "other")
+    _git(repo, "checkout", "-q", "main")
+    (repo / "conflict.txt").write_text("main\n")
+    _git(repo, "commit", "-qam", "main")
+    _git(repo, "merge", "-q", "other", check=False)
+
+    if version >= 3:
+        # Intent-to-add entries carry extended flags (version 3 and later).
+        (repo / "src" / "later.py").write_text("pass\n")
+        _git(repo, "add", "-N", "src/later.py")
+    _git(repo, "update-index", "--index-version", str(version))
+
+    index = repo / ".git" / "index"
+    assert int.from_bytes(index.read_bytes()[4:8], "big") == version
+
+    svc = _import_service(monkeypatch, tmp_path)
+    stats = svc._read_git_index_stats(index)
+    expected = _git_index_entries(repo)
+
+    assert "conflict.txt" not in stats
+    assert ("src/later.py" in stats) == (version >= 3)
+    assert stats == expected
+
+
+def test_stale_git_index_sizes_are_not_trusted(monkeypatch, tmp_path):
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    _git(repo, "init", "-q")
+    (repo / "shrunk.json").write_text("[" + "0," * 200_000 + "0]")
+    (repo / "grown.json").write_text("[]")
+    (repo / "large.json").write_text("[" + "0," * 200_000 + "0]")
+    _git(repo, "add", ".")
+    _git(repo, "commit", "-qm", "initial")
+
+    (repo / "shrunk.json").write_text("[1, 2, 3]")
+    (repo / "grown.json").write_text("[" + "1," * 200_000 + "1]")
+
+    svc = _import_service(monkeypatch, tmp_path, CODEX_WORKSPACE=str(repo))
+    sizes = {fp.name: size for fp, size in svc._iter_git_files(repo)}
+    assert sizes == {"shrunk.json": None, "grown.json": None, "large.json": 400_003}
+
+    skipped = {}
+    files = {fp.name for fp in svc._iter_source_files([repo], skipped)}
+    assert files == {"shrunk.json", "grown.json"}
+    assert skipped == {(str(repo), "large.json"): ("oversized", 400_003)}
+
+    # The size of modified files is checked on the single read.
+    chromadb = pytest.importorskip("chromadb")
+    client = chromadb.EphemeralClient()
+    monkeypatch.setattr(svc, "_remote_client", lambda: client)
+    svc._run_indexing()
+    col = client.get_collection(svc._live_collection_name())
+    assert set(svc._load_manifest(col)) == {"shrunk.json"}
+
+
+def _stored_ids(col, root, path):
+    where = {"$and": [{"root": {"$eq": str(root)}}, {"path": {"$eq": path}}]}
+    return sorted(col.get(where=where)["ids"])
+
+
+def test_incremental_runs_only_touch_their_own_root(monkeypatch, tmp_path):
+    chromadb = pytest.importorskip("chromadb")
+
+    primary, sibling = tmp_path / "app", tmp_path / "backend"
+    for root, body in ((primary, "frontend"), (sibling, "backend")):
+        (root / "src").mkdir(parents=True)
+        # Same relative paths in both roots.
+        (root / "README.md").write_text(f"# {body}\n" + f"{body} notes\n" * 80)
+        (root / "src" / "main.py").write_text(f"print('{body}')\n")
+        _git(root, "init", "-q")
+        _git(root, "add", "-A")
+        _git(root, "commit", "-qm", "initial")
+
+    svc = _import_service(
+        monkeypatch, tmp_path, CODEX_WORKSPACE=str(primary), CODEX_EXTRA_PATHS=str(sibling)
+    )
+    client = chromadb.EphemeralClient()
+    monkeypatch.setattr(svc, "_remote_client", lambda: client)
+
+    embedded = []
+    embed = svc._embed_texts
+    monkeypatch.setattr(
+        svc, "_embed_texts", lambda texts, backend=None: embedded.extend(texts) or embed(texts, backend)
+    )
+
+    svc._run_indexing()
+    assert svc._ws().progress.status == "completed", svc._ws().progress.error
+    col = client.get_collection(svc._live_collection_name())
+    backend_readme = _stored_ids(col, sibling, "README.md")
+    assert backend_readme
+
+    # A deletion in one root leaves the same path of the other root alone.
+    _git(primary, "rm", "-q", "README.md")
+    _git(primary, "commit", "-qm", "drop readme")
+    embedded.clear()
+
+    svc._run_indexing()
+    assert svc._ws().progress.status == "completed", svc._ws().progress.error
+    assert svc._ws().progress.total_files == 0  # diff-only run
+    assert _stored_ids(col, primary, "README.md") == []
+    assert _stored_ids(col, sibling, "README.md") == backend_readme
+    assert embedded == []
+
+    # A rename moves the chunks of its own root only – without re-embedding.
+    frontend_main = _stored_ids(col, primary, "src/main.py")
+    _git(sibling, "mv", "src/main.py", "src/server.py")
+    _git(sibling, "commit", "-qm", "rename")
+
+    svc._run_indexing()
+    assert svc._ws().progress.status == "completed", svc._ws().progress.error
+    assert svc._ws().progress.total_files == 1
+    assert embedded == []
+    assert _stored_ids(col, primary, "src/main.py") == frontend_main
+    assert _stored_ids(col, sibling, "src/main.py") == []
+    assert _stored_ids(col, sibling, "src/server.py") == [f"{sibling / 'src' / 'server.py'}:0"]
+
+
+def test_plan_never_creates_the_collection(monkeypatch, tmp_path):
+    from fastapi.testclient import TestClient
+
+    chromadb = pytest.importorskip("chromadb")
+
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    _git(repo, "init", "-q")
+    for name in ("alpha", "beta"):
+        (repo / f"{name}.py").write_text(f"print('{name}')\n")
+    _git(repo, "add", ".")
+    _git(repo, "commit", "-qm", "initial")
+
+    svc = _import_service(monkeypatch, tmp_path, CODEX_WORKSPACE=str(repo))
+    client = chromadb.EphemeralClient()
+    monkeypatch.setattr(svc, "_remote_client", lambda: client)
+    http = TestClient(svc.app)
+
+    plan = http.get("/index/plan").json()
+    assert (plan["mode"], plan["collection_missing"], plan["files"]["added"]) == ("full", True, 2)
+    assert svc._collection_versions(svc._ws()) == []
+
+    svc._run_indexing()
+    assert http.get("/index/plan").json()["collection_missing"] is False
+
+    # Once the collection is gone the next run has to visit every file, not
+    # only the ones git reports as changed.
+    client.delete_collection(svc._live_collection_name())
+    assert http.get("/index/plan").json()["mode"] == "full"
+    svc._run_indexing()
+    assert svc._ws().progress.total_files == 2
+    assert client.get_collection(svc._live_collection_name()).count() == 2
+
+
+def test_full_runs_and_plan_tell_roots_apart(monkeypatch, tmp_path):
+    chromadb = pytest.importorskip("chromadb")
+    from fastapi.testclient import TestClient
+
+    primary, sibling = tmp_path / "app", tmp_path / "backend"
+    for offset, (root, body) in enumerate(((primary, "frontend"), (sibling, "backend"))):
+        root.mkdir()
+        (root / "README.md").write_text(f"# {body}\n" + f"{body} notes\n" * 80)
+        os.utime(root / "README.md", (1_700_000_000 + offset, 1_700_000_000 + offset))
+
+    svc = _import_service(
+        monkeypatch,
+        tmp_path,
+        CODEX_WORKSPACE=str(primary),
+        CODEX_EXTRA_PATHS=str(sibling),
+        CODEX_INDEX_ENUMERATION="walk",
+    )
+    client = chromadb.EphemeralClient()
+    monkeypatch.setattr(svc, "_remote_client", lambda: client)
+
+    embedded = []
+    embed = svc._embed_texts
+    monkeypatch.setattr(
+        svc, "_embed_texts", lambda texts, backend=None: embedded.extend(texts) or embed(texts, backend)
+    )
+
+    svc._run_indexing()
+    assert svc._ws().progress.status == "completed", svc._ws().progress.error
+    col = client.get_collection(svc._live_collection_name())
+    backend_readme = _stored_ids(col, sibling, "README.md")
+
+    # Nothing changed – nothing is embedded again.
+    embedded.clear()
+    svc._run_indexing()
+    assert embedded == []
+
+    (primary / "README.md").unlink()
+    plan = TestClient(svc.app).get("/index/plan").json()
+    assert plan["files"]["deleted"] == 1
+    assert plan["files"]["unchanged"] == 1
+
+    svc._run_indexing()
+    assert svc._ws().progress.status == "completed", svc._ws().progress.error
+    assert _stored_ids(col, primary, "README.md") == []
+    assert _stored_ids(col, sibling, "README.md") == backend_readme
+    assert embedded == []
+
+
+class _FailingUpserts:
+    """Collection proxy whose writes fail – the import must not lose data."""
+
+    def __init__(self, col):
+        self._col = col
+
+    def __getattr__(self, name):
+        return getattr(self._col, name)
+
+    def upsert(self, **kwargs):
+        raise RuntimeError("store unavailable")
+
+
+def test_snapshot_round_trip_of_multi_root_workspace(monkeypatch, tmp_path):
+    chromadb = pytest.importorskip("chromadb")
+    from fastapi.testclient import TestClient
+
+    primary, sibling = tmp_path / "app", tmp_path / "backend"
+    for root, body in ((primary, "frontend"), (sibling, "backend")):
+        (root / "src").mkdir(parents=True)
+        (root / "README.md").write_text(f"# {body}\n" + f"{body} notes\n" * 80)
+        (root / "src" / "main.py").write_text(f"print('{body}')\n")
+
+    svc = _import_service(
+        monkeypatch,
+        tmp_path,
+        CODEX_WORKSPACE=str(primary),
+        CODEX_EXTRA_PATHS=str(sibling),
+        CODEX_INDEX_ENUMERATION="walk",
+    )
+    client = chromadb.EphemeralClient()
+    monkeypatch.setattr(svc, "_remote_client", lambda: client)
+    http = TestClient(svc.app)
+
+    svc._run_indexing()
+    col = client.get_collection(svc._live_collection_name())
+    before = sorted(col.get()["ids"])
+
+    exported = http.post("/index/export")
+    assert exported.status_code == 200, exported.text
+    assert exported.json()["files"] == 4
+
+    # A failing write leaves the stored chunks untouched.
+    ensure = svc._ensure_remote_collection
+    monkeypatch.setattr(svc, "_ensure_remote_collection", lambda: _FailingUpserts(ensure()))
+    assert http.post("/index/import").status_code == 500
+    assert sorted(col.get()["ids"]) == before
+
+    # A chunk left over from a longer version of a loaded file goes away.
+    leftover = col.get(ids=[before[0]], include=["embeddings", "documents", "metadatas"])
+    col.add(
+        ids=[before[0].rsplit(":", 1)[0] + ":99"],
+        documents=leftover["documents"],
+        metadatas=[{**leftover["metadatas"][0], "chunk_index": 99}],
+        embeddings=leftover["embeddings"],
+    )
+
+    monkeypatch.setattr(svc, "_ensure_remote_collection", ensure)
+    imported = http.post("/index/import")
+    assert imported.status_code == 200, imported.text
+    assert imported.json()["files"] == 4
+    assert imported.json()["stale_files"] == 0
+    assert sorted(col.get()["ids"]) == before
+
+
+@pytest.mark.parametrize(
+    "body", [{"name": "../escape.snapshot"}, {"name": "/tmp/escape.snapshot"}, {"name": ".."}]
+)
+def test_snapshot_names_stay_in_the_snapshot_directory(monkeypatch, tmp_path, body):
+    from fastapi.testclient import TestClient
+
+    svc = _import_service(monkeypatch, tmp_path)
+    http = TestClient(svc.app)
+
+    assert http.post("/index/export", json=body).status_code == 400
+    assert http.post("/index/import", json=body).status_code == 400
+    # Filesystem paths are no longer accepted at all.
+    assert http.post("/index/import", json={"path": "/etc/passwd"}).status_code == 422
+    assert svc._snapshot_path(svc.SnapshotRequest(name="warm.snapshot")) == (
+        tmp_path / "state" / "snapshots" / "warm.snapshot"
+    ).resolve()
+
+
+def test_snapshot_import_checks_the_collection_backend(monkeypatch, tmp_path):
+    chromadb = pytest.importorskip("chromadb")
+    from fastapi.testclient import TestClient
+
+    (tmp_path / "main.py").write_text("print('hello')\n")
+    svc = _import_service(monkeypatch, tmp_path, CODEX_INDEX_ENUMERATION="walk")
+    client = chromadb.EphemeralClient()
+    monkeypatch.setattr(svc, "_remote_client", lambda: client)
+    http = TestClient(svc.app)
+
+    svc._run_indexing()
+    assert http.post("/index/export").status_code == 200
+
+    # The configured backend changed, but the live collection still holds
+    # the snapshot's vectors until it has been rebuilt.
+    monkeypatch.setattr(svc, "_embedding_backend_id", "test:8")
+    assert http.post("/index/import").status_code == 200
+
+    live = client.get_collection(svc._live_collection_name())
+    live.modify(metadata={**live.metadata, "backend": "test:8"})
+    response = http.post("/index/import")
+    assert response.status_code == 409
+    assert "test:8" in response.json()["detail"]
+
+
+def test_collapse_keeps_files_of_different_roots_apart(monkeypatch, tmp_path):
+    svc = _import_service(monkeypatch, tmp_path)
+    overlap = svc.CHUNK_OVERLAP
+
+    def _hit(root, path, index):
+        meta = {"root": root, "path": path, "chunk_index": index}
+        meta.update(start_line=index * 10 + 1, end_line=index * 10 + 12, sha1="x")
+        return "o" * overlap + f"{root}:{path}:{index}", meta
+
+    hits = [
+        _hit("/app", "README.md", 0),
+        _hit("/backend", "README.md", 3),
+        _hit("/app", "README.md", 1),
+        _hit("/app", "main.py", 0),
+        _hit("/backend", "README.md", 3),
+    ]
+    docs, metas = svc._collapse_hits([doc for doc, _ in hits], [meta for _, meta in hits], k=2)
+
+    files = [(m["root"], m["path"]) for m in metas]
+    assert files == [("/app", "README.md"), ("/backend", "README.md")]
+    assert metas[0]["chunk_indices"] == [0, 1]
+    assert metas[0]["line_ranges"] == [[1, 22]]
+    assert metas[1]["chunk_indices"] == [3]
+    assert "sha1" not in metas[0]
+    assert docs[0] == "o" * overlap + "/app:README.md:0/app:README.md:1"
+
+
+def test_search_filters_are_pushed_down(monkeypatch, tmp_path):
+    from fastapi import HTTPException
+
+    primary, sibling = tmp_path / "app", tmp_path / "backend"
+    for root in (primary, sibling):
+        (root / "src" / "api").mkdir(parents=True)
+        (root / "src" / "api" / "main.py").write_text("print('main')\n")
+
+    svc = _import_service(
+        monkeypatch, tmp_path, CODEX_WORKSPACE=str(primary), CODEX_EXTRA_PATHS=str(sibling)
+    )
+
+    def _where(**filters):
+        return svc._build_search_where(svc.SearchRequest(query="q", **filters))
+
+    assert _where() == (None, None)
+    assert _where(root="backend", extensions=["py", ".TS"], path_prefix="./src/") == (
+        {
+            "$and": [
+                {"root": {"$eq": str(sibling)}},
+                {"ext": {"$in": [".py", ".ts"]}},
+                {"dir_1": {"$eq": "src"}},
+            ]
+        },
+        None,
+    )
+    assert _where(extensions=["py"]) == ({"ext": {"$eq": ".py"}}, None)
+    assert _where(path_prefix="src/api/main.py") == ({"path": {"$eq": "src/api/main.py"}}, None)
+    # Prefixes not aligned to a directory keep the deepest directory pushed
+    # down and are matched on the hits.
+    assert _where(path_prefix="src/ap") == ({"dir_1": {"$eq": "src"}}, "src/ap")
+    assert _where(path_prefix="sr") == (None, "sr")
+
+    with pytest.raises(HTTPException) as exc:
+        _where(root="frontend")
+    assert exc.value.status_code == 400
+
+
+_BLOB = b"\n".join([b"A" * 300] * 10)
+
+CLASSIFIER_CASES = [
+    ("src/main.py", 12, b"print('hi')\n", None),
+    ("web/package-lock.json", 20, b'{"lockfileVersion": 3}', "lockfile"),
+    ("static/logo.svg", 20, b"<svg></svg>", "asset"),
+    ("dist/app.min.js", 20, b"var a=1;", "minified"),
+    ("src/vendor.js", 4000, b"var a=1;" * 500, "minified"),
+    ("src/icons.ts", len(_BLOB), _BLOB, "minified"),
+    ("fixtures/users.csv", 20, b"id,name\n", "data"),
+    ("config/large.yaml", 300 * 1024, b"key: value\n", "oversized"),
+    ("data/large.json", 300 * 1024, b"{}", None),
+    ("data/huge.json", 2 * 1024**2, b"{}", "oversized"),
+    ("api/client.ts", 60, b"// Code generated by openapi-gen. DO NOT EDIT.\n", "generated"),
+    ("legacy/old.py", 12, b"print('hi')\n", "denied"),
+    ("docs/diagram.svg", 20, b"<svg></svg>", None),
+]
+
+
+@pytest.mark.parametrize(("rel_path", "size", "sample", "expected"), CLASSIFIER_CASES)
+def test_classifier_categories(monkeypatch, tmp_path, rel_path, size, sample, expected):
+    config = tmp_path / "classifier.json"
+    config.write_text(
+        json.dumps({"allow": ["docs/*.svg"], "deny": ["legacy/*"], "size_limits": {".json": "1M"}})
+    )
+    svc = _import_service(monkeypatch, tmp_path, CODEX_INDEX_CLASSIFIER=str(config))
+
+    assert svc._classify_content(rel_path, size, sample) == expected
+
+
+def test_classifier_categories_can_be_disabled(monkeypatch, tmp_path):
+    config = tmp_path / "classifier.json"
+    config.write_text(json.dumps({"disabled_categories": ["generated", "lockfile"]}))
+    svc = _import_service(monkeypatch, tmp_path, CODEX_INDEX_CLASSIFIER=str(config))
+
+    assert svc._classify_content("api/client.ts", 60, b"// @generated\n") is None
+    assert svc._classify_content("yarn.lock", 20, b"# yarn lockfile v1\n") is None
+    assert svc._classify_content("static/logo.png", 20, b"\x89PNG") == "asset"
+
+
+def _lines(tag, n):
+    return "".join(f"{tag} line {i:05d} of the file\n" for i in range(n))
+
+
+def _rewrite_interrupted(monkeypatch, svc, client, fp, text, batches=5):
+    """Rewrite *fp* with *text* and fail the run after *batches* embedded batches.
+
+    With ``CODEX_INDEX_WRITE_BATCH=1`` writes are flushed every 16 chunks (the
+    search QoS floor), so five batches of four get the first part stored.
+    """
+
+    calls, reserved = [], []
+    embed = svc._embed_texts
+
+    def _failing_embed(texts, backend=None):
+        calls.append(len(texts))
+        reserved.append(svc._memory_governor.reserved)
+        if len(calls) > batches:
+            raise RuntimeError("embedding backend unavailable")
+        return embed(texts, backend)
+
+    fp.write_text(text)
+    mtime = fp.stat().st_mtime + 10
+    os.utime(fp, (mtime, mtime))
+
+    with monkeypatch.context() as m:
+        m.setattr(svc, "_embed_texts", _failing_embed)
+        svc._run_indexing()
+    assert svc._ws().progress.status == "error"
+    # Memory reserved for the file, the batch and the pending writes is
+    # released on the error path as well.
+    assert min(reserved) > 0
+    assert svc._memory_governor.reserved == 0
+
+    # The first part reached the store, the rest still holds the old text.
+    col = client.get_collection(svc._live_collection_name())
+    first = col.get(ids=[f"{fp}:0"])["documents"][0]
+    assert first in text
+
+    calls.clear()
+    monkeypatch.setattr(
+        svc, "_embed_texts", lambda texts, backend=None: calls.append(1) or embed(texts, backend)
+    )
+    svc._run_indexing()
+    assert svc._ws().progress.status == "completed", svc._ws().progress.error
+    assert calls, "the interrupted file was not re-embedded"
+
+    stored = col.get(where={"path": {"$eq": fp.name}})
+    n_chunks = svc._load_manifest(col)[fp.name]["n_chunks"]
+    assert sorted(stored["ids"]) == sorted(f"{fp}:{i}" for i in range(n_chunks))
+    assert all(doc in text for doc in stored["documents"])
+
+
+def test_interrupted_rewrite_is_not_mistaken_for_complete(monkeypatch, tmp_path):
+    chromadb = pytest.importorskip("chromadb")
+
+    fp = tmp_path / "notes.md"
+    fp.write_text(_lines("old", 1800))
+
+    svc = _import_service(
+        monkeypatch, tmp_path, CODEX_INDEX_ENUMERATION="walk", CODEX_INDEX_WRITE_BATCH="1"
+    )
+    client = chromadb.EphemeralClient()
+    monkeypatch.setattr(svc, "_remote_client", lambda: client)
+
+    svc._run_indexing()
+    assert svc._ws().progress.status == "completed", svc._ws().progress.error
+
+    # The new version is shorter – its leftovers must go as well.
+    _rewrite_interrupted(monkeypatch, svc, client, fp, _lines("new", 900))
+
+
+def test_interrupted_streamed_file_is_re_embedded(monkeypatch, tmp_path):
+    chromadb = pytest.importorskip("chromadb")
+
+    fp = tmp_path / "notes.md"
+    fp.write_text(_lines("old", 1800))
+
+    svc = _import_service(
+        monkeypatch,
+        tmp_path,
+        CODEX_INDEX_ENUMERATION="walk",
+        CODEX_INDEX_WRITE_BATCH="1",
+        CODEX_INDEX_SEGMENT_BYTES="8K",
+    )
+    client = chromadb.EphemeralClient()
+    monkeypatch.setattr(svc, "_remote_client", lambda: client)
+
+    svc._run_indexing()
+    assert svc._ws().progress.status == "completed", svc._ws().progress.error
+
+    # Both versions are streamed in 8 KiB segments; the run fails partway
+    # through the file, after its first 20 chunks were written.
+    text = _lines("new", 1500)
+    assert svc._memory_governor.should_stream(len(text))
+    _rewrite_interrupted(monkeypatch, svc, client, fp, text)
+
+
+class _RecordingCollection:
+    """Collection proxy recording the write calls of every thread."""
+
+    def __init__(self, col):
+        self._col = col
+        self._lock = threading.Lock()
+        self.calls = []
+
+    def __getattr__(self, name):
+        return getattr(self._col, name)
+
+    def _record(self, op, **kwargs):
+        with self._lock:
+            self.calls.append((threading.current_thread().name, op))
+            return getattr(self._col, op)(**kwargs)
+
+    def delete(self, **kwargs):
+        return self._record("delete", **kwargs)
+
+    def upsert(self, **kwargs):
+        return self._record("upsert", **kwargs)
+
+    def update(self, **kwargs):
+        return self._record("update", **kwargs)
+
+
+def test_coalescer_flush_order_under_concurrent_writes(monkeypatch, tmp_path):
+    chromadb = pytest.importorskip("chromadb")
+    np = pytest.importorskip("numpy")
+
+    svc = _import_service(monkeypatch, tmp_path)
+    monkeypatch.setattr(svc, "WRITE_FLUSH_INTERVAL", 3600)
+    col = _RecordingCollection(
+        chromadb.EphemeralClient().get_or_create_collection(f"coalescer_{tmp_path.name}")
+    )
+    roots = [f"/root{i}" for i in range(6)]
+    start = threading.Barrier(len(roots))
+    errors = []
+
+    def _chunks(root, version, n):
+        ids = [f"{root}/README.md:{i}" for i in range(n)]
+        docs = [f"{version} {i}" for i in range(n)]
+        metas = [{"root": root, "path": "README.md", "chunk_index": i} for i in range(n)]
+        return ids, docs, metas, np.full((n, 4), version, dtype=np.float32)
+
+    def _write(root):
+        # Every root holds README.md – only the (root, path) key tells them apart.
+        key = (root, "README.md")
+        writer = svc.WriteCoalescer(col)
+        try:
+            start.wait(5)
+            writer.upsert(key, *_chunks(root, 1, 3))
+            # Overlaps the pending upsert, which therefore has to go first.
+            writer.delete_paths([key])
+            writer.upsert(key, *_chunks(root, 2, 2))
+            writer.update(key, ids=[f"{root}/README.md:0"], metadatas=[{"n_chunks": 2}])
+            writer.flush()
+        except Exception as exc:  # pragma: no cover – reported below
+            errors.append(exc)
+
+    threads = [threading.Thread(target=_write, args=(root,), name=root) for root in roots]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    for root in roots:
+        ops = [op for name, op in col.calls if name == root]
+        assert ops == ["upsert", "delete", "upsert", "update"]
+
+        stored = col.get(where={"root": {"$eq": root}})
+        assert sorted(stored["ids"]) == [f"{root}/README.md:0", f"{root}/README.md:1"]
+        assert sorted(stored["documents"]) == ["2 0", "2 1"]
+        first = stored["metadatas"][stored["ids"].index(f"{root}/README.md:0")]
+        assert first["n_chunks"] == 2
+
+
+def test_random_projection_is_reproducible(monkeypatch, tmp_path):
+    np = pytest.importorskip("numpy")
+    svc = _import_service(monkeypatch, tmp_path)
+
+    projection = svc.Projection.random(20, 8, seed=7)
+    assert projection.matrix.shape == (20, 8)
+    assert projection.matrix.dtype == np.float32
+    assert (projection.source_dim, projection.dim) == (20, 8)
+    assert projection.identity == "random:20x8:s7"
+
+    # The identity alone recreates the same matrix; other seeds differ.
+    assert np.array_equal(svc._projection_for(projection.identity).matrix, projection.matrix)
+    assert not np.array_equal(svc.Projection.random(20, 8, seed=8).matrix, projection.matrix)
+
+    vectors = np.random.default_rng(0).standard_normal((5, 20))
+    projected = projection.apply(vectors)
+    assert projected.shape == (5, 8)
+    assert projected.dtype == np.float32
+
+
+def test_pca_projection_keeps_the_main_components(monkeypatch, tmp_path):
+    np = pytest.importorskip("numpy")
+    svc = _import_service(monkeypatch, tmp_path)
+
+    rng = np.random.default_rng(0)
+    # Variance concentrated in the first dimensions.
+    sample = rng.standard_normal((200, 20)) * np.linspace(10, 0.1, 20) + 3
+    projection = svc.Projection.fit_pca(sample, 4)
+
+    assert projection.kind == "pca"
+    assert projection.matrix.shape == (20, 4)
+    assert projection.matrix.dtype == projection.mean.dtype == np.float32
+    assert projection.identity.startswith("pca:20x4:")
+    assert svc.Projection.fit_pca(sample, 4).identity == projection.identity
+    assert np.allclose(projection.matrix.T @ projection.matrix, np.eye(4), atol=1e-5)
+
+    projected = projection.apply(sample)
+    assert projected.shape == (200, 4)
+    assert projected.dtype == np.float32
+    assert np.allclose(projected.mean(axis=0), 0, atol=1e-3)
+    variances = projected.var(axis=0)
+    assert list(variances) == sorted(variances, reverse=True)
+
+    # Fitted bases are persisted and loaded by identity.
+    projection.save(svc._projection_path(projection.identity))
+    loaded = svc._projection_for(projection.identity)
+    assert np.array_equal(loaded.apply(sample), projected)
+
+
+def test_projection_eval_reports_recall(monkeypatch, tmp_path):
+    from fastapi.testclient import TestClient
+
+    (tmp_path / "src").mkdir()
+    for i in range(40):
+        (tmp_path / "src" / f"module_{i}.py").write_text(
+            "".join(f"def handler_{i}_{j}(request):\n    return {i * j}\n" for j in range(60))
+        )
+
+    svc = _import_service(monkeypatch, tmp_path, CODEX_INDEX_ENUMERATION="walk")
+    http = TestClient(svc.app)
+
+    response = http.get("/index/projection/eval", params={"dims": "2,16,19", "k": 5})
+    assert response.status_code == 200, response.text
+    report = response.json()
+
+    assert report["source_dim"] == 20
+    assert report["queries"] > len(svc.EVAL_QUERIES)
+    recall = {(r["kind"], r["dim"]): r["recall"] for r in report["results"]}
+    assert set(recall) == {(kind, dim) for kind in ("random", "pca") for dim in (2, 16, 19)}
+    assert all(0 <= value <= 1 for value in recall.values())
+    # More dimensions retain more of the neighbourhood structure.
+    for kind in ("random", "pca"):
+        assert recall[(kind, 2)] < recall[(kind, 19)]
+    assert recall[("pca", 19)] >= 0.8
+
+    assert http.get("/index/projection/eval", params={"dims": "a,b"}).status_code == 422
+
+
+def test_search_rejects_mismatched_projections(monkeypatch, tmp_path):
+    from fastapi.testclient import TestClient
+
+    chromadb = pytest.importorskip("chromadb")
+
+    (tmp_path / "src").mkdir()
+    for name in ("alpha", "beta", "gamma"):
+        (tmp_path / "src" / f"{name}.py").write_text(f"def {name}():\n    return '{name}'\n")
+
+    svc = _import_service(
+        monkeypatch,
+        tmp_path,
+        CODEX_INDEX_ENUMERATION="walk",
+        CODEX_INDEX_PROJECTION="random",
+        CODEX_INDEX_PROJECTION_DIM="8",
+    )
+    client = chromadb.EphemeralClient()
+    monkeypatch.setattr(svc, "_remote_client", lambda: client)
+    http = TestClient(svc.app)
+
+    svc._run_indexing()
+    col = client.get_collection(svc._live_collection_name())
+    assert col.metadata["projection"] == f"random:20x8:s{svc.PROJECTION_SEED}"
+    assert len(col.get(limit=1, include=["embeddings"])["embeddings"][0]) == 8
+
+    # Queries are projected like the stored vectors.
+    response = http.post("/search", json={"query": "alpha", "k": 2})
+    assert response.status_code == 200, response.text
+    assert len(response.json()["documents"]) == 2
+
+    # A projection for vectors of another backend, and one whose basis is gone.
+    for identity in ("random:32x8:s1", "pca:20x8:0123456789ab"):
+        col.modify(metadata={**col.metadata, "projection": identity})
+        response = http.post("/search", json={"query": "alpha", "k": 2})
+        assert response.status_code == 409
+        assert "re-run /index" in response.json()["detail"]
+
+
+def test_search_qos_shares(monkeypatch, tmp_path):
+    svc = _import_service(monkeypatch, tmp_path)
+    qos = svc.SearchQoS()
+    monkeypatch.setattr(qos, "_read_shared", lambda: {})
+
+    # No recent searches – the indexer runs unthrottled.
+    assert qos.status()["indexer_share"] == 1.0
+    qos._latencies.append((time.time() - svc.QOS_WINDOW - 1, 500.0))
+    assert qos.status()["indexer_share"] == 1.0
+
+    with qos.track():
+        assert qos.status()["in_flight"] == 1
+    status = qos.status()
+    assert status["in_flight"] == 0
+    assert status["p99_ms"] < svc.SEARCH_LATENCY_TARGET_MS
+    assert status["indexer_share"] == svc.INDEXER_MAX_SHARE
+
+    # A p99 twice the target halves the share, down to the floor.
+    target = svc.SEARCH_LATENCY_TARGET_MS
+    qos._latencies.append((time.time(), 2 * target))
+    assert qos.status()["p99_ms"] == 2 * target
+    assert qos.status()["indexer_share"] == pytest.approx(svc.INDEXER_MAX_SHARE / 2)
+    qos._latencies.append((time.time(), 1000 * target))
+    assert qos.status()["indexer_share"] == svc.QOS_MIN_SHARE
+
+    # Slow searches served by other workers count as well.
+    other = svc.SearchQoS()
+    monkeypatch.setattr(
+        other,
+        "_read_shared",
+        lambda: {"search:other": {"p99_ms": 4 * target, "last_search_at": time.time()}},
+    )
+    assert other.status()["p99_ms"] == 4 * target
+    assert other.status()["indexer_share"] == pytest.approx(svc.INDEXER_MAX_SHARE / 4)
+    assert other.batch_size(256) == int(256 * svc.INDEXER_MAX_SHARE / 4)
+
+
+def test_search_qos_pauses_outside_the_operation(monkeypatch, tmp_path):
+    svc = _import_service(monkeypatch, tmp_path)
+
+    assert svc.SearchQoS.pause_for(2.0, 1.0) == 0.0
+    assert svc.SearchQoS.pause_for(2.0, 0.5) == pytest.approx(2.0)
+    assert svc.SearchQoS.pause_for(1.0, 0.25) == pytest.approx(3.0)
+
+    qos = svc.SearchQoS()
+    monkeypatch.setattr(qos, "status", lambda: {"indexer_share": 0.25})
+    clock, sleeps = [0.0], []
+    monkeypatch.setattr(svc.time, "perf_counter", lambda: clock[0])
+    monkeypatch.setattr(svc.time, "sleep", sleeps.append)
+
+    with qos.throttled():
+        clock[0] += 2.0
+    # The pause is owed, not slept while the caller may hold a slot …
+    assert sleeps == []
+    # … and paid before the next slot is requested, exactly once.
+    qos.pace()
+    qos.pace()
+    assert sleeps == [pytest.approx(6.0)]
+
+    # An operation started with a pause still owed pays it first.
+    with qos.throttled():
+        clock[0] += 1.0
+    with qos.throttled():
+        assert sleeps == [pytest.approx(6.0), pytest.approx(3.0)]
+
+
+class _FlakyClient:
+    """Chroma client proxy whose heartbeat can be switched off."""
+
+    def __init__(self, client):
+        self._client = client
+        self.up = True
+        self.heartbeats = 0
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def heartbeat(self):
+        self.heartbeats += 1
+        if not self.up:
+            raise ConnectionError("connection refused")
+        return self._client.heartbeat()
+
+
+def test_readiness_follows_chroma(monkeypatch, tmp_path):
+    from fastapi.testclient import TestClient
+
+    chromadb = pytest.importorskip("chromadb")
+
+    svc = _import_service(monkeypatch, tmp_path, CODEX_READY_CHECK_TTL="0")
+    client = _FlakyClient(chromadb.EphemeralClient())
+    monkeypatch.setattr(svc, "_remote_client", lambda: client)
+    http = TestClient(svc.app)
+
+    svc._warm_backends()
+    assert http.get("/readyz").status_code == 200
+
+    client.up = False
+    response = http.get("/readyz")
+    assert response.status_code == 503
+    assert response.json()["status"] == "unavailable"
+    assert response.json()["embedding_backend"] is True
+    assert "unreachable" in response.json()["error"]
+
+    client.up = True
+    assert http.get("/readyz").json()["status"] == "ready"
+
+    # Within the TTL probes reuse the last heartbeat.
+    monkeypatch.setattr(svc, "READY_CHECK_TTL", 60)
+    heartbeats = client.heartbeats
+    for _ in range(3):
+        assert http.get("/readyz").status_code == 200
+    assert client.heartbeats == heartbeats
+
+
+def test_residual_path_prefix_matches_whole_segments(monkeypatch, tmp_path):
+    from fastapi.testclient import TestClient
+
+    chromadb = pytest.importorskip("chromadb")
+
+    for rel in ("src/app.py", "src/deep/view.py", "src2/app.py", "srcfoo.py"):
+        (tmp_path / rel).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / rel).write_text(f"def handler():\n    return {rel!r}\n")
+
+    svc = _import_service(monkeypatch, tmp_path, CODEX_INDEX_ENUMERATION="walk")
+    client = chromadb.EphemeralClient()
+    monkeypatch.setattr(svc, "_remote_client", lambda: client)
+    http = TestClient(svc.app)
+    svc._run_indexing()
+
+    assert svc._under_prefix("src/app.py", "src")
+    assert svc._under_prefix("src", "src/")
+    assert not svc._under_prefix("src2/app.py", "src")
+    assert not svc._under_prefix("srcfoo.py", "src")
+
+    # Without directory pushdown the whole prefix is matched on the hits.
+    monkeypatch.setattr(svc, "PATH_PREFIX_DEPTH", 0)
+    assert svc._build_search_where(svc.SearchRequest(query="q", path_prefix="src")) == (None, "src")
+
+    response = http.post("/search", json={"query": "handler", "k": 10, "path_prefix": "src"})
+    assert response.status_code == 200, response.text
+    paths = sorted(m["path"] for m in response.json()["metadatas"])
+    assert paths == ["src/app.py", "src/deep/view.py"]
+
+
+def test_throughput_tracker_rates_and_eta(monkeypatch, tmp_path):
+    svc = _import_service(monkeypatch, tmp_path)
+    clock = [100.0]
+    tracker = svc._ThroughputTracker(clock=lambda: clock[0])
+    status = {
+        "status": "running",
+        "started_at": 90.0,
+        "processed_files": 5,
+        "total_files": 20,
+        "processed_chunks": 50,
+        "total_chunks": 60,
+        "embed_latency_ms": 12.345,
+    }
+
+    # The first snapshot already measures from the start of the run.
+    metrics = tracker.update(status)
+    assert metrics == {
+        "files_per_second": 0.5,
+        "chunks_per_second": 5.0,
+        "embed_latency_ms": 12.35,
+        # 60 chunks in 5 of 20 files extrapolate to 240, 190 are left.
+        "eta_seconds": 38.0,
+    }
+
+    # Chunks arrive in bursts – unchanged counters do not zero the rate.
+    clock[0] = 101.0
+    assert tracker.update(status)["chunks_per_second"] == pytest.approx(50 / 11, abs=0.01)
+
+    # Older snapshots leave the averaging window.
+    clock[0] = 120.0
+    status.update(processed_files=15, processed_chunks=150, total_chunks=180)
+    metrics = tracker.update(status)
+    assert metrics["chunks_per_second"] == pytest.approx(100 / 19, abs=0.01)
+    assert metrics["eta_seconds"] == pytest.approx((240 - 150) / (100 / 19), abs=0.1)
+
+    # A new run resets the window; before its first write the ETA follows
+    # the file rate.
+    clock[0] = 204.0
+    status.update(
+        started_at=200.0, processed_files=2, total_files=10, processed_chunks=0, total_chunks=0
+    )
+    metrics = tracker.update(status)
+    assert (metrics["chunks_per_second"], metrics["eta_seconds"]) == (0.0, 16.0)
+
+    metrics = tracker.update({**status, "status": "completed"})
+    assert metrics["files_per_second"] is metrics["eta_seconds"] is None
+
+
+def test_index_events_stream_progress(monkeypatch, tmp_path):
+    chromadb = pytest.importorskip("chromadb")
+    httpx = pytest.importorskip("httpx")
+    uvicorn = pytest.importorskip("uvicorn")
+
+    (tmp_path / "src").mkdir()
+    for i in range(30):
+        (tmp_path / "src" / f"module_{i}.py").write_text(f"def handler_{i}():\n    return {i}\n")
+
+    svc = _import_service(monkeypatch, tmp_path, CODEX_INDEX_ENUMERATION="walk")
+    client = chromadb.EphemeralClient()
+    monkeypatch.setattr(svc, "_remote_client", lambda: client)
+
+    embed = svc._embed_texts
+
+    def _slow_embed(texts, backend=None):
+        time.sleep(0.05)
+        return embed(texts, backend)
+
+    monkeypatch.setattr(svc, "_embed_texts", _slow_embed)
+
+    # TestClient buffers streamed bodies – serve the app for real instead.
+    server = uvicorn.Server(uvicorn.Config(svc.app, host="127.0.0.1", port=0, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    _wait_for(lambda: server.started)
+    base = "http://127.0.0.1:%d" % server.servers[0].sockets[0].getsockname()[1]
+
+    events, state = [], {}
+    try:
+        with httpx.stream("GET", f"{base}/index/events", params={"interval": 0.2}, timeout=30) as r:
+            assert r.headers["content-type"].startswith("text/event-stream")
+            event = None
+            for line in r.iter_lines():
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: "):
+                    data = json.loads(line[len("data: "):])
+                    state.update(data)
+                    events.append((event, data, state["status"]))
+                    if len(events) == 1:
+                        assert httpx.post(f"{base}/index").status_code == 200
+                    elif state["status"] == "completed":
+                        break
+    finally:
+        server.should_exit = True
+        thread.join(10)
+
+    kind, snapshot, _ = events[0]
+    assert kind == "snapshot"
+    assert {"status", "processed_files", "total_files", "eta_seconds"} <= set(snapshot)
+
+    running = [data for kind, data, status in events[1:] if status == "running"]
+    assert running, "no progress events while indexing"
+    assert all(data["files_per_second"] is not None for data in running)
+    # Chunks are only counted once the coalescer flushed them, which this
+    # short run does at its end – the ETA follows the file rate until then.
+    assert any(data["eta_seconds"] is not None for data in running)
+    assert state["processed_files"] == state["total_files"]
+
+
+def test_each_file_is_read_once_and_touches_only_refresh_metadata(monkeypatch, tmp_path):
+    chromadb = pytest.importorskip("chromadb")
+
+    (tmp_path / "src").mkdir()
+    for name in ("alpha", "beta"):
+        (tmp_path / "src" / f"{name}.py").write_text(f"def {name}():\n    return '{name}'\n")
+    (tmp_path / "src" / "small.md").write_text(_lines("small", 100))
+    (tmp_path / "src" / "large.md").write_text(_lines("large", 800))  # streamed
+
+    svc = _import_service(
+        monkeypatch, tmp_path, CODEX_INDEX_ENUMERATION="walk", CODEX_INDEX_SEGMENT_BYTES="4K"
+    )
+    client = chromadb.EphemeralClient()
+    monkeypatch.setattr(svc, "_remote_client", lambda: client)
+    assert svc._memory_governor.should_stream((tmp_path / "src" / "large.md").stat().st_size)
+    assert not svc._memory_governor.should_stream((tmp_path / "src" / "small.md").stat().st_size)
+
+    opened, embedded = [], []
+    real_open, read_bytes, embed = open, Path.read_bytes, svc._embed_texts
+
+    def _open(file, *args, **kwargs):
+        opened.append(Path(file).name)
+        return real_open(file, *args, **kwargs)
+
+    def _read_bytes(path):
+        opened.append(path.name)
+        return read_bytes(path)
+
+    monkeypatch.setattr(svc, "open", _open, raising=False)
+    monkeypatch.setattr(Path, "read_bytes", _read_bytes)
+    monkeypatch.setattr(
+        svc, "_embed_texts", lambda texts, backend=None: embedded.extend(texts) or embed(texts, backend)
+    )
+
+    svc._run_indexing()
+    assert svc._ws().progress.status == "completed", svc._ws().progress.error
+    sources = [name for name in opened if name.startswith(("alpha", "beta", "small", "large"))]
+    assert sorted(sources) == ["alpha.py", "beta.py", "large.md", "small.md"]
+
+    col = client.get_collection(svc._live_collection_name())
+    before = {m["chunk_index"]: m for m in col.get(where={"path": "src/small.md"})["metadatas"]}
+    assert len(before) > 1
+
+    # Only the timestamp changes – the chunks keep their vectors.
+    fp = tmp_path / "src" / "small.md"
+    mtime = int(fp.stat().st_mtime) + 60
+    os.utime(fp, (mtime, mtime))
+    opened.clear()
+    embedded.clear()
+
+    svc._run_indexing()
+    assert svc._ws().progress.status == "completed", svc._ws().progress.error
+    assert embedded == []
+    assert opened.count("small.md") == 1
+
+    after = {m["chunk_index"]: m for m in col.get(where={"path": "src/small.md"})["metadatas"]}
+    assert set(after) == set(before)
+    assert all(meta["mtime"] == mtime for meta in after.values())
+    assert after[0]["sha1"] == before[0]["sha1"]
+    assert after[0]["n_chunks"] == len(after)